@@ -0,0 +1,263 @@
+import os
+import json
+from datetime import datetime, timedelta
+
+import cv2
+import numpy as np
+from PIL import Image
+
+# Resolutions images are generated at, as (width, height)
+RESOLUTIONS = [(640, 480), (1280, 960), (1920, 1080), (3024, 4032), (4032, 3024)]
+
+# Share of each kind of image in a corpus
+KIND_WEIGHTS = {
+    "sharp": 0.3,
+    "gaussian_blur": 0.15,
+    "motion_blur": 0.15,
+    "near_duplicate": 0.15,
+    "faces": 0.25,
+}
+
+# Share of images with an EXIF capture date, and the range dates fall in
+EXIF_DATE_RATE = 0.8
+DATE_RANGE = (datetime(2015, 1, 1), datetime(2024, 12, 31))
+
+# Default folder faces are cut from, and the margin kept around them
+FACE_SOURCE_DIR = "Image Samples"
+FACE_SOURCE_MARGIN = 0.25
+
+JPEG_QUALITY = 90
+MANIFEST_FILENAME = "corpus.json"
+
+_EXIF_DATETIME = 0x0132
+_EXIF_IFD = 0x8769
+_EXIF_DATETIME_ORIGINAL = 0x9003
+
+
+def _rng(seed, index):
+    # One independent stream per image, so image i does not depend on the count
+    return np.random.default_rng([seed, index])
+
+
+def random_scene(rng, width, height):
+    """
+    A sharp synthetic scene: a textured color gradient with random shapes,
+    lines and text-like strokes, plus sensor-like noise.
+    """
+    top = rng.integers(0, 256, 3)
+    bottom = rng.integers(0, 256, 3)
+    ramp = np.linspace(0, 1, height, dtype=np.float32)[:, None, None]
+    # Fine texture everywhere, like foliage or fabric, so no region is flat
+    texture = rng.normal(0, 30, ((height + 1) // 2, (width + 1) // 2)).astype(np.float32)
+    texture = cv2.resize(texture, (width, height), interpolation=cv2.INTER_NEAREST)[:, :, None]
+    image = np.clip(top * (1 - ramp) + bottom * ramp + texture, 0, 255).astype(np.uint8)
+
+    scale = max(width, height) / 1000
+    for _ in range(int(rng.integers(20, 60))):
+        color = tuple(int(c) for c in rng.integers(0, 256, 3))
+        x, y = int(rng.integers(0, width)), int(rng.integers(0, height))
+        shape = rng.integers(0, 4)
+        if shape == 0:
+            w, h = (int(v * scale) for v in rng.integers(20, 250, 2))
+            cv2.rectangle(image, (x, y), (x + w, y + h), color, -1)
+        elif shape == 1:
+            cv2.circle(image, (x, y), int(rng.integers(10, 150) * scale), color, -1)
+        elif shape == 2:
+            end = (int(rng.integers(0, width)), int(rng.integers(0, height)))
+            cv2.line(image, (x, y), end, color, max(1, int(rng.integers(1, 6) * scale)))
+        else:
+            text = "".join(chr(c) for c in rng.integers(65, 91, int(rng.integers(3, 10))))
+            cv2.putText(image, text, (x, y), cv2.FONT_HERSHEY_SIMPLEX, scale * rng.uniform(0.5, 2),
+                        color, max(1, int(2 * scale)), cv2.LINE_AA)
+
+    noise = rng.normal(0, 4, image.shape).astype(np.float32)
+    return np.clip(image + noise, 0, 255).astype(np.uint8)
+
+
+def gaussian_blur(image, sigma):
+    return cv2.GaussianBlur(image, (0, 0), sigma)
+
+
+def motion_blur(image, length, angle):
+    """
+    Blurs along a line of `length` pixels at `angle` degrees, like camera shake.
+    """
+    length = max(3, int(length) | 1)
+    kernel = np.zeros((length, length), dtype=np.float32)
+    kernel[length // 2, :] = 1
+    rotation = cv2.getRotationMatrix2D((length / 2 - 0.5, length / 2 - 0.5), angle, 1)
+    kernel = cv2.warpAffine(kernel, rotation, (length, length))
+    return cv2.filter2D(image, -1, kernel / kernel.sum())
+
+
+def near_duplicate(image, rng):
+    """
+    A near-duplicate of an image: a slight crop, resized back, re-compressed
+    at a random JPEG quality. Returns (image, crop fraction, quality).
+    """
+    height, width = image.shape[:2]
+    crop = float(rng.uniform(0, 0.05))
+    dx, dy = int(width * crop / 2), int(height * crop / 2)
+    cropped = image[dy:height - dy, dx:width - dx]
+    resized = cv2.resize(cropped, (width, height), interpolation=cv2.INTER_AREA)
+    quality = int(rng.integers(60, 91))
+    _, encoded = cv2.imencode(".jpg", resized, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    return cv2.imdecode(encoded, cv2.IMREAD_COLOR), crop, quality
+
+
+def load_face_patches(source_dir=FACE_SOURCE_DIR):
+    """
+    Faces cut from the photos in source_dir with some margin, found with
+    the frontal face cascade. Returns a list of BGR patches.
+    """
+    from features.face_detection import load_face_cascade, HAAR_SCALE_FACTOR, HAAR_MIN_NEIGHBORS
+    cascade = load_face_cascade()
+    patches = []
+    if not os.path.isdir(source_dir):
+        return patches
+    for name in sorted(os.listdir(source_dir)):
+        image = cv2.imread(os.path.join(source_dir, name))
+        if image is None:
+            continue
+        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        faces = cascade.detectMultiScale(gray, scaleFactor=HAAR_SCALE_FACTOR,
+                                         minNeighbors=HAAR_MIN_NEIGHBORS, minSize=(80, 80))
+        for (x, y, w, h) in faces:
+            m = int(max(w, h) * FACE_SOURCE_MARGIN)
+            x0, y0 = max(0, x - m), max(0, y - m)
+            patches.append(image[y0:y + h + m, x0:x + w + m].copy())
+    return patches
+
+
+def drawn_face(size):
+    """
+    A simple drawn face, used when no face photos are available. The face
+    cascade does not reliably detect it.
+    """
+    patch = np.full((size, size, 3), 200, dtype=np.uint8)
+    center = (size // 2, size // 2)
+    cv2.ellipse(patch, center, (size * 2 // 5, size // 2 - 2), 0, 0, 360, (140, 170, 220), -1)
+    for dx in (-1, 1):
+        cv2.circle(patch, (size // 2 + dx * size // 6, size * 2 // 5), max(2, size // 20), (40, 40, 40), -1)
+    cv2.ellipse(patch, (size // 2, size * 2 // 3), (size // 6, size // 14), 0, 0, 180, (60, 60, 150), 2)
+    return patch
+
+
+def paste_faces(image, patches, rng):
+    """
+    Pastes one to three faces at random sizes (5-40% of the image width)
+    and offsets, blended in with a feathered elliptical mask. Returns the
+    full-image (x, y, w, h) boxes of the pasted patches.
+    """
+    height, width = image.shape[:2]
+    boxes = []
+    for _ in range(int(rng.integers(1, 4))):
+        size = int(width * rng.uniform(0.05, 0.4))
+        size = max(24, min(size, height - 1, width - 1))
+        if patches:
+            patch = patches[int(rng.integers(0, len(patches)))]
+            patch = cv2.resize(patch, (size, size), interpolation=cv2.INTER_AREA)
+        else:
+            patch = drawn_face(size)
+        x = int(rng.integers(0, width - size))
+        y = int(rng.integers(0, height - size))
+
+        mask = np.zeros((size, size), dtype=np.float32)
+        cv2.ellipse(mask, (size // 2, size // 2), (size // 2 - 1, size // 2 - 1), 0, 0, 360, 1, -1)
+        mask = cv2.GaussianBlur(mask, (0, 0), max(1, size / 30))[:, :, None]
+        region = image[y:y + size, x:x + size].astype(np.float32)
+        image[y:y + size, x:x + size] = (patch * mask + region * (1 - mask)).astype(np.uint8)
+        boxes.append([x, y, size, size])
+    return boxes
+
+
+def random_date(rng):
+    start, end = DATE_RANGE
+    seconds = int(rng.integers(0, int((end - start).total_seconds())))
+    return start + timedelta(seconds=seconds)
+
+
+def save_jpeg(image, path, date=None, quality=JPEG_QUALITY):
+    """
+    Saves a BGR image as JPEG, with EXIF DateTime and DateTimeOriginal if
+    a date is given.
+    """
+    pil_image = Image.fromarray(cv2.cvtColor(image, cv2.COLOR_BGR2RGB))
+    options = {"quality": quality}
+    if date is not None:
+        exif = Image.Exif()
+        stamp = date.strftime("%Y:%m:%d %H:%M:%S")
+        exif[_EXIF_DATETIME] = stamp
+        exif[_EXIF_IFD] = {_EXIF_DATETIME_ORIGINAL: stamp}
+        options["exif"] = exif.tobytes()
+    pil_image.save(path, "JPEG", **options)
+
+
+def generate_corpus(output_dir, count=200, seed=0, face_source=FACE_SOURCE_DIR, resolutions=None):
+    """
+    Writes `count` synthetic JPEGs to output_dir, reproducibly for a given
+    seed, with a corpus.json manifest of what each image is: its kind
+    (see KIND_WEIGHTS), resolution, blur parameters, the image it
+    near-duplicates, pasted face boxes and EXIF date. Returns the manifest.
+    """
+    resolutions = resolutions or RESOLUTIONS
+    os.makedirs(output_dir, exist_ok=True)
+    kinds = list(KIND_WEIGHTS)
+    weights = np.array([KIND_WEIGHTS[k] for k in kinds])
+    patches = None
+
+    entries = []
+    for index in range(count):
+        rng = _rng(seed, index)
+        kind = kinds[int(rng.choice(len(kinds), p=weights / weights.sum()))]
+        if kind == "near_duplicate" and not entries:
+            kind = "sharp"
+        width, height = resolutions[int(rng.integers(0, len(resolutions)))]
+        date = random_date(rng) if rng.random() < EXIF_DATE_RATE else None
+        entry = {"file": f"synthetic_{index:05d}.jpg", "kind": kind, "size": [width, height]}
+
+        if kind == "near_duplicate":
+            original = entries[int(rng.integers(0, len(entries)))]
+            image = cv2.imread(os.path.join(output_dir, original["file"]))
+            image, crop, quality = near_duplicate(image, rng)
+            entry.update(size=original["size"], duplicate_of=original["file"], crop=round(crop, 4),
+                         quality=quality)
+            date = datetime.fromisoformat(original["date"]) if original["date"] else None
+        else:
+            image = random_scene(rng, width, height)
+            if kind == "gaussian_blur":
+                sigma = float(rng.uniform(1.5, 6))
+                image = gaussian_blur(image, sigma * max(width, height) / 1000)
+                entry["sigma"] = round(sigma, 3)
+            elif kind == "motion_blur":
+                length, angle = float(rng.uniform(8, 40)), float(rng.uniform(0, 180))
+                image = motion_blur(image, length * max(width, height) / 1000, angle)
+                entry.update(length=round(length, 2), angle=round(angle, 1))
+            elif kind == "faces":
+                if patches is None:
+                    patches = load_face_patches(face_source) if face_source else []
+                entry["faces"] = paste_faces(image, patches, rng)
+
+        entry["date"] = date.isoformat() if date else None
+        save_jpeg(image, os.path.join(output_dir, entry["file"]), date)
+        entries.append(entry)
+
+    manifest = {"seed": seed, "count": count, "images": entries}
+    with open(os.path.join(output_dir, MANIFEST_FILENAME), "w") as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+
+def corpus_images(corpus_dir):
+    """
+    Paths of the images of a corpus, in manifest order, or every image
+    file in the folder if it has no manifest.
+    """
+    manifest_path = os.path.join(corpus_dir, MANIFEST_FILENAME)
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            return [os.path.join(corpus_dir, e["file"]) for e in json.load(f)["images"]]
+    return sorted(
+        os.path.join(corpus_dir, name) for name in os.listdir(corpus_dir)
+        if os.path.splitext(name)[1].lower() in (".jpg", ".jpeg", ".png", ".webp")
+    )
@@ -0,0 +1,311 @@
+import os
+import sys
+import json
+import shutil
+import argparse
+import platform
+import tempfile
+import multiprocessing
+from time import perf_counter
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from benchmarks.corpus import generate_corpus, corpus_images
+
+# Benchmarks in the order they run: a feature's pipeline stages, by the
+# feature's option name, then "process", the end-to-end /api/process path
+BENCHMARKS = [
+    "remove_blur",
+    "remove_duplicates",
+    "remove_bad_angles",
+    "cluster_face",
+    "sort_date",
+    "process",
+]
+
+# Features the end-to-end benchmark enables; background removal needs a
+# downloaded model, so it is left out unless asked for
+PROCESS_OPTIONS = ["cluster_face", "remove_duplicates", "remove_blur", "remove_bad_angles", "sort_date"]
+
+# Relative change from which compare reports a regression
+REGRESSION_THRESHOLD = 0.10
+
+# Metrics compared between runs, and whether higher values are better
+METRICS = {
+    "images_per_second": True,
+    "p50_ms": False,
+    "p95_ms": False,
+    "peak_rss_mb": False,
+}
+
+
+def _peak_rss_mb(children=False):
+    try:
+        import resource
+    except ImportError:
+        return None
+    who = resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(who).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def _summarize(count, seconds, latencies):
+    return {
+        "images": count,
+        "seconds": round(seconds, 3),
+        "images_per_second": round(count / seconds, 2) if seconds else None,
+        "p50_ms": round(float(np.percentile(latencies, 50)) * 1000, 2) if latencies else None,
+        "p95_ms": round(float(np.percentile(latencies, 95)) * 1000, 2) if latencies else None,
+    }
+
+
+def _rounded(timings):
+    return {stage: {span: round(seconds, 3) for span, seconds in spans.items()}
+            for stage, spans in timings.items()}
+
+
+def _feature_benchmark(name, paths):
+    """
+    The pipeline stages of one feature, run as the workers run them on
+    ImageFrame proxies. Latencies time analyze_image on each image alone;
+    the throughput covers analyzing the corpus in worker-sized batches with
+    analyze_images, then the stages' selections over the summaries.
+    """
+    from pipeline import settings
+    from pipeline.engine import analyze_image, analyze_images, build_stages, select_frames
+    from pipeline.frame import ImageFrame
+    from pipeline.metrics import add_spans
+
+    options = {name: True}
+    # The first call loads models and is not timed
+    analyze_image((paths[0], None), options)
+    latencies = []
+    for path in paths:
+        start = perf_counter()
+        analyze_image((path, None), options)
+        latencies.append(perf_counter() - start)
+
+    timings = {}
+    frames = []
+    start = perf_counter()
+    for offset in range(0, len(paths), settings.CHUNK_SIZE):
+        batch = paths[offset:offset + settings.CHUNK_SIZE]
+        for path, result in zip(batch, analyze_images([(path, None) for path in batch], options)):
+            frame = ImageFrame(path)
+            frame.summary.update(result[0])
+            frames.append(frame)
+            add_spans(timings, result[3])
+    stats = {}
+    select_frames(frames, build_stages(options), stats)
+    result = _summarize(len(paths), perf_counter() - start, latencies)
+    add_spans(timings, stats["timings"])
+    # Seconds per stage and span over the batched pass
+    result["timings"] = _rounded(timings)
+    return result
+
+
+def _process_benchmark(paths, work_dir, repeat, options):
+    """
+    The /api/process path: files are streamed into an upload session,
+    background pre-analysis is awaited, and the pipeline runs over the
+    session. Latencies are per run, since the pipeline processes all
+    images together.
+    """
+    from pipeline.ingest import Ingestor
+    from pipeline.engine import run_pipeline
+    from pipeline.metrics import add_spans
+
+    ingestor = Ingestor(os.path.join(work_dir, "uploads"))
+    enabled = {name: True for name in options}
+    latencies = []
+    timings = {}
+    for run in range(repeat):
+        session_id = f"benchmark{run}"
+        output_dir = os.path.join(work_dir, "processed", session_id)
+        os.makedirs(ingestor.session_dir(session_id))
+        os.makedirs(output_dir)
+
+        start = perf_counter()
+        for path in paths:
+            with open(path, "rb") as f:
+                ingestor.save_stream(session_id, os.path.basename(path), f)
+        ingestor.wait_for_session(session_id)
+        session_dir = ingestor.session_dir(session_id)
+        image_paths = [os.path.join(session_dir, name) for name in os.listdir(session_dir)]
+        _, stats = run_pipeline(image_paths, output_dir, enabled,
+                                content_hashes=ingestor.content_hashes(session_id))
+        latencies.append(perf_counter() - start)
+        add_spans(timings, stats["timings"])
+
+    result = _summarize(len(paths) * repeat, sum(latencies), latencies)
+    result["options"] = options
+    # Seconds per stage and span over all runs, for sizing worker pools
+    result["timings"] = _rounded(timings)
+    return result
+
+
+def _run_one(name, paths, repeat, process_options):
+    # Runs in a fresh process, so peak memory belongs to this benchmark alone
+    from pipeline.executor import shutdown_pools
+
+    work_dir = tempfile.mkdtemp(prefix=f"benchmark_{name}_")
+    try:
+        if name == "process":
+            result = _process_benchmark(paths, work_dir, repeat, process_options)
+        else:
+            result = _feature_benchmark(name, paths)
+        shutdown_pools()
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    result["peak_rss_mb"] = _peak_rss_mb()
+    # Worker processes of the image pool, if it used processes
+    result["peak_worker_rss_mb"] = _peak_rss_mb(children=True)
+    return result
+
+
+def run_benchmarks(paths, names=None, repeat=1, process_options=None):
+    """
+    Runs the named benchmarks (all of BENCHMARKS by default) over the image
+    paths, each in its own process. Returns the results by name.
+    """
+    results = {}
+    context = multiprocessing.get_context("spawn")
+    for name in names or BENCHMARKS:
+        print(f"Running {name} on {len(paths)} images...")
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+            results[name] = pool.submit(
+                _run_one, name, paths, repeat, process_options or PROCESS_OPTIONS
+            ).result()
+        print(f"  {_format_result(results[name])}")
+    return results
+
+
+def _format_result(result):
+    return (f"{result['images_per_second']} images/s, p50 {result['p50_ms']} ms, "
+            f"p95 {result['p95_ms']} ms, peak RSS {result['peak_rss_mb']} MB")
+
+
+def _environment():
+    from pipeline import settings
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "executor": settings.EXECUTOR_KIND,
+        "workers": settings.WORKER_COUNT,
+        "analysis_cache": bool(settings.ANALYSIS_CACHE_PATH),
+    }
+
+
+def compare_results(base, new, threshold=REGRESSION_THRESHOLD):
+    """
+    Compares two result files metric by metric. Returns a list of rows
+    (benchmark, metric, base value, new value, relative change, regressed),
+    where the change is positive when the new run is better.
+    """
+    rows = []
+    for name, new_result in new["results"].items():
+        base_result = base["results"].get(name)
+        if base_result is None:
+            continue
+        for metric, higher_is_better in METRICS.items():
+            old_value, new_value = base_result.get(metric), new_result.get(metric)
+            if not old_value or new_value is None:
+                continue
+            change = (new_value - old_value) / old_value
+            if not higher_is_better:
+                change = -change or 0.0
+            rows.append((name, metric, old_value, new_value, change, change < -threshold))
+    return rows
+
+
+def _print_comparison(rows):
+    print(f"{'benchmark':<26}{'metric':<20}{'base':>12}{'new':>12}{'change':>10}")
+    for name, metric, old_value, new_value, change, regressed in rows:
+        flag = "  REGRESSION" if regressed else ""
+        print(f"{name:<26}{metric:<20}{old_value:>12.6g}{new_value:>12.6g}{change:>+10.1%}{flag}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks", description="Image feature benchmarks")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    generate = commands.add_parser("generate", help="write a synthetic corpus")
+    generate.add_argument("output_dir")
+    generate.add_argument("--count", type=int, default=200)
+    generate.add_argument("--seed", type=int, default=0)
+    generate.add_argument("--face-source", default="Image Samples",
+                          help="folder of photos faces are cut from")
+
+    run = commands.add_parser("run", help="run benchmarks and write a result file")
+    run.add_argument("--corpus", help="corpus folder; generated into a temporary folder if omitted")
+    run.add_argument("--count", type=int, default=100, help="images of a generated corpus")
+    run.add_argument("--seed", type=int, default=0, help="seed of a generated corpus")
+    run.add_argument("--benchmarks", default=",".join(BENCHMARKS))
+    run.add_argument("--repeat", type=int, default=3, help="runs of the end-to-end benchmark")
+    run.add_argument("--process-options", default=",".join(PROCESS_OPTIONS),
+                     help="features enabled in the end-to-end benchmark")
+    run.add_argument("--cache", action="store_true",
+                     help="keep the analysis cache enabled (measures warm runs)")
+    run.add_argument("--output", default="benchmark_results.json")
+
+    compare = commands.add_parser("compare", help="compare two result files")
+    compare.add_argument("base")
+    compare.add_argument("new")
+    compare.add_argument("--threshold", type=float, default=REGRESSION_THRESHOLD)
+
+    args = parser.parse_args(argv)
+
+    if args.command == "generate":
+        manifest = generate_corpus(args.output_dir, args.count, args.seed, args.face_source)
+        print(f"Wrote {len(manifest['images'])} images to {args.output_dir}")
+        return 0
+
+    if args.command == "compare":
+        with open(args.base) as f:
+            base = json.load(f)
+        with open(args.new) as f:
+            new = json.load(f)
+        rows = compare_results(base, new, args.threshold)
+        _print_comparison(rows)
+        regressions = [row for row in rows if row[5]]
+        if regressions:
+            print(f"{len(regressions)} regression(s) beyond {args.threshold:.0%}")
+            return 1
+        return 0
+
+    names = [name for name in args.benchmarks.split(",") if name]
+    unknown = set(names) - set(BENCHMARKS)
+    if unknown:
+        parser.error(f"unknown benchmarks: {', '.join(sorted(unknown))}")
+    if not args.cache:
+        # Inherited by the benchmark processes before they read settings
+        os.environ["ANALYSIS_CACHE_PATH"] = ""
+
+    corpus_dir = args.corpus
+    generated = None
+    if corpus_dir is None:
+        generated = corpus_dir = tempfile.mkdtemp(prefix="benchmark_corpus_")
+        print(f"Generating {args.count} images (seed {args.seed})...")
+        generate_corpus(corpus_dir, args.count, args.seed)
+    try:
+        paths = corpus_images(corpus_dir)
+        results = run_benchmarks(paths, names, args.repeat,
+                                 [name for name in args.process_options.split(",") if name])
+    finally:
+        if generated:
+            shutil.rmtree(generated, ignore_errors=True)
+
+    report = {
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "corpus": {"path": args.corpus, "count": len(paths), "seed": None if args.corpus else args.seed},
+        "environment": _environment(),
+        "results": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {args.output}")
+    return 0
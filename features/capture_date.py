@@ -0,0 +1,441 @@
+import io
+import os
+import re
+import struct
+import zlib
+from datetime import datetime, timedelta
+from email.utils import parsedate_to_datetime
+
+# Largest metadata block read in one piece. A JPEG APP1 segment holds at
+# most 64 KB; HEIC meta boxes and PNG text chunks are allowed a little more.
+MAX_METADATA_BYTES = 1024 * 1024
+
+# Markers and boxes scanned before giving up on finding metadata
+MAX_SEGMENTS = 64
+
+# EXIF tags read, and the IFDs they live in
+EXIF_IFD_POINTER = 0x8769
+GPS_IFD_POINTER = 0x8825
+DATE_TIME_ORIGINAL = 0x9003
+DATE_TIME_DIGITIZED = 0x9004
+GPS_TIME_STAMP = 0x0007
+GPS_DATE_STAMP = 0x001D
+
+# Sizes of the TIFF field types read (ASCII, SHORT, LONG, RATIONAL)
+_TYPE_SIZES = {2: 1, 3: 2, 4: 4, 5: 8}
+
+_EXIF_PREFIX = b"Exif\0\0"
+_XMP_PREFIX = b"http://ns.adobe.com/xap/1.0/\0"
+
+# XMP properties holding a capture date, most specific first
+_XMP_DATE_PATTERNS = [
+    re.compile(rb'%s\s*=\s*"([^"]+)"|<%s>([^<]+)</%s>' % (name, name, name))
+    for name in (b"exif:DateTimeOriginal", b"xmp:CreateDate", b"photoshop:DateCreated")
+]
+
+
+class _BufferFile:
+    """
+    Minimal seek/read over bytes already in memory, without copying them.
+    """
+
+    def __init__(self, data):
+        self._data = memoryview(data).cast("B")
+        self._pos = 0
+
+    def read(self, size=-1):
+        end = len(self._data) if size < 0 else self._pos + size
+        chunk = bytes(self._data[self._pos:end])
+        self._pos += len(chunk)
+        return chunk
+
+    def seek(self, offset, whence=0):
+        base = (0, self._pos, len(self._data))[whence]
+        self._pos = max(0, base + offset)
+        return self._pos
+
+
+def parse_exif_datetime(value):
+    """
+    Parses an EXIF "YYYY:MM:DD HH:MM:SS" date. Returns None for empty or
+    zeroed-out dates.
+    """
+    if isinstance(value, bytes):
+        value = value.decode("ascii", "ignore")
+    value = value.strip("\0 ")
+    for fmt in ("%Y:%m:%d %H:%M:%S", "%Y-%m-%d %H:%M:%S", "%Y:%m:%d %H:%M"):
+        try:
+            return datetime.strptime(value[:19], fmt)
+        except ValueError:
+            continue
+    return None
+
+
+def _parse_iso_date(value):
+    value = value.strip()
+    for fmt, length in (("%Y-%m-%dT%H:%M:%S", 19), ("%Y-%m-%dT%H:%M", 16), ("%Y-%m-%d", 10)):
+        try:
+            return datetime.strptime(value[:length], fmt)
+        except ValueError:
+            continue
+    return None
+
+
+def _gps_datetime(date_stamp, time_stamp):
+    # GPS dates are UTC, unlike the local time of the other EXIF dates
+    date = parse_exif_datetime(date_stamp.strip("\0 ")[:10] + " 00:00:00") if date_stamp else None
+    if date is None:
+        return None
+    if time_stamp and len(time_stamp) == 3:
+        hours, minutes, seconds = time_stamp
+        date += timedelta(hours=hours, minutes=minutes, seconds=int(seconds))
+    return date
+
+
+def _read_ifd(read, endian, offset, tags):
+    """
+    Reads the wanted tags of the IFD at offset. read(offset, size) returns
+    bytes of the TIFF structure. Returns {tag: value}.
+    """
+    count_bytes = read(offset, 2)
+    if len(count_bytes) < 2:
+        return {}
+    (count,) = struct.unpack(endian + "H", count_bytes)
+    entries = read(offset + 2, 12 * min(count, 1024))
+    values = {}
+    for start in range(0, len(entries) - 11, 12):
+        tag, kind, n = struct.unpack(endian + "HHI", entries[start:start + 8])
+        if tag not in tags or kind not in _TYPE_SIZES:
+            continue
+        size = _TYPE_SIZES[kind] * n
+        if size <= 4:
+            raw = entries[start + 8:start + 8 + size]
+        elif size <= MAX_METADATA_BYTES:
+            (value_offset,) = struct.unpack(endian + "I", entries[start + 8:start + 12])
+            raw = read(value_offset, size)
+        else:
+            continue
+        if len(raw) < size:
+            # Truncated file: a cut-off date would parse as a wrong one
+            continue
+        if kind == 2:
+            values[tag] = raw.split(b"\0", 1)[0].decode("ascii", "ignore")
+        elif kind == 3:
+            values[tag] = struct.unpack(endian + "H", raw[:2])[0]
+        elif kind == 4:
+            values[tag] = struct.unpack(endian + "I", raw[:4])[0]
+        else:
+            pairs = struct.unpack(endian + "%dI" % (2 * (len(raw) // 8)), raw[:len(raw) // 8 * 8])
+            values[tag] = [num / den if den else 0 for num, den in zip(pairs[::2], pairs[1::2])]
+    return values
+
+
+def _tiff_date(read):
+    """
+    Capture date of a TIFF/EXIF structure: DateTimeOriginal, else
+    DateTimeDigitized, else the GPS date and time.
+    """
+    header = read(0, 8)
+    endian = {b"II": "<", b"MM": ">"}.get(header[:2])
+    if len(header) < 8 or endian is None:
+        return None
+    magic, ifd0 = struct.unpack(endian + "HI", header[2:8])
+    if magic != 42:
+        return None
+    date_tags = {DATE_TIME_ORIGINAL, DATE_TIME_DIGITIZED}
+    values = _read_ifd(read, endian, ifd0, date_tags | {EXIF_IFD_POINTER, GPS_IFD_POINTER})
+    if EXIF_IFD_POINTER in values:
+        values.update(_read_ifd(read, endian, values[EXIF_IFD_POINTER], date_tags))
+    for tag in (DATE_TIME_ORIGINAL, DATE_TIME_DIGITIZED):
+        date = parse_exif_datetime(values[tag]) if tag in values else None
+        if date is not None:
+            return date
+    if GPS_IFD_POINTER in values:
+        gps = _read_ifd(read, endian, values[GPS_IFD_POINTER], {GPS_DATE_STAMP, GPS_TIME_STAMP})
+        return _gps_datetime(gps.get(GPS_DATE_STAMP), gps.get(GPS_TIME_STAMP))
+    return None
+
+
+def _exif_block_date(block):
+    if block.startswith(_EXIF_PREFIX):
+        block = block[len(_EXIF_PREFIX):]
+    return _tiff_date(lambda offset, size: block[offset:offset + size])
+
+
+def _xmp_date(xmp):
+    for pattern in _XMP_DATE_PATTERNS:
+        match = pattern.search(xmp)
+        if match:
+            date = _parse_iso_date((match.group(1) or match.group(2)).decode("utf-8", "ignore"))
+            if date is not None:
+                return date
+    return None
+
+
+def _jpeg_metadata(f):
+    """
+    Walks the JPEG markers up to the image data and returns the EXIF and
+    XMP APP1 payloads (None when absent), skipping every other segment.
+    """
+    exif = xmp = None
+    f.seek(2)
+    for _ in range(MAX_SEGMENTS):
+        marker = f.read(2)
+        if len(marker) < 2 or marker[0] != 0xFF:
+            break
+        code = marker[1]
+        while code == 0xFF:
+            code = f.read(1)[0]
+        if code in (0xD9, 0xDA):
+            # Metadata precedes the scan data
+            break
+        if code == 0x01 or 0xD0 <= code <= 0xD7:
+            continue
+        (length,) = struct.unpack(">H", f.read(2))
+        if code == 0xE1 and (exif is None or xmp is None):
+            payload = f.read(length - 2)
+            if len(payload) < length - 2:
+                break
+            if payload.startswith(_EXIF_PREFIX):
+                exif = payload
+            elif payload.startswith(_XMP_PREFIX):
+                xmp = payload
+        else:
+            f.seek(length - 2, io.SEEK_CUR)
+        if exif is not None and xmp is not None:
+            break
+    return exif, xmp
+
+
+def _png_metadata(f):
+    """
+    Reads the eXIf chunk, XMP and "Creation Time" text chunks of a PNG,
+    which precede the image data.
+    """
+    exif = xmp = created = None
+    f.seek(8)
+    for _ in range(MAX_SEGMENTS):
+        header = f.read(8)
+        if len(header) < 8:
+            break
+        length, kind = struct.unpack(">I4s", header)
+        if kind in (b"IDAT", b"IEND"):
+            break
+        if kind not in (b"eXIf", b"tEXt", b"iTXt", b"zTXt") or length > MAX_METADATA_BYTES:
+            f.seek(length + 4, io.SEEK_CUR)
+            continue
+        data = f.read(length)
+        if len(data) < length:
+            break
+        f.seek(4, io.SEEK_CUR)
+        if kind == b"eXIf":
+            exif = data
+            continue
+        keyword, _, text = data.partition(b"\0")
+        if kind == b"zTXt":
+            text = zlib.decompress(text[1:])
+        elif kind == b"iTXt":
+            compressed = text[:1] == b"\1"
+            text = text[2:].split(b"\0", 2)[-1]
+            if compressed:
+                text = zlib.decompress(text)
+        if keyword == b"XML:com.adobe.xmp":
+            xmp = text
+        elif keyword == b"Creation Time":
+            created = text.decode("latin-1").strip()
+    return exif, xmp, created
+
+
+def _webp_metadata(f):
+    """
+    Reads the EXIF and XMP chunks of a WebP (RIFF) file.
+    """
+    exif = xmp = None
+    f.seek(12)
+    for _ in range(MAX_SEGMENTS):
+        header = f.read(8)
+        if len(header) < 8:
+            break
+        kind, length = struct.unpack("<4sI", header)
+        if kind in (b"EXIF", b"XMP ") and length <= MAX_METADATA_BYTES:
+            data = f.read(length)
+            if len(data) < length:
+                break
+            if kind == b"EXIF":
+                exif = data
+            else:
+                xmp = data
+            f.seek(length & 1, io.SEEK_CUR)
+        else:
+            f.seek(length + (length & 1), io.SEEK_CUR)
+    return exif, xmp
+
+
+def _boxes(data):
+    """
+    Yields (type, payload) of the ISO BMFF boxes in data.
+    """
+    pos = 0
+    while pos + 8 <= len(data):
+        size, kind = struct.unpack(">I4s", data[pos:pos + 8])
+        header = 8
+        if size == 1:
+            (size,) = struct.unpack(">Q", data[pos + 8:pos + 16])
+            header = 16
+        elif size == 0:
+            size = len(data) - pos
+        if size < header:
+            return
+        yield kind, data[pos + header:pos + size]
+        pos += size
+
+
+def _uint(data, pos, size):
+    return int.from_bytes(data[pos:pos + size], "big") if size else 0, pos + size
+
+
+def _heif_exif(f):
+    """
+    Reads the Exif item of a HEIF/HEIC/AVIF file, located through the
+    item info (iinf) and item location (iloc) boxes of its meta box.
+    """
+    f.seek(0)
+    meta = None
+    for _ in range(MAX_SEGMENTS):
+        header = f.read(8)
+        if len(header) < 8:
+            return None
+        size, kind = struct.unpack(">I4s", header)
+        header_size = 8
+        if size == 1:
+            (size,) = struct.unpack(">Q", f.read(8))
+            header_size = 16
+        if kind == b"meta":
+            if size > MAX_METADATA_BYTES:
+                return None
+            meta = f.read(size - header_size)
+            if len(meta) < size - header_size:
+                return None
+            break
+        if size < header_size:
+            return None
+        f.seek(size - header_size, io.SEEK_CUR)
+    if meta is None:
+        return None
+
+    children = dict(_boxes(meta[4:]))
+    iinf, iloc = children.get(b"iinf"), children.get(b"iloc")
+    if not iinf or not iloc:
+        return None
+
+    # Item id of the Exif item
+    exif_id = None
+    entries_start = 6 if iinf[0] == 0 else 8
+    for kind, infe in _boxes(iinf[entries_start:]):
+        if kind != b"infe" or infe[0] < 2:
+            continue
+        id_size = 2 if infe[0] == 2 else 4
+        item_id, pos = _uint(infe, 4, id_size)
+        if infe[pos + 2:pos + 6] == b"Exif":
+            exif_id = item_id
+            break
+    if exif_id is None:
+        return None
+
+    # Its extents
+    version = iloc[0]
+    offset_size, length_size = iloc[4] >> 4, iloc[4] & 15
+    base_offset_size, index_size = iloc[5] >> 4, (iloc[5] & 15) if version in (1, 2) else 0
+    count, pos = _uint(iloc, 6, 2 if version < 2 else 4)
+    for _ in range(count):
+        item_id, pos = _uint(iloc, pos, 2 if version < 2 else 4)
+        method = 0
+        if version in (1, 2):
+            method, pos = _uint(iloc, pos, 2)
+            method &= 15
+        pos += 2
+        base_offset, pos = _uint(iloc, pos, base_offset_size)
+        extent_count, pos = _uint(iloc, pos, 2)
+        extents = []
+        for _ in range(extent_count):
+            pos += index_size
+            extent_offset, pos = _uint(iloc, pos, offset_size)
+            extent_length, pos = _uint(iloc, pos, length_size)
+            extents.append((base_offset + extent_offset, extent_length))
+        if item_id != exif_id:
+            continue
+        if sum(length for _, length in extents) > MAX_METADATA_BYTES:
+            return None
+        if method == 1:
+            idat = children.get(b"idat", b"")
+            data = b"".join(idat[start:start + length] for start, length in extents)
+        elif method == 0:
+            chunks = []
+            for start, length in extents:
+                f.seek(start)
+                chunks.append(f.read(length))
+            data = b"".join(chunks)
+            if len(data) < sum(length for _, length in extents):
+                return None
+        else:
+            return None
+        # The item starts with the offset of the TIFF header past this field
+        tiff_offset, _ = _uint(data, 0, 4)
+        return data[4 + tiff_offset:]
+    return None
+
+
+def capture_date_from(f):
+    """
+    Capture date from the metadata of an open image file, reading only the
+    metadata segments: JPEG APP1, TIFF IFDs, HEIF item data, PNG chunks
+    before the image data, WebP chunks. Tries the EXIF DateTimeOriginal,
+    DateTimeDigitized and GPS date, then XMP and PNG creation dates.
+    Returns None when the file carries no date.
+    """
+    head = f.read(16)
+    exif = xmp = created = None
+    if head[:2] == b"\xff\xd8":
+        exif, xmp = _jpeg_metadata(f)
+    elif head[:4] in (b"II*\0", b"MM\0*"):
+        def read(offset, size):
+            f.seek(offset)
+            return f.read(size)
+        date = _tiff_date(read)
+        if date is not None:
+            return date
+    elif head[:8] == b"\x89PNG\r\n\x1a\n":
+        exif, xmp, created = _png_metadata(f)
+    elif head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        exif, xmp = _webp_metadata(f)
+    elif head[4:8] == b"ftyp":
+        exif = _heif_exif(f)
+
+    date = _exif_block_date(exif) if exif else None
+    if date is None and xmp:
+        date = _xmp_date(xmp)
+    if date is None and created:
+        try:
+            date = parsedate_to_datetime(created).replace(tzinfo=None)
+        except (TypeError, ValueError, IndexError):
+            date = _parse_iso_date(created)
+    return date
+
+
+def read_capture_date(source):
+    """
+    Capture date of an image, given its path or its bytes already in
+    memory. Malformed metadata counts as no date; errors opening the file
+    are raised.
+    """
+    if isinstance(source, (str, os.PathLike)):
+        with open(source, "rb") as f:
+            return _safe_capture_date(f)
+    return _safe_capture_date(_BufferFile(source))
+
+
+def _safe_capture_date(f):
+    try:
+        return capture_date_from(f)
+    except (ValueError, IndexError, TypeError, OverflowError, struct.error, zlib.error):
+        return None
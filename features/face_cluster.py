@@ -1,53 +1,230 @@
 import os
+import logging
 import cv2
-import shutil
+import base64
+import hashlib
 import numpy as np
-from PIL import Image
-
-def cluster_by_face(image_paths, output_dir, face_sample_path=None):
-    """
-    Cluster images by face detection using OpenCV.
-    If face_sample_path is provided, only keep images with detected faces.
-    Otherwise, group all images with detected faces together.
-    """
-    print(f"Processing {len(image_paths)} images for face detection")
-    
-    # Load the pre-trained face detection classifier
-    face_cascade = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_frontalface_default.xml')
-    
-    # Create output directory for images with faces
-    faces_dir = os.path.join(output_dir, "images_with_faces")
-    os.makedirs(faces_dir, exist_ok=True)
-    
-    result_paths = []
-    for img_path in image_paths:
-        try:
-            # Read image using OpenCV
-            img = cv2.imread(img_path)
-            if img is None:
-                print(f"Could not read image: {img_path}")
-                continue
-                
-            # Convert to grayscale for face detection
-            gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-            
-            # Detect faces in the image
-            faces = face_cascade.detectMultiScale(
-                gray,
-                scaleFactor=1.1,
-                minNeighbors=5,
-                minSize=(30, 30)
-            )
-            
-            # If faces are found, copy the image to the output directory
-            if len(faces) > 0:
-                filename = os.path.basename(img_path)
-                new_path = os.path.join(faces_dir, filename)
-                shutil.copy2(img_path, new_path)
-                result_paths.append(new_path)
-                
-        except Exception as e:
-            print(f"Error processing {os.path.basename(img_path)}: {e}")
-    
-    print(f"Face detection complete. Found faces in {len(result_paths)} images.")
-    return result_paths
\ No newline at end of file
+
+from features.face_detection import detect_image_faces, face_detection_width
+from features.face_index import FaceIndex, normalize
+from pipeline import settings
+from pipeline.models import get_model
+
+logger = logging.getLogger(__name__)
+
+# SFace takes 112x112 face crops and returns 128-value embeddings
+FACE_EMBEDDING_INPUT = 112
+FACE_EMBEDDING_SIZE = 128
+
+# Context added around a detected box on every side, relative to its size,
+# so the crop covers the whole face like SFace's aligned training crops.
+# Faces with landmarks are aligned by SFace itself instead.
+FACE_CROP_MARGIN = 0.1
+
+# Cosine similarity from which two SFace embeddings are taken to show the
+# same person (OpenCV's reference threshold for this model)
+FACE_MATCH_THRESHOLD = 0.363
+
+# Faces similar to fewer faces than this (themselves included) are not
+# clustered, so people seen only once do not get a folder of their own
+FACE_CLUSTER_MIN_SAMPLES = 2
+
+def face_embedder_available():
+    """
+    Whether the SFace model file is present, enabling identity clustering.
+    """
+    return bool(settings.FACE_EMBEDDING_MODEL) and os.path.isfile(settings.FACE_EMBEDDING_MODEL)
+
+def face_embedding_version():
+    """
+    Identifies the embeddings analyze_face_embeddings stores, for caching them.
+    """
+    model = os.path.basename(settings.FACE_EMBEDDING_MODEL)
+    return f"sface:{model}:{FACE_EMBEDDING_INPUT}:{FACE_CROP_MARGIN}:f16"
+
+def face_selection_version(sample_path=None):
+    """
+    Identifies the decision select_with_faces makes: matching a given
+    sample (by content) or clustering, with its thresholds.
+    """
+    if sample_path and os.path.exists(sample_path):
+        with open(sample_path, "rb") as f:
+            digest = hashlib.blake2b(f.read(), digest_size=16).hexdigest()
+        return f"match:{digest}:{FACE_MATCH_THRESHOLD}"
+    return f"cluster:{FACE_MATCH_THRESHOLD}:{FACE_CLUSTER_MIN_SAMPLES}"
+
+def load_face_embedder():
+    """
+    Load the SFace face recognition model.
+    """
+    if not face_embedder_available():
+        raise FileNotFoundError(f"Face embedding model not found: {settings.FACE_EMBEDDING_MODEL}")
+    return cv2.FaceRecognizerSF.create(settings.FACE_EMBEDDING_MODEL, "")
+
+def face_crop(bgr, box, size=FACE_EMBEDDING_INPUT):
+    """
+    Square crop around a face box with FACE_CROP_MARGIN of context,
+    resized to the embedding model's input. Edges are replicated where the
+    crop leaves the image.
+    """
+    x, y, w, h = box
+    side = int(round(max(w, h) * (1 + 2 * FACE_CROP_MARGIN)))
+    x0 = int(round(x + w / 2 - side / 2))
+    y0 = int(round(y + h / 2 - side / 2))
+    height, width = bgr.shape[:2]
+    crop = bgr[max(0, y0):min(height, y0 + side), max(0, x0):min(width, x0 + side)]
+    top, left = max(0, -y0), max(0, -x0)
+    bottom, right = max(0, y0 + side - height), max(0, x0 + side - width)
+    if top or left or bottom or right:
+        crop = cv2.copyMakeBorder(crop, top, bottom, left, right, cv2.BORDER_REPLICATE)
+    return cv2.resize(crop, (size, size), interpolation=cv2.INTER_AREA)
+
+def embed_faces(bgr, faces, embedder, landmarks=None):
+    """
+    Normalized embedding of every (x, y, w, h) face box in a BGR image,
+    as a (faces, FACE_EMBEDDING_SIZE) float32 matrix. With landmarks (ten
+    coordinates per face), crops are aligned on them.
+    """
+    if not len(faces):
+        return np.zeros((0, FACE_EMBEDDING_SIZE), dtype=np.float32)
+    if landmarks is None:
+        crops = [face_crop(bgr, face) for face in faces]
+    else:
+        crops = [
+            embedder.alignCrop(bgr, np.array([*face, *points, 1.0], dtype=np.float32))
+            for face, points in zip(faces, landmarks)
+        ]
+    return normalize(np.vstack([embedder.feature(crop) for crop in crops]))
+
+def encode_embeddings(embeddings):
+    """
+    Compact, JSON-friendly form of an embedding matrix: one base64 string
+    of float16 values per face.
+    """
+    return [base64.b64encode(row.astype("<f2").tobytes()).decode("ascii") for row in embeddings]
+
+def decode_embeddings(encoded):
+    """
+    Inverse of encode_embeddings, as a float32 matrix.
+    """
+    if not encoded:
+        return np.zeros((0, FACE_EMBEDDING_SIZE), dtype=np.float32)
+    data = b"".join(base64.b64decode(row) for row in encoded)
+    return np.frombuffer(data, dtype="<f2").reshape(len(encoded), -1).astype(np.float32)
+
+def analyze_face_embeddings(frame, embedder):
+    """
+    Pipeline analysis step: embeds every face found by the shared face
+    detection, on the same reduced-resolution decode it ran on.
+    """
+    bgr, scale = frame.proxy(face_detection_width())
+    faces = [tuple(v / scale for v in face) for face in frame.summary["faces"]]
+    landmarks = frame.summary.get("face_landmarks")
+    if landmarks is not None:
+        landmarks = [[v / scale for v in points] for points in landmarks]
+    frame.summary["face_embeddings"] = encode_embeddings(embed_faces(bgr, faces, embedder, landmarks))
+
+def embed_sample(sample_path, detector, embedder):
+    """
+    Embedding of the largest face in a sample image, or None if the image
+    cannot be read or shows no face.
+    """
+    img = cv2.imread(sample_path)
+    if img is None:
+        return None
+    faces, landmarks = detect_image_faces(img, detector)
+    if not faces:
+        return None
+    largest = max(range(len(faces)), key=lambda i: faces[i][2] * faces[i][3])
+    points = None if landmarks is None else [landmarks[largest]]
+    return embed_faces(img, [faces[largest]], embedder, points)[0]
+
+def match_sample(embedding_lists, sample_embedding, threshold=FACE_MATCH_THRESHOLD):
+    """
+    For every image (given as a matrix of its face embeddings), the best
+    similarity of one of its faces to the sample, or None if no face is at
+    least threshold similar.
+    """
+    index = _image_index(embedding_lists)
+    best = [None] * len(embedding_lists)
+    scores, images = index.within(sample_embedding, threshold)
+    for score, image in zip(scores, images):
+        if best[image] is None:
+            best[image] = float(score)
+    return best
+
+def cluster_identities(face_lists, embedding_lists, threshold=FACE_MATCH_THRESHOLD,
+                       min_samples=FACE_CLUSTER_MIN_SAMPLES):
+    """
+    Clusters all faces of a set of images by identity and returns, per
+    image, the cluster of its largest clustered face, or None if none of
+    its faces was clustered. Clusters are numbered from 0 in order of
+    first appearance.
+    """
+    index = _image_index(embedding_lists)
+    labels = index.cluster(threshold, min_samples)
+    sizes = np.array([w * h for faces in face_lists for (_, _, w, h) in faces], dtype=np.int64)
+
+    result = [None] * len(embedding_lists)
+    largest = [0] * len(embedding_lists)
+    for label, size, image in zip(labels, sizes, index.ids):
+        if label >= 0 and size > largest[image]:
+            result[image], largest[image] = int(label), size
+    return result
+
+def _image_index(embedding_lists):
+    # One index over the faces of all images, mapping each face to its image
+    vectors = [embeddings for embeddings in embedding_lists if len(embeddings)]
+    matrix = np.vstack(vectors) if vectors else np.zeros((0, FACE_EMBEDDING_SIZE), dtype=np.float32)
+    ids = np.repeat(np.arange(len(embedding_lists)), [len(e) for e in embedding_lists])
+    return FaceIndex(matrix, ids)
+
+def face_folder(label):
+    """
+    Output folder of images with faces: one folder per clustered person.
+    """
+    if label is None:
+        return "images_with_faces"
+    return f"images_with_faces/person_{label + 1:03d}"
+
+def frame_face_folder(frame):
+    return face_folder(frame.summary.get("face_cluster"))
+
+def has_faces(frame):
+    """
+    Pipeline predicate: keeps a frame in which at least one face was found.
+    """
+    return bool(frame.summary.get("faces"))
+
+def select_with_faces(frames, sample_path=None):
+    """
+    Pipeline selection step: keeps frames in which at least one face was found.
+
+    When face embeddings were computed, a face sample keeps only the frames
+    showing the sample's person (recording the similarity as face_match);
+    without a sample, every face is clustered by identity and each frame
+    records the cluster of its main face as face_cluster.
+    """
+    with_faces = [f for f in frames if f.summary.get("faces")]
+    if not all("face_embeddings" in f.summary for f in with_faces):
+        return with_faces
+    embeddings = [decode_embeddings(f.summary["face_embeddings"]) for f in with_faces]
+
+    sample = None
+    if sample_path and os.path.exists(sample_path):
+        sample = embed_sample(sample_path, get_model("face_detector"), get_model("face_embedder"))
+        if sample is None:
+            logger.warning("No face found in the face sample, clustering all faces instead")
+
+    if sample is not None:
+        kept = []
+        for frame, score in zip(with_faces, match_sample(embeddings, sample)):
+            if score is not None:
+                frame.summary["face_match"] = round(score, 4)
+                kept.append(frame)
+        return kept
+
+    labels = cluster_identities([f.summary["faces"] for f in with_faces], embeddings)
+    for frame, label in zip(with_faces, labels):
+        frame.summary["face_cluster"] = label
+    return with_faces
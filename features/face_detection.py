@@ -0,0 +1,172 @@
+import os
+import cv2
+
+from pipeline import settings
+
+FACE_CASCADE_PATH = cv2.data.haarcascades + 'haarcascade_frontalface_default.xml'
+
+# Smallest face reported, in full-resolution pixels
+FACE_MIN_SIZE = 30
+
+# Haar cascade parameters, shared by every feature that looks for faces.
+# Coarser scale steps suffice when only large faces matter.
+HAAR_SCALE_FACTOR = 1.1
+HAAR_LARGE_FACE_SCALE_FACTOR = 1.3
+HAAR_MIN_NEIGHBORS = 5
+
+# YuNet keeps detections above this confidence, after non-maximum suppression
+YUNET_SCORE_THRESHOLD = 0.9
+YUNET_NMS_THRESHOLD = 0.3
+YUNET_TOP_K = 5000
+
+# Minimum width of the reduced-resolution image faces are detected on.
+# The cascade misses small faces on coarse images; YuNet finds faces down
+# to about 10 pixels, so it runs on a smaller proxy.
+DETECTION_WIDTHS = {"haar": 1600, "yunet": 800}
+
+# Enough when only large faces matter: a good-angle face covers over 5% of
+# the image
+LARGE_FACE_DETECTION_WIDTH = 640
+
+
+def load_face_cascade():
+    """
+    Load the pre-trained frontal face Haar cascade.
+    """
+    return cv2.CascadeClassifier(FACE_CASCADE_PATH)
+
+
+class HaarFaceDetector:
+    """
+    Frontal face Haar cascade. Works on grayscale images and finds no landmarks.
+    """
+
+    name = "haar"
+    grayscale = True
+
+    def __init__(self, cascade):
+        self.cascade = cascade
+
+    def detect(self, image, min_size=FACE_MIN_SIZE, small_faces=True):
+        faces = self.cascade.detectMultiScale(
+            image,
+            scaleFactor=HAAR_SCALE_FACTOR if small_faces else HAAR_LARGE_FACE_SCALE_FACTOR,
+            minNeighbors=HAAR_MIN_NEIGHBORS,
+            minSize=(min_size, min_size)
+        )
+        return [tuple(int(v) for v in face) for face in faces], None
+
+
+class YuNetFaceDetector:
+    """
+    OpenCV's YuNet CNN face detector. Works on BGR images and also returns
+    five landmarks per face (eyes, nose tip, mouth corners), which face
+    embeddings use to align crops.
+    """
+
+    name = "yunet"
+    grayscale = False
+
+    def __init__(self, model):
+        self.model = model
+
+    def detect(self, image, min_size=FACE_MIN_SIZE, small_faces=True):
+        height, width = image.shape[:2]
+        self.model.setInputSize((width, height))
+        _, faces = self.model.detect(image)
+        if faces is None:
+            return [], []
+        boxes, landmarks = [], []
+        for face in faces:
+            box = tuple(int(round(v)) for v in face[:4])
+            if min(box[2], box[3]) < min_size:
+                continue
+            boxes.append(box)
+            landmarks.append([float(v) for v in face[4:14]])
+        return boxes, landmarks
+
+
+def face_detector_backend():
+    """
+    The detector in use: FACE_DETECTOR, falling back to the Haar cascade
+    when the YuNet model file is missing.
+    """
+    if settings.FACE_DETECTOR == "yunet" and os.path.isfile(settings.FACE_DETECTOR_MODEL):
+        return "yunet"
+    return "haar"
+
+
+def face_detection_width(small_faces=True):
+    """
+    Proxy width faces are detected on; a smaller one when small faces are
+    not needed.
+    """
+    width = DETECTION_WIDTHS[face_detector_backend()]
+    return width if small_faces else min(width, LARGE_FACE_DETECTION_WIDTH)
+
+
+def face_detection_version(small_faces=True):
+    """
+    Identifies the detections analyze_face_detections stores, for caching them.
+    """
+    backend = face_detector_backend()
+    if backend == "yunet":
+        params = (f"{os.path.basename(settings.FACE_DETECTOR_MODEL)}:"
+                  f"{YUNET_SCORE_THRESHOLD}:{YUNET_NMS_THRESHOLD}")
+    else:
+        scale_factor = HAAR_SCALE_FACTOR if small_faces else HAAR_LARGE_FACE_SCALE_FACTOR
+        params = f"frontal:{scale_factor}:{HAAR_MIN_NEIGHBORS}"
+    return f"faces:{backend}:{params}:{FACE_MIN_SIZE}:proxy{face_detection_width(small_faces)}:v3"
+
+
+def load_face_detector():
+    """
+    Load the configured face detector.
+    """
+    if face_detector_backend() == "yunet":
+        model = cv2.FaceDetectorYN.create(
+            settings.FACE_DETECTOR_MODEL, "", (320, 320),
+            YUNET_SCORE_THRESHOLD, YUNET_NMS_THRESHOLD, YUNET_TOP_K
+        )
+        return YuNetFaceDetector(model)
+    cascade = load_face_cascade()
+    if cascade.empty():
+        raise RuntimeError("Could not load the face cascade")
+    return HaarFaceDetector(cascade)
+
+
+def detect_image_faces(bgr, detector, min_size=FACE_MIN_SIZE, small_faces=True):
+    """
+    Detect faces in a full BGR image. Returns (boxes, landmarks): (x, y, w, h)
+    boxes, and per face ten landmark coordinates or None if the detector
+    finds no landmarks.
+    """
+    image = cv2.cvtColor(bgr, cv2.COLOR_BGR2GRAY) if detector.grayscale else bgr
+    return detector.detect(image, min_size, small_faces)
+
+
+def scale_boxes(faces, scale):
+    """
+    Map (x, y, w, h) boxes found on a proxy back to full-resolution coordinates.
+    """
+    return [tuple(int(round(v * scale)) for v in face) for face in faces]
+
+
+def analyze_face_detections(frame, detector, small_faces=True):
+    """
+    Pipeline analysis step shared by every face feature: detects faces once
+    on a reduced-resolution decode and stores the boxes (and landmarks, if
+    the detector finds them) in full-resolution coordinates, with the
+    image's full-resolution size. small_faces=False searches a coarser
+    decode at coarser scales, for features that only look at large faces.
+    """
+    image, scale = frame.proxy(face_detection_width(small_faces), grayscale=detector.grayscale)
+    # Keep the minimum face size relative to the full-resolution image
+    min_size = max(1, int(round(FACE_MIN_SIZE / scale)))
+    boxes, landmarks = detector.detect(image, min_size, small_faces)
+    frame.summary["faces"] = scale_boxes(boxes, scale)
+    frame.summary["face_landmarks"] = None if landmarks is None else [
+        [round(v * scale, 1) for v in points] for points in landmarks
+    ]
+    height, width = image.shape[:2]
+    frame.summary["face_image_size"] = [int(round(width * scale)), int(round(height * scale))]
@@ -0,0 +1,225 @@
+import numpy as np
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+# From this many faces on, searches and clustering go through an IVF
+# (inverted file) partition and only compare faces in nearby partitions,
+# instead of comparing every pair
+IVF_MIN_SIZE = 10000
+
+# Partitions searched per query: the ones with the nearest centroids
+IVF_PROBES = 8
+
+# k-means iterations and sample size used to train the partition
+IVF_TRAIN_ITERATIONS = 10
+IVF_TRAIN_SAMPLE = 20000
+
+# Rows compared per step, bounding the similarity block to BLOCK_ROWS x n
+BLOCK_ROWS = 1024
+
+
+def normalize(vectors):
+    """
+    L2-normalizes the rows of a float32 matrix, so dot products are cosine
+    similarities. All-zero rows stay zero.
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, np.float32(1e-12))
+
+
+def _top_k(scores, k):
+    # Indices of the k largest scores per row, best first
+    k = min(k, scores.shape[1])
+    if k < scores.shape[1]:
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    else:
+        top = np.broadcast_to(np.arange(scores.shape[1]), scores.shape).copy()
+    order = np.argsort(-np.take_along_axis(scores, top, axis=1), axis=1, kind="stable")
+    return np.take_along_axis(top, order, axis=1)
+
+
+class FaceIndex:
+    """
+    In-memory cosine similarity index over face embeddings.
+
+    Embeddings are kept as one normalized float32 matrix, so a search is a
+    matrix product and clustering compares faces a block of rows at a time.
+    ids maps each row back to its owner, e.g. the image a face was found
+    in. Large indexes (ivf=None and at least IVF_MIN_SIZE faces, or
+    ivf=True) are partitioned by spherical k-means; a query then only
+    scans the IVF_PROBES partitions with the nearest centroids, which is
+    approximate but keeps tens of thousands of faces well under a second.
+    """
+
+    def __init__(self, vectors, ids=None, ivf=None):
+        self.vectors = normalize(np.asarray(vectors, dtype=np.float32).reshape(len(vectors), -1))
+        self.ids = np.arange(len(self.vectors)) if ids is None else np.asarray(ids)
+        self.centroids = None
+        self.lists = None
+        if ivf is None:
+            ivf = len(self.vectors) >= IVF_MIN_SIZE
+        if ivf and len(self.vectors):
+            self._train()
+
+    def __len__(self):
+        return len(self.vectors)
+
+    def _assign(self, vectors, centroids):
+        assignment = np.empty(len(vectors), dtype=np.int64)
+        for start in range(0, len(vectors), BLOCK_ROWS):
+            block = vectors[start:start + BLOCK_ROWS]
+            assignment[start:start + len(block)] = (block @ centroids.T).argmax(axis=1)
+        return assignment
+
+    def _train(self):
+        n = len(self.vectors)
+        # Deterministic, so the same faces always give the same partition
+        rng = np.random.default_rng(0)
+        sample = self.vectors
+        if n > IVF_TRAIN_SAMPLE:
+            sample = self.vectors[np.sort(rng.choice(n, IVF_TRAIN_SAMPLE, replace=False))]
+        count = max(1, min(len(sample), int(round(np.sqrt(n)))))
+        centroids = sample[rng.choice(len(sample), count, replace=False)]
+
+        for _ in range(IVF_TRAIN_ITERATIONS):
+            assignment = self._assign(sample, centroids)
+            order = np.argsort(assignment, kind="stable")
+            used, starts = np.unique(assignment[order], return_index=True)
+            # Partitions that lost every member keep their old centroid
+            centroids[used] = normalize(np.add.reduceat(sample[order], starts, axis=0))
+
+        assignment = self._assign(self.vectors, centroids)
+        order = np.argsort(assignment, kind="stable")
+        bounds = np.searchsorted(assignment[order], np.arange(count + 1))
+        self.centroids = centroids
+        self.lists = [order[bounds[i]:bounds[i + 1]] for i in range(count)]
+
+    def _candidates(self, centroid_scores):
+        # Rows of the partitions with the highest centroid scores
+        probes = _top_k(centroid_scores[None, :], IVF_PROBES)[0]
+        return np.concatenate([self.lists[p] for p in probes])
+
+    def search(self, queries, k=10):
+        """
+        The k most similar faces of every query embedding, best first.
+        Returns (scores, ids), both of shape (queries, k); missing results
+        have score -inf and id -1.
+        """
+        queries = normalize(np.atleast_2d(np.asarray(queries, dtype=np.float32)))
+        scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        ids = np.full((len(queries), k), -1, dtype=self.ids.dtype if len(self.ids) else np.int64)
+        if not len(self.vectors):
+            return scores, ids
+
+        if self.centroids is None:
+            for start in range(0, len(queries), BLOCK_ROWS):
+                block = queries[start:start + BLOCK_ROWS] @ self.vectors.T
+                top = _top_k(block, k)
+                stop = start + len(block)
+                scores[start:stop, :top.shape[1]] = np.take_along_axis(block, top, axis=1)
+                ids[start:stop, :top.shape[1]] = self.ids[top]
+            return scores, ids
+
+        centroid_scores = queries @ self.centroids.T
+        for i, query in enumerate(queries):
+            rows = self._candidates(centroid_scores[i])
+            row_scores = self.vectors[rows] @ query
+            top = _top_k(row_scores[None, :], k)[0]
+            scores[i, :len(top)] = row_scores[top]
+            ids[i, :len(top)] = self.ids[rows[top]]
+        return scores, ids
+
+    def within(self, query, threshold):
+        """
+        Every face at least threshold similar to one query embedding.
+        Returns (scores, ids), most similar first.
+        """
+        query = normalize(np.asarray(query, dtype=np.float32).ravel())
+        if not len(self.vectors):
+            return np.empty(0, dtype=np.float32), self.ids[:0]
+        if self.centroids is None:
+            rows = np.arange(len(self.vectors))
+        else:
+            rows = self._candidates(self.centroids @ query)
+        row_scores = self.vectors[rows] @ query
+        hits = np.flatnonzero(row_scores >= threshold)
+        hits = hits[np.argsort(-row_scores[hits], kind="stable")]
+        return row_scores[hits], self.ids[rows[hits]]
+
+    def _blocks(self):
+        """
+        Yields (rows, cols): groups of rows with the rows they are compared
+        against; every row appears in exactly one group.
+        """
+        n = len(self.vectors)
+        if self.centroids is None:
+            everything = np.arange(n)
+            for start in range(0, n, BLOCK_ROWS):
+                yield everything[start:start + BLOCK_ROWS], everything
+            return
+        neighbors = self.centroids @ self.centroids.T
+        for partition, members in enumerate(self.lists):
+            if not len(members):
+                continue
+            cols = self._candidates(neighbors[partition])
+            for start in range(0, len(members), BLOCK_ROWS):
+                yield members[start:start + BLOCK_ROWS], cols
+
+    def _pairs(self, threshold):
+        # (row, col) index pairs at least threshold similar, self pairs included
+        for rows, cols in self._blocks():
+            hits = (self.vectors[rows] @ self.vectors[cols].T) >= threshold
+            r, c = np.nonzero(hits)
+            yield rows[r], cols[c]
+
+    def cluster(self, threshold, min_samples=1):
+        """
+        Groups faces by identity, DBSCAN-style on cosine similarity: faces
+        with at least min_samples faces (themselves included) at least
+        threshold similar are core faces, core faces that are similar are
+        in the same cluster, and other faces join the cluster of a similar
+        core face or are noise. Returns one label per row, numbered from 0
+        in order of first appearance, with -1 for noise.
+        """
+        n = len(self.vectors)
+        if not n:
+            return np.empty(0, dtype=np.int64)
+
+        if min_samples > 1:
+            counts = np.zeros(n, dtype=np.int64)
+            for rows, cols in self._blocks():
+                hits = (self.vectors[rows] @ self.vectors[cols].T) >= threshold
+                counts[rows] = hits.sum(axis=1)
+            core = counts >= min_samples
+        else:
+            core = np.ones(n, dtype=bool)
+
+        # Components are merged block by block: each block's links are
+        # reduced to links between current components first
+        component = np.arange(n)
+        border = np.full(n, -1, dtype=np.int64)
+        for r, c in self._pairs(threshold):
+            linked = core[r] & core[c]
+            attach = ~core[r] & core[c]
+            border[r[attach]] = c[attach]
+            a, b = component[r[linked]], component[c[linked]]
+            different = a != b
+            if not different.any():
+                continue
+            links = np.unique(np.stack([a[different], b[different]], axis=1), axis=0)
+            graph = coo_matrix((np.ones(len(links), dtype=np.int8), (links[:, 0], links[:, 1])), shape=(n, n))
+            _, merged = connected_components(graph, directed=False)
+            component = merged[component]
+
+        labels = np.where(core, component, -1)
+        has_core = border >= 0
+        labels[~core & has_core] = component[border[~core & has_core]]
+
+        # Renumber clusters by the first face that belongs to them
+        clustered = np.flatnonzero(labels >= 0)
+        values, first = np.unique(labels[clustered], return_index=True)
+        numbering = np.empty(len(values), dtype=np.int64)
+        numbering[np.argsort(first, kind="stable")] = np.arange(len(values))
+        labels[clustered] = numbering[np.searchsorted(values, labels[clustered])]
+        return labels
@@ -0,0 +1,87 @@
+from collections import defaultdict
+
+import numpy as np
+import pywt
+import scipy.fftpack
+from PIL import Image
+
+# Hashes hash_gray_batch can compute, each 64 bits as imagehash's defaults
+HASH_KINDS = ("ahash", "dhash", "phash", "whash")
+HASH_SIZE = 8
+
+# Side of the image phash transforms (imagehash's highfreq_factor of 4)
+PHASH_IMAGE_SIZE = HASH_SIZE * 4
+
+# imagehash resizes with Lanczos (its ANTIALIAS); any other filter changes bits
+_RESAMPLE = Image.Resampling.LANCZOS
+
+
+def pack_bits(bits):
+    """
+    Packs an (n, 8, 8) boolean array into n uint64 values, first bit most
+    significant, as in imagehash's hex representation.
+    """
+    packed = np.packbits(bits.reshape(len(bits), -1), axis=1)
+    return packed.view(">u8").ravel().astype(np.uint64)
+
+
+def _resized(images, size):
+    return np.stack([np.asarray(image.resize(size, _RESAMPLE)) for image in images])
+
+
+def _median_bits(values):
+    # Every image is compared with its own median
+    return values > np.median(values.reshape(len(values), -1), axis=1)[:, None, None]
+
+
+def _whash(images):
+    # Like phash, whash works on a square whose side depends on the image
+    # (the largest power of two not above its shorter side): batch by side
+    hashes = np.zeros(len(images), dtype=np.uint64)
+    by_side = defaultdict(list)
+    for index, image in enumerate(images):
+        by_side[max(2 ** int(np.log2(min(image.size))), HASH_SIZE)].append(index)
+    for side, indices in by_side.items():
+        pixels = _resized([images[i] for i in indices], (side, side)) / 255.
+        levels = int(np.log2(side))
+        # Drops the coarsest Haar approximation (the mean), as imagehash does
+        coeffs = pywt.wavedec2(pixels, "haar", level=levels, axes=(1, 2))
+        coeffs[0] *= 0
+        pixels = pywt.waverec2(coeffs, "haar", axes=(1, 2))
+        low = pywt.wavedec2(pixels, "haar", level=levels - int(np.log2(HASH_SIZE)), axes=(1, 2))[0]
+        hashes[indices] = pack_bits(_median_bits(low))
+    return hashes
+
+
+def hash_gray_batch(grays, kinds=("dhash", "phash")):
+    """
+    Computes the given hash kinds of a batch of grayscale images (2-D uint8
+    arrays or "L" PIL images), returned as {kind: uint64 array}, one value
+    per image. The bits are those imagehash.dhash, phash, average_hash and
+    whash give for the same images, packed as pack_bits does.
+
+    Each image is resized once per hash kind; everything after works on the
+    stacked batch, with a single DCT over all phash inputs.
+    """
+    unknown = set(kinds) - set(HASH_KINDS)
+    if unknown:
+        raise ValueError(f"Unknown hash kinds: {', '.join(sorted(unknown))}")
+    images = [gray if isinstance(gray, Image.Image) else Image.fromarray(gray) for gray in grays]
+    if not images:
+        return {kind: np.zeros(0, dtype=np.uint64) for kind in kinds}
+
+    hashes = {}
+    if "ahash" in kinds:
+        pixels = _resized(images, (HASH_SIZE, HASH_SIZE))
+        hashes["ahash"] = pack_bits(pixels > pixels.mean(axis=(1, 2))[:, None, None])
+    if "dhash" in kinds:
+        pixels = _resized(images, (HASH_SIZE + 1, HASH_SIZE))
+        hashes["dhash"] = pack_bits(pixels[:, :, 1:] > pixels[:, :, :-1])
+    if "phash" in kinds:
+        pixels = _resized(images, (PHASH_IMAGE_SIZE, PHASH_IMAGE_SIZE))
+        # scipy.fftpack's DCT, as imagehash uses, so coefficients match exactly
+        dct = scipy.fftpack.dct(scipy.fftpack.dct(pixels, axis=1), axis=2)
+        hashes["phash"] = pack_bits(_median_bits(dct[:, :HASH_SIZE, :HASH_SIZE]))
+    if "whash" in kinds:
+        hashes["whash"] = _whash(images)
+    return {kind: hashes[kind] for kind in kinds}
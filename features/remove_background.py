@@ -1,42 +1,141 @@
 import os
+import logging
 import numpy as np
-from PIL import Image
+from PIL import Image, ImageOps
 from rembg import remove
 
-def remove_background(image_paths, output_dir):
+from pipeline import settings
+from pipeline.models import get_model, get_onnx_session
+from pipeline.output import CUTOUT_FORMATS
+
+logger = logging.getLogger(__name__)
+
+# Input size, mean and std of the rembg models that can be run in batches,
+# matching each model's rembg session. Other models go through rembg.remove
+# one image at a time.
+IMAGENET_MEAN = (0.485, 0.456, 0.406)
+MODEL_INPUTS = {
+    "u2net": ((320, 320), IMAGENET_MEAN, (0.229, 0.224, 0.225)),
+    "u2netp": ((320, 320), IMAGENET_MEAN, (0.229, 0.224, 0.225)),
+    "u2net_human_seg": ((320, 320), IMAGENET_MEAN, (0.229, 0.224, 0.225)),
+    "silueta": ((320, 320), IMAGENET_MEAN, (0.229, 0.224, 0.225)),
+    "isnet-general-use": ((1024, 1024), IMAGENET_MEAN, (1.0, 1.0, 1.0)),
+    "isnet-anime": ((1024, 1024), IMAGENET_MEAN, (1.0, 1.0, 1.0)),
+}
+
+# Quality of WebP output; the alpha channel is always kept
+WEBP_QUALITY = 90
+
+# (model, batch size) pairs already reported as capped by the model
+_capped_batch_sizes = set()
+
+def nobg_filename(filename, output_format="png"):
+    """
+    Output name for a background-removed image, in a format that preserves transparency.
+    """
+    base_name, ext = os.path.splitext(filename)
+    return f"{base_name}_nobg{CUTOUT_FORMATS[output_format]}"
+
+def save_cutout(cutout, dst_path, output_format="png"):
+    """
+    Save an RGBA cutout as PNG or WebP with alpha.
+    """
+    if output_format == "webp":
+        cutout.save(dst_path, "WEBP", quality=WEBP_QUALITY)
+    else:
+        cutout.save(dst_path, "PNG")
+
+def write_without_background(src_path, dst_path, output_format="png"):
+    """
+    Removes the background of one image with rembg and saves it to dst_path.
+    """
+    with Image.open(src_path) as img:
+        output = remove(img, session=get_model("rembg"))
+        save_cutout(output, dst_path, output_format)
+
+def model_input(img, size, mean, std):
     """
-    Remove background from images using rembg library.
+    Resize and normalize an image the way rembg's sessions do, as a CHW
+    float32 array.
     """
-    print(f"Processing {len(image_paths)} images for background removal")
-    
-    # Create a directory for background-removed images
-    nobg_dir = os.path.join(output_dir, "no_background")
-    os.makedirs(nobg_dir, exist_ok=True)
-    
-    processed_images = []
-    
-    for img_path in image_paths:
+    im = np.asarray(img.convert("RGB").resize(size, Image.LANCZOS), dtype=np.float32)
+    im = im / (np.max(im) or 1)
+    return ((im - np.float32(mean)) / np.float32(std)).transpose(2, 0, 1)
+
+def cutout_from_prediction(img, prediction):
+    """
+    Turn one model output map into a mask at the image's size and composite
+    the image over a transparent background, as rembg does.
+    """
+    low, high = np.min(prediction), np.max(prediction)
+    prediction = (prediction - low) / (high - low)
+    mask = Image.fromarray((prediction * 255).astype("uint8"), mode="L")
+    mask = mask.resize(img.size, Image.LANCZOS)
+    return Image.composite(img, Image.new("RGBA", img.size, 0), mask)
+
+def _write_one(src_path, dst_path, output_format):
+    try:
+        write_without_background(src_path, dst_path, output_format)
+        return None
+    except Exception as e:
+        return e
+
+def remove_backgrounds(pairs, batch_size=None, threads=None, output_format=None):
+    """
+    Removes the background of every (src_path, dst_path) pair.
+
+    Images are resized to the model's input size and stacked so that up to
+    batch_size of them go through one ONNX inference; the masks are then
+    scaled back and composited per image. threads sets ONNX Runtime's
+    intra-op threads (0 lets it decide). Defaults come from settings.
+    Decoded images of a batch are held until it is written, so memory grows
+    with batch_size, which is capped at settings.BACKGROUND_MAX_BATCH_SIZE.
+    Returns, per pair, None or the exception that stopped it.
+    """
+    batch_size = min(max(1, batch_size or settings.BACKGROUND_BATCH_SIZE), settings.BACKGROUND_MAX_BATCH_SIZE)
+    threads = settings.BACKGROUND_THREADS if threads is None else threads
+    output_format = output_format or settings.BACKGROUND_FORMAT
+
+    inputs = MODEL_INPUTS.get(settings.REMBG_MODEL)
+    if inputs is None:
+        return [_write_one(src, dst, output_format) for src, dst in pairs]
+
+    session = get_onnx_session(threads)
+    input_meta = session.get_inputs()[0]
+    if isinstance(input_meta.shape[0], int) and batch_size > input_meta.shape[0]:
+        # The model was exported with a fixed batch dimension
+        if (settings.REMBG_MODEL, batch_size) not in _capped_batch_sizes:
+            _capped_batch_sizes.add((settings.REMBG_MODEL, batch_size))
+            logger.warning(
+                f"Model {settings.REMBG_MODEL} takes batches of {input_meta.shape[0]} images; "
+                f"running batches of {input_meta.shape[0]} instead of {batch_size}"
+            )
+        batch_size = input_meta.shape[0]
+
+    errors = [None] * len(pairs)
+    for start in range(0, len(pairs), batch_size):
+        images = []
+        for i in range(start, min(start + batch_size, len(pairs))):
+            try:
+                with Image.open(pairs[i][0]) as img:
+                    # exif_transpose returns a loaded copy, so the file can be closed
+                    images.append((i, ImageOps.exif_transpose(img)))
+            except Exception as e:
+                errors[i] = e
+        if not images:
+            continue
+
         try:
-            # Open image
-            with Image.open(img_path) as img:
-                # Remove background
-                output = remove(img)
-                
-                # Save to new path
-                filename = os.path.basename(img_path)
-                base_name, ext = os.path.splitext(filename)
-                
-                # Save as PNG to preserve transparency
-                new_filename = f"{base_name}_nobg.png"
-                new_path = os.path.join(nobg_dir, new_filename)
-                
-                output.save(new_path)
-                processed_images.append(new_path)
-                
-                print(f"Removed background from: {filename}")
-                
+            batch = np.stack([model_input(img, *inputs) for _, img in images])
+            predictions = session.run(None, {input_meta.name: batch})[0][:, 0]
         except Exception as e:
-            print(f"Error processing {os.path.basename(img_path)}: {e}")
-    
-    print(f"Background removal complete. Processed {len(processed_images)} images.")
-    return processed_images
\ No newline at end of file
+            for i, _ in images:
+                errors[i] = e
+            continue
+
+        for (i, img), prediction in zip(images, predictions):
+            try:
+                save_cutout(cutout_from_prediction(img, prediction), pairs[i][1], output_format)
+            except Exception as e:
+                errors[i] = e
+    return errors
@@ -1,7 +1,9 @@
-import os
+import logging
 import cv2
 import numpy as np
-from PIL import Image
+import scipy.fft
+
+logger = logging.getLogger(__name__)
 
 # Configuration / Tunable Parameters
 # Global threshold for the combined focus measure (tuned based on validation data)
@@ -20,6 +22,23 @@ FFT_WEIGHT = 0.35
 # Improved FFT: high-pass filter size (fraction of smaller dimension)
 SIZE_PERCENT = 0.1
 
+# Largest relative difference between the combined score of score_blur_gray and
+# the reference implementation (multi_scale_laplacian_variance,
+# improved_fft_blur_detection and the float64 Tenengrad), caused by float32
+# rounding. Patch variances use the Laplacian of the whole image, which only
+# differs from the per-patch Laplacian on the one-pixel patch borders.
+# Perfectly flat images are the exception: their FFT measure is the log of
+# rounding noise in both versions, though both still call them blurry.
+# Enforced by tests/test_remove_blur.py.
+FOCUS_SCORE_TOLERANCE = 1e-4
+
+# Identifies the scoring algorithm and parameters for cached results; bump the
+# version when the scoring code changes
+BLUR_ANALYSIS_VERSION = (
+    f"blur:v3:{DEFAULT_BLUR_THRESHOLD}:{LOCAL_BLUR_THRESHOLD}:{FRACTION_BLURRY}:{PATCH_GRID}:"
+    f"{LAPLACIAN_WEIGHT}:{TENENGRAD_WEIGHT}:{FFT_WEIGHT}:{SIZE_PERCENT}"
+)
+
 def multi_scale_laplacian_variance(gray, levels=3):
     """
     Computes Laplacian variance over multiple scales.
@@ -102,98 +121,178 @@ def resize_image(image, width=1024):
     new_height = int(width * aspect_ratio)
     return cv2.resize(image, (width, new_height), interpolation=cv2.INTER_AREA)
 
-def enhanced_blur_detection(image_path, threshold=DEFAULT_BLUR_THRESHOLD):
-    """
-    Computes a combined focus score using:
-      - Multi-scale Laplacian variance,
-      - Tenengrad gradient magnitude, and
-      - FFT-based high-frequency energy.
-    The final score is compared against an adaptive threshold based on image brightness.
-    Additionally, a patch-based method computes local blur scores with dynamic thresholds.
-    The image is classified as blurry if either the global or the local measure indicates blur.
-    """
-    try:
-        image = cv2.imread(image_path)
-        if image is None:
-            return 0, True
-
-        # Resize image to a max width of 1024 (preserving aspect ratio)
-        image = resize_image(image, width=1024)
-        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-
-        # Global focus measures:
-        laplacian_var = multi_scale_laplacian_variance(gray, levels=3)
-        sobel_x = cv2.Sobel(gray, cv2.CV_64F, 1, 0, ksize=3)
-        sobel_y = cv2.Sobel(gray, cv2.CV_64F, 0, 1, ksize=3)
-        tenengrad = np.mean(sobel_x**2 + sobel_y**2)
-        fft_score = improved_fft_blur_detection(gray, size_percent=SIZE_PERCENT)
-
-        # Combine the global measures using the tuned weights.
-        combined_score = (LAPLACIAN_WEIGHT * laplacian_var) + (TENENGRAD_WEIGHT * tenengrad) + (FFT_WEIGHT * fft_score)
-
-        # Adaptive scaling based on overall brightness (mean intensity).
-        mean_intensity = np.mean(gray)
-        adaptive_factor = 1.0
-        if mean_intensity < 50:
-            adaptive_factor = 0.8
-        elif mean_intensity > 200:
-            adaptive_factor = 1.2
-        final_threshold = threshold * adaptive_factor
-
-        global_blurry = bool(combined_score < final_threshold)
-
-        # Local (patch-based) focus measure.
-        local_blurry = patch_based_blur_check(
-            gray,
-            patch_grid=PATCH_GRID,
-            local_threshold=LOCAL_BLUR_THRESHOLD,
-            fraction_blurry=FRACTION_BLURRY
-        )
-
-        # Classify image as blurry if either global or local measures indicate blur.
-        is_blurry = (global_blurry or local_blurry)
-        return float(combined_score), is_blurry
-
-    except Exception as e:
-        print(f"Error processing image {image_path}: {str(e)}")
-        return 0, True
-
-def remove_blur_images(image_paths, output_dir):
-    """
-    Remove blurry images using enhanced blur detection methods:
-    - Multi-scale Laplacian variance
-    - Tenengrad gradient magnitude
-    - FFT-based high-frequency energy analysis
-    - Patch-based blur checking with dynamic thresholds
-    """
-    print(f"Processing {len(image_paths)} images for blur detection")
-    
-    # Create a directory for sharp images
-    sharp_dir = os.path.join(output_dir, "sharp_images")
-    os.makedirs(sharp_dir, exist_ok=True)
-    
-    sharp_images = []
-    
-    for img_path in image_paths:
-        try:
-            # Run enhanced blur detection on the image
-            blur_score, is_blurry = enhanced_blur_detection(img_path)
-            
-            # If image is sharp enough, keep it
-            if not is_blurry:
-                filename = os.path.basename(img_path)
-                new_path = os.path.join(sharp_dir, filename)
-                
-                # Read and save the image to the new path
-                img = cv2.imread(img_path)
-                cv2.imwrite(new_path, img)
-                sharp_images.append(new_path)
-                print(f"Sharp image: {filename}, Blur score: {blur_score:.2f}")
-            else:
-                print(f"Blurry image: {os.path.basename(img_path)}, Blur score: {blur_score:.2f}")
-                
-        except Exception as e:
-            print(f"Error processing {os.path.basename(img_path)}: {e}")
-    
-    print(f"Blur detection complete. Found {len(image_paths) - len(sharp_images)} blurry images.")
-    return sharp_images
\ No newline at end of file
+def fft_blur_scores(grays, size_percent=0.1):
+    """
+    Same measure as improved_fft_blur_detection for a stack of equally sized
+    grayscale images (n, h, w), using float32 real-to-complex FFTs and no
+    shifts. Returns an array of n scores.
+
+    The zeroed square holds frequencies -half..half-1 on both axes. Its
+    symmetric part -(half-1)..half-1 is removed in the half spectrum, which
+    keeps the high-pass image real; the two unpaired lines at frequency -half
+    are separable and are subtracted as outer products, which makes the result
+    complex exactly like the full-spectrum version. Images are not padded to
+    faster FFT sizes, since padding changes the frequency grid and the score.
+    """
+    grays = np.asarray(grays, dtype=np.float32)
+    n, h, w = grays.shape
+    half = int(min(h, w) * size_percent // 2)
+    if half == 0:
+        magnitude = np.abs(grays)
+    else:
+        spectrum = scipy.fft.rfft2(grays)
+        filtered = spectrum.copy()
+        filtered[:, :half, :half] = 0
+        filtered[:, h - half + 1:, :half] = 0
+        real = scipy.fft.irfft2(filtered, s=(h, w))
+
+        # Row -half over columns -half..half-1, using F(u, -v) = conj(F(-u, v))
+        v = np.arange(-half, half)
+        row = np.zeros((n, w), dtype=np.complex64)
+        row[:, v % w] = np.where(v >= 0, spectrum[:, h - half, np.abs(v)], np.conj(spectrum[:, half, np.abs(v)]))
+        row_x = scipy.fft.ifft(row) / h
+        row_y = np.exp(-2j * np.pi * half * np.arange(h) / h)
+        # Column -half over rows -(half-1)..half-1
+        u = np.arange(-(half - 1), half)
+        col = np.zeros((n, h), dtype=np.complex64)
+        col[:, u % h] = np.conj(spectrum[:, (-u) % h, half])
+        col_y = scipy.fft.ifft(col) / w
+        col_x = np.exp(-2j * np.pi * half * np.arange(w) / w)
+
+        lines = (row_y.astype(np.complex64)[None, :, None] * row_x[:, None, :] +
+                 col_y[:, :, None] * col_x.astype(np.complex64)[None, None, :])
+        magnitude = np.hypot(real - lines.real, lines.imag)
+    eps = np.float32(1e-10)
+    return 20 * np.log10(magnitude + eps).mean(axis=(1, 2), dtype=np.float64)
+
+def _patch_bounds(size, count):
+    step = size // count
+    return np.array([i * step for i in range(count)] + [size])
+
+def _patch_sums(integral, ys, xs):
+    return (integral[np.ix_(ys[1:], xs[1:])] - integral[np.ix_(ys[:-1], xs[1:])]
+            - integral[np.ix_(ys[1:], xs[:-1])] + integral[np.ix_(ys[:-1], xs[:-1])])
+
+def patch_blur_check_integral(gray, lap, patch_grid=(4, 4), local_threshold=80, fraction_blurry=0.3):
+    """
+    Same check as patch_based_blur_check, with every patch's mean and
+    Laplacian variance read from integral images of gray and of lap, the
+    Laplacian of the whole image.
+    """
+    rows, cols = patch_grid
+    h, w = gray.shape
+    ys = _patch_bounds(h, rows)
+    xs = _patch_bounds(w, cols)
+    areas = np.outer(np.diff(ys), np.diff(xs))
+
+    patch_means = _patch_sums(cv2.integral(gray, sdepth=cv2.CV_64F), ys, xs) / areas
+    lap_sum, lap_sqsum = cv2.integral2(lap, sdepth=cv2.CV_64F, sqdepth=cv2.CV_64F)
+    lap_means = _patch_sums(lap_sum, ys, xs) / areas
+    lap_vars = _patch_sums(lap_sqsum, ys, xs) / areas - lap_means ** 2
+
+    patch_factors = np.where(patch_means < 50, 0.8, np.where(patch_means > 200, 1.2, 1.0))
+    blurry_patches = np.count_nonzero(lap_vars < local_threshold * patch_factors)
+    return (blurry_patches / (rows * cols)) > fraction_blurry
+
+def _spatial_measures(gray, levels=3):
+    """
+    Multi-scale Laplacian variance, Tenengrad and the full-resolution
+    Laplacian of one grayscale image, in float32.
+    """
+    lap = cv2.Laplacian(gray, cv2.CV_32F)
+    _, std = cv2.meanStdDev(lap)
+    laplacian_var = float(std[0, 0]) ** 2
+    current = gray
+    for _ in range(levels - 1):
+        if current.shape[0] > 1 and current.shape[1] > 1:
+            current = cv2.pyrDown(current)
+        _, std = cv2.meanStdDev(cv2.Laplacian(current, cv2.CV_32F))
+        laplacian_var += float(std[0, 0]) ** 2
+    laplacian_var /= levels
+
+    sobel_x = cv2.Sobel(gray, cv2.CV_32F, 1, 0, ksize=3)
+    sobel_y = cv2.Sobel(gray, cv2.CV_32F, 0, 1, ksize=3)
+    tenengrad = cv2.mean(cv2.multiply(sobel_x, sobel_x) + cv2.multiply(sobel_y, sobel_y))[0]
+    return laplacian_var, tenengrad, lap
+
+def _classify(gray, lap, laplacian_var, tenengrad, fft_score, threshold):
+    # Combine the global measures using the tuned weights.
+    combined_score = (LAPLACIAN_WEIGHT * laplacian_var) + (TENENGRAD_WEIGHT * tenengrad) + (FFT_WEIGHT * fft_score)
+
+    # Adaptive scaling based on overall brightness (mean intensity).
+    mean_intensity = cv2.mean(gray)[0]
+    adaptive_factor = 1.0
+    if mean_intensity < 50:
+        adaptive_factor = 0.8
+    elif mean_intensity > 200:
+        adaptive_factor = 1.2
+    final_threshold = threshold * adaptive_factor
+
+    global_blurry = bool(combined_score < final_threshold)
+
+    # Local (patch-based) focus measure.
+    local_blurry = patch_blur_check_integral(
+        gray, lap,
+        patch_grid=PATCH_GRID,
+        local_threshold=LOCAL_BLUR_THRESHOLD,
+        fraction_blurry=FRACTION_BLURRY
+    )
+
+    # Classify image as blurry if either global or local measures indicate blur.
+    is_blurry = bool(global_blurry or local_blurry)
+    return float(combined_score), is_blurry
+
+def score_blur_gray(gray, threshold=DEFAULT_BLUR_THRESHOLD):
+    """
+    Scores a grayscale image already at working resolution, returning
+    (score, is_blurry). The Laplacian is computed once and shared by the global and patch measures;
+    scores match the reference implementation within FOCUS_SCORE_TOLERANCE.
+    """
+    laplacian_var, tenengrad, lap = _spatial_measures(gray, levels=3)
+    fft_score = fft_blur_scores(gray[None], size_percent=SIZE_PERCENT)[0]
+    return _classify(gray, lap, laplacian_var, tenengrad, fft_score, threshold)
+
+def score_blur_batch(grays, threshold=DEFAULT_BLUR_THRESHOLD):
+    """
+    Scores many grayscale working images at once, returning a list of
+    (score, is_blurry) in input order. Images of the same size share one
+    batched FFT.
+    """
+    fft_scores = [None] * len(grays)
+    by_shape = {}
+    for i, gray in enumerate(grays):
+        by_shape.setdefault(gray.shape, []).append(i)
+    for indices in by_shape.values():
+        scores = fft_blur_scores(np.stack([grays[i] for i in indices]), size_percent=SIZE_PERCENT)
+        for i, score in zip(indices, scores):
+            fft_scores[i] = score
+
+    results = []
+    for gray, fft_score in zip(grays, fft_scores):
+        laplacian_var, tenengrad, lap = _spatial_measures(gray, levels=3)
+        results.append(_classify(gray, lap, laplacian_var, tenengrad, fft_score, threshold))
+    return results
+
+def analyze_blur_batch(frames):
+    """
+    Pipeline analysis step for a batch of frames: scores each frame's shared
+    working copy, which is decoded at reduced resolution and straight to
+    grayscale. score_blur_batch computes the FFTs of equally sized copies
+    together.
+    """
+    results = score_blur_batch([frame.working_gray for frame in frames])
+    for frame, (blur_score, is_blurry) in zip(frames, results):
+        frame.summary["blur_score"] = blur_score
+        frame.summary["is_blurry"] = is_blurry
+
+def analyze_blur(frame):
+    """
+    Pipeline analysis step: analyze_blur_batch for a single frame.
+    """
+    analyze_blur_batch([frame])
+
+def is_sharp(frame):
+    """
+    Pipeline predicate: keeps a frame that was scored and is not blurry.
+    """
+    return frame.summary.get("is_blurry") is False
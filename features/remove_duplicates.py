@@ -1,134 +1,110 @@
-import os
 import numpy as np
-from PIL import Image
-import imagehash
 import logging
-from collections import defaultdict
 
-# Set up logging
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+from features.image_hashes import hash_gray_batch
+
 logger = logging.getLogger(__name__)
 
-def calculate_hash_distance(hash1, hash2):
+# Images are duplicates if either hash distance is within its threshold
+DHASH_THRESHOLD = 8
+PHASH_THRESHOLD = 12
+
+# Minimum width of the reduced-resolution grayscale image that is hashed
+HASH_PROXY_WIDTH = 256
+
+# Bump when analyze_hash_batch changes so cached results are recomputed
+HASH_ANALYSIS_VERSION = f"hashes:dhash-phash-64:proxy{HASH_PROXY_WIDTH}:v2"
+
+# Number of leader rows whose distances are computed together in group_packed_duplicates
+DEDUP_BLOCK_SIZE = 256
+
+# Cap on the bytes of one block of 64-bit distances; on very large sessions
+# fewer leader rows are compared per step
+DEDUP_BLOCK_BYTES = 16 * 1024 * 1024
+
+# Masks for the SWAR popcount of 64-bit words
+_M1 = np.uint64(0x5555555555555555)
+_M2 = np.uint64(0x3333333333333333)
+_M4 = np.uint64(0x0F0F0F0F0F0F0F0F)
+_H01 = np.uint64(0x0101010101010101)
+
+def popcount64(values):
     """
-    Calculate normalized hamming distance between two image hashes
+    Vectorized population count of a uint64 array.
     """
-    try:
-        # Convert string hashes back to imagehash objects if they're strings
-        if isinstance(hash1, str):
-            h1 = imagehash.hex_to_hash(hash1)
-        else:
-            h1 = hash1
-            
-        if isinstance(hash2, str):
-            h2 = imagehash.hex_to_hash(hash2)
-        else:
-            h2 = hash2
-
-        # Calculate distance
-        distance = abs(h1 - h2)
-        logger.debug(f"Hash distance: {distance}")
-        return distance
-    except Exception as e:
-        logger.error(f"Error calculating hash distance: {str(e)}")
-        return float('inf')
-
-def remove_duplicates(image_paths, output_dir):
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(values)
+    x = values - ((values >> np.uint64(1)) & _M1)
+    x = (x & _M2) + ((x >> np.uint64(2)) & _M2)
+    x = (x + (x >> np.uint64(4))) & _M4
+    return (x * _H01) >> np.uint64(56)
+
+def group_packed_duplicates(dhashes, phashes):
     """
-    Remove duplicate images based on perceptual hashing.
-    Uses both difference hash and perceptual hash for better accuracy.
+    Greedily group packed hashes, matching the first-seen semantics of the
+    pairwise loop: each image not yet grouped starts a group and claims every
+    later ungrouped image within DHASH_THRESHOLD or PHASH_THRESHOLD.
+    Returns groups of indices in input order.
+
+    Distances are computed as blocks of leader rows against the remaining
+    columns with XOR and a vectorized popcount, so memory stays bounded by
+    DEDUP_BLOCK_SIZE * len(dhashes), and by DEDUP_BLOCK_BYTES per array.
     """
-    logger.info(f"Processing {len(image_paths)} images for duplicate removal")
-    
-    # Create a directory for unique images
-    unique_dir = os.path.join(output_dir, "unique_images")
-    os.makedirs(unique_dir, exist_ok=True)
-    
-    # Dictionary to store image hashes
-    image_hashes = {}
-    
-    # Calculate hashes for all images
-    for img_path in image_paths:
-        try:
-            if not os.path.exists(img_path):
-                logger.warning(f"File not found: {img_path}")
+    dhashes = np.asarray(dhashes, dtype=np.uint64)
+    phashes = np.asarray(phashes, dtype=np.uint64)
+    n = len(dhashes)
+    processed = np.zeros(n, dtype=bool)
+    groups = []
+
+    start = 0
+    while start < n:
+        rows = max(1, min(DEDUP_BLOCK_SIZE, DEDUP_BLOCK_BYTES // (8 * (n - start))))
+        stop = min(start + rows, n)
+        # Every index before `start` is already grouped, so only later columns matter
+        similar = (
+            (popcount64(dhashes[start:stop, None] ^ dhashes[None, start:]) <= DHASH_THRESHOLD) |
+            (popcount64(phashes[start:stop, None] ^ phashes[None, start:]) <= PHASH_THRESHOLD)
+        )
+        for row, i in enumerate(range(start, stop)):
+            if processed[i]:
                 continue
+            members = np.flatnonzero(similar[row] & ~processed[start:]) + start
+            processed[members] = True
+            groups.append(members.tolist())
+        start = stop
 
-            with Image.open(img_path) as img:
-                # Convert to RGB if necessary
-                if img.mode not in ('RGB', 'L'):
-                    img = img.convert('RGB')
-                
-                # Use both difference hash and perceptual hash for better accuracy
-                dhash_value = imagehash.dhash(img)
-                phash_value = imagehash.phash(img)
-                image_hashes[img_path] = {'dhash': dhash_value, 'phash': phash_value}
-
-        except Exception as e:
-            logger.error(f"Error processing image {img_path}: {e}")
-            continue
-
-    if not image_hashes:
-        logger.warning("No valid images could be processed")
-        return []
-
-    # Find duplicates using both hash types
-    DHASH_THRESHOLD = 8
-    PHASH_THRESHOLD = 12
-    groups = []
-    processed = set()
-    
-    # Group similar images
-    for img_path in image_hashes.keys():
-        if img_path in processed:
-            continue
-
-        current_group = [img_path]
-        processed.add(img_path)
-
-        # Compare with other images
-        for other_path in image_hashes.keys():
-            if other_path != img_path and other_path not in processed:
-                dhash_distance = calculate_hash_distance(image_hashes[img_path]['dhash'], 
-                                                       image_hashes[other_path]['dhash'])
-                phash_distance = calculate_hash_distance(image_hashes[img_path]['phash'], 
-                                                       image_hashes[other_path]['phash'])
-                
-                # Consider images duplicate if either hash is within threshold
-                if dhash_distance <= DHASH_THRESHOLD or phash_distance <= PHASH_THRESHOLD:
-                    current_group.append(other_path)
-                    processed.add(other_path)
-
-        if len(current_group) >= 1:  # Add all groups
-            groups.append(current_group)
-    
-    # Process the groups to save unique images
-    unique_images = []
-    duplicate_count = 0
-    
+    return groups
+
+def analyze_hash_batch(frames):
+    """
+    Pipeline analysis step for a batch of frames: hashes a reduced-resolution
+    grayscale decode of each; both hashes shrink the image far below
+    HASH_PROXY_WIDTH anyway. The hashes of the whole batch are computed
+    together by hash_gray_batch, and stored packed into ints to keep the
+    summaries compact.
+    """
+    grays = [frame.proxy(HASH_PROXY_WIDTH, grayscale=True)[0] for frame in frames]
+    hashes = hash_gray_batch(grays)
+    for row, frame in enumerate(frames):
+        frame.summary['dhash'] = int(hashes['dhash'][row])
+        frame.summary['phash'] = int(hashes['phash'][row])
+
+def analyze_hashes(frame):
+    """
+    Pipeline analysis step: analyze_hash_batch for a single frame.
+    """
+    analyze_hash_batch([frame])
+
+def select_unique(frames):
+    """
+    Pipeline selection step: keeps the first frame of every duplicate group.
+    """
+    hashed = [f for f in frames if 'dhash' in f.summary]
+    # The packed hashes are all that is needed; no per-image dicts are built
+    dhashes = np.fromiter((f.summary['dhash'] for f in hashed), dtype=np.uint64, count=len(hashed))
+    phashes = np.fromiter((f.summary['phash'] for f in hashed), dtype=np.uint64, count=len(hashed))
+    groups = group_packed_duplicates(dhashes, phashes)
     for group in groups:
-        if not group:  # Skip empty groups
-            continue
-            
-        # Get the first image as the unique one
-        original_path = group[0]
-        
-        try:
-            # Save the unique image
-            with Image.open(original_path) as img:
-                filename = os.path.basename(original_path)
-                new_path = os.path.join(unique_dir, filename)
-                img.save(new_path, quality=95)
-                unique_images.append(new_path)
-                
-            # Log duplicates
-            if len(group) > 1:
-                duplicate_count += len(group) - 1
-                logger.info(f"Found {len(group)-1} duplicates of {os.path.basename(original_path)}")
-                for dup in group[1:]:
-                    logger.debug(f"  Duplicate: {os.path.basename(dup)}")
-        except Exception as e:
-            logger.error(f"Error saving unique image {original_path}: {e}")
-    
-    logger.info(f"Duplicate removal complete. Found {duplicate_count} duplicates out of {len(image_paths)} images.")
-    return unique_images
\ No newline at end of file
+        if len(group) > 1:
+            logger.info(f"Found {len(group)-1} duplicates of {hashed[group[0]].filename}")
+    return [hashed[group[0]] for group in groups]
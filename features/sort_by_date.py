@@ -1,59 +1,55 @@
 import os
-import shutil
+import logging
 from datetime import datetime
-import time
-from PIL import Image
 
-def sort_by_date(image_paths, output_dir):
-    """
-    Sort images by date and organize them into folders by year/month.
-    """
-    print(f"Processing {len(image_paths)} images for date sorting")
-    
-    # Dictionary to store sorted images
-    sorted_images = []
-    
-    # Create a base directory for date-sorted images
-    date_dir = os.path.join(output_dir, "date_sorted")
-    os.makedirs(date_dir, exist_ok=True)
-    
-    for img_path in image_paths:
+from features.capture_date import read_capture_date
+
+logger = logging.getLogger(__name__)
+
+# Bump when analyze_date changes so cached results are recomputed
+DATE_ANALYSIS_VERSION = "capture-date:v2"
+
+def date_folder(date_taken):
+    """
+    Relative year/month folder for a date, e.g. date_sorted/2023/07.
+    """
+    return os.path.join("date_sorted", str(date_taken.year), f"{date_taken.month:02d}")
+
+def analyze_date(frame):
+    """
+    Pipeline analysis step: records the capture date from the image
+    metadata (None if missing). Only the metadata segments are read from
+    disk, unless another stage already read the whole file. Only depends on
+    the file contents, so the result can be cached.
+    """
+    exif_date = None
+    data = frame.buffered
+    try:
+        exif_date = read_capture_date(data if data is not None else frame.path)
+    except Exception as e:
+        logger.warning(f"Could not read EXIF data from {frame.filename}: {e}")
+    frame.summary["exif_date"] = exif_date
+
+def select_by_date(frames):
+    """
+    Pipeline selection step: dates every frame, falling back to the file
+    modification time, and keeps every frame that could be dated.
+    """
+    dated = []
+    for frame in frames:
+        if "exif_date" not in frame.summary:
+            continue
         try:
-            # Get image creation/modification date
-            stat = os.stat(img_path)
-            
-            # Try to get date from EXIF data first
-            date_taken = None
-            try:
-                with Image.open(img_path) as img:
-                    exif_data = img._getexif()
-                    if exif_data and 36867 in exif_data:  # 36867 is DateTimeOriginal tag
-                        date_taken = datetime.strptime(exif_data[36867], "%Y:%m:%d %H:%M:%S")
-            except Exception as e:
-                print(f"Could not read EXIF data from {os.path.basename(img_path)}: {e}")
-            
-            # If no EXIF data, use file modification time
-            if not date_taken:
-                date_taken = datetime.fromtimestamp(stat.st_mtime)
-            
-            # Create year/month directory structure
-            year_dir = os.path.join(date_dir, str(date_taken.year))
-            month_dir = os.path.join(year_dir, f"{date_taken.month:02d}")
-            
-            os.makedirs(year_dir, exist_ok=True)
-            os.makedirs(month_dir, exist_ok=True)
-            
-            # Copy image to appropriate directory
-            filename = os.path.basename(img_path)
-            new_path = os.path.join(month_dir, filename)
-            
-            shutil.copy2(img_path, new_path)
-            sorted_images.append(new_path)
-            
-            print(f"Sorted image: {filename} to {date_taken.year}/{date_taken.month:02d}")
-                
+            date_taken = frame.summary["exif_date"] or datetime.fromtimestamp(frame.mtime)
         except Exception as e:
-            print(f"Error processing {os.path.basename(img_path)}: {e}")
-    
-    print(f"Date sorting complete. Sorted {len(sorted_images)} images.")
-    return sorted_images
\ No newline at end of file
+            logger.warning(f"Error processing {frame.filename}: {e}")
+            continue
+        frame.summary["date_taken"] = date_taken
+        dated.append(frame)
+    return dated
+
+def frame_date_folder(frame):
+    """
+    Pipeline output folder of a dated frame.
+    """
+    return date_folder(frame.summary["date_taken"])
@@ -1,22 +1,34 @@
-from fastapi import FastAPI, UploadFile, File, Form, HTTPException
-from fastapi.responses import FileResponse
+from fastapi import FastAPI, UploadFile, File, Form, HTTPException, Request, Header
+from fastapi.responses import FileResponse, StreamingResponse, PlainTextResponse, Response
+from starlette.background import BackgroundTask
+from starlette.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 from typing import List, Optional
-import shutil
 import os
+import re
 import uuid
-import zipfile
-import tempfile
-from datetime import datetime
-
-# Import feature modules
-from features.face_cluster import cluster_by_face
-from features.remove_duplicates import remove_duplicates
-from features.remove_blur import remove_blur_images
-from features.remove_bad_angles import remove_bad_angles
-from features.sort_by_date import sort_by_date
-from features.remove_background import remove_background
+import mimetypes
+import threading
+
+import cv2
+
+# Import the processing pipeline
+from pipeline.engine import run_pipeline
+from pipeline.jobs import JobManager, JobQueueFull, SessionBusy
+from pipeline.cache import get_cache
+from pipeline.ingest import Ingestor, UploadOutOfOrder, ChunkRejected
+from pipeline.output import OUTPUT_MODES, CUTOUT_FORMATS, resolve_output
+from pipeline.archive import ZipStream, archive_files
+from pipeline.incremental import SessionGraphs
+from pipeline.models import registry
+from pipeline.metrics import metrics, configure_logging
+from pipeline.thumbnails import ThumbnailStore
+from pipeline.janitor import SessionJanitor
+from pipeline import settings
+
+# Per-image messages are logged at DEBUG; set LOG_LEVEL=DEBUG to see them
+configure_logging()
 
 app = FastAPI(title="Image Cluster API")
 
@@ -31,30 +43,159 @@ app.add_middleware(
 
 # Create temporary directories for uploads and processed images
 UPLOAD_DIR = "temp/uploads"
+PARTIAL_DIR = "temp/partial_uploads"
 PROCESSED_DIR = "temp/processed"
 os.makedirs(UPLOAD_DIR, exist_ok=True)
+os.makedirs(PARTIAL_DIR, exist_ok=True)
 os.makedirs(PROCESSED_DIR, exist_ok=True)
 
+# Background processing jobs
+job_manager = JobManager()
+
+# Streams uploads to disk, hashing and pre-analyzing them as they land
+ingestor = Ingestor(UPLOAD_DIR, PARTIAL_DIR)
+
+# Memoized stage results per session, so re-runs only compute what changed
+session_graphs = SessionGraphs()
+
+# Previews of processed images, rendered in the background after each job
+thumbnails = ThumbnailStore()
+
+def forget_session(session_id):
+    """Drop the in-memory state of a session removed from disk"""
+    ingestor.forget_session(session_id)
+    session_graphs.forget(session_id)
+    thumbnails.forget_session(session_id)
+
+# Expires idle sessions and keeps their total size under the storage quota
+janitor = SessionJanitor(
+    [UPLOAD_DIR, PARTIAL_DIR, PROCESSED_DIR],
+    is_busy=job_manager.session_active,
+    is_receiving=ingestor.receiving,
+    on_remove=forget_session,
+)
+
+# Thumbnail URLs name an output path, whose content can change when a
+# session is processed again: browsers keep them but revalidate by ETag
+THUMBNAIL_CACHE_CONTROL = "private, no-cache"
+
+CONTENT_RANGE_PATTERN = re.compile(r"bytes (\d+)-(\d+)/(\d+)")
+RANGE_PATTERN = re.compile(r"bytes=(\d*)-(\d*)")
+
+def safe_filename(filename):
+    """Strip directories from a client-supplied filename"""
+    name = os.path.basename(filename or "")
+    if not name or name.startswith("."):
+        raise HTTPException(status_code=400, detail="Invalid filename")
+    return name
+
+def safe_session_id(session_id):
+    """Reject client-supplied session ids that are not a plain folder name"""
+    if not session_id or session_id.startswith(".") or os.path.basename(session_id) != session_id:
+        raise HTTPException(status_code=404, detail="Session not found")
+    return session_id
+
+def get_output_dir(session_id):
+    """Return the output directory of a session, recording the access"""
+    session_id = safe_session_id(session_id)
+    janitor.touch(session_id)
+    return os.path.join(PROCESSED_DIR, session_id)
+
+def get_session_dir(session_id):
+    """Return the upload directory of an existing session"""
+    session_id = safe_session_id(session_id)
+    session_dir = os.path.join(UPLOAD_DIR, session_id)
+    if not os.path.isdir(session_dir):
+        raise HTTPException(status_code=404, detail="Session not found")
+    janitor.touch(session_id)
+    return session_dir
+
 @app.post("/api/upload")
 async def upload_images(files: List[UploadFile] = File(...)):
     """Upload multiple images to the server"""
     session_id = str(uuid.uuid4())
     session_dir = os.path.join(UPLOAD_DIR, session_id)
-    os.makedirs(session_dir, exist_ok=True)
-    
     file_paths = []
-    for file in files:
-        if not file.content_type.startswith('image/'):
-            continue
-        
-        file_path = os.path.join(session_dir, file.filename)
-        with open(file_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
-        file_paths.append(file_path)
+    # Held so the janitor leaves the session alone while its files arrive
+    with janitor.hold(session_id):
+        os.makedirs(session_dir, exist_ok=True)
+        for file in files:
+            if not file.content_type.startswith('image/'):
+                continue
+            
+            # Hashed while copied, off the event loop; pre-analysis starts as soon as each file lands
+            file_path = await run_in_threadpool(ingestor.save_stream, session_id, safe_filename(file.filename), file.file)
+            file_paths.append(file_path)
     
     return {"session_id": session_id, "file_count": len(file_paths)}
 
-@app.post("/api/process")
+@app.post("/api/sessions")
+async def create_session():
+    """Create an empty upload session for chunked uploads"""
+    session_id = str(uuid.uuid4())
+    os.makedirs(os.path.join(UPLOAD_DIR, session_id), exist_ok=True)
+    janitor.touch(session_id)
+    return {"session_id": session_id}
+
+@app.get("/api/upload/{session_id}/{filename}")
+async def get_upload_offset(session_id: str, filename: str):
+    """Get how many bytes of a chunked upload were received, to resume it"""
+    session_id = safe_session_id(session_id)
+    get_session_dir(session_id)
+    offset, complete = ingestor.received_offset(session_id, safe_filename(filename))
+    return {"offset": offset, "complete": complete}
+
+@app.put("/api/upload/{session_id}/{filename}")
+async def upload_chunk(
+    session_id: str,
+    filename: str,
+    request: Request,
+    content_range: str = Header(...)
+):
+    """Append one chunk of a file, sent with a 'Content-Range: bytes start-end/total' header"""
+    session_id = safe_session_id(session_id)
+    filename = safe_filename(filename)
+    mime_type, _ = mimetypes.guess_type(filename)
+    if not mime_type or not mime_type.startswith('image/'):
+        raise HTTPException(status_code=415, detail="Only image files can be uploaded")
+    
+    match = CONTENT_RANGE_PATTERN.fullmatch(content_range.strip())
+    if not match:
+        raise HTTPException(status_code=400, detail="Invalid Content-Range header")
+    start, end, total = (int(v) for v in match.groups())
+    if end < start or end >= total:
+        raise HTTPException(status_code=416, detail="Invalid Content-Range header")
+    
+    # Held before the session is looked up, so the janitor cannot remove it
+    # while the chunk is written; between chunks, is_receiving keeps it
+    with janitor.hold(session_id):
+        get_session_dir(session_id)
+        try:
+            chunk = await run_in_threadpool(ingestor.begin_chunk, session_id, filename, start, end, total)
+        except UploadOutOfOrder as e:
+            raise HTTPException(status_code=409, detail={"message": str(e), "offset": e.offset})
+        except ChunkRejected as e:
+            raise HTTPException(status_code=400, detail={"message": str(e), "offset": e.offset})
+        
+        # Bytes are appended and hashed as they arrive, on worker threads so disk
+        # writes and hashing never block the event loop; a body longer or shorter
+        # than its Content-Range is discarded
+        try:
+            with chunk:
+                buffered = bytearray()
+                async for data in request.stream():
+                    buffered += data
+                    if len(buffered) >= settings.UPLOAD_CHUNK_SIZE:
+                        await run_in_threadpool(chunk.write, bytes(buffered))
+                        buffered.clear()
+                if buffered:
+                    await run_in_threadpool(chunk.write, bytes(buffered))
+                offset, complete = await run_in_threadpool(chunk.finish)
+        except ChunkRejected as e:
+            raise HTTPException(status_code=400, detail={"message": str(e), "offset": e.offset})
+    return {"offset": offset, "complete": complete}
+
+@app.post("/api/process", status_code=202)
 async def process_images(
     session_id: str = Form(...),
     cluster_face: Optional[bool] = Form(False),
@@ -63,109 +204,237 @@ async def process_images(
     remove_bad_angles_flag: Optional[bool] = Form(False),
     sort_date: Optional[bool] = Form(False),
     remove_background_flag: Optional[bool] = Form(False),
+    output_mode: Optional[str] = Form(None),
+    background_batch_size: Optional[int] = Form(None),
+    background_threads: Optional[int] = Form(None),
+    background_format: Optional[str] = Form(None),
     face_sample: Optional[UploadFile] = File(None)
 ):
-    """Process images with selected features"""
-    # Validate session
-    session_dir = os.path.join(UPLOAD_DIR, session_id)
-    if not os.path.exists(session_dir):
-        raise HTTPException(status_code=404, detail="Session not found")
+    """Start processing images with selected features; returns a job id to poll"""
+    # Validate session; the sanitized id names every folder and key below
+    session_id = safe_session_id(session_id)
+    session_dir = get_session_dir(session_id)
+    if output_mode and output_mode not in OUTPUT_MODES:
+        raise HTTPException(status_code=400, detail=f"output_mode must be one of {', '.join(OUTPUT_MODES)}")
+    if background_format and background_format not in CUTOUT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"background_format must be one of {', '.join(CUTOUT_FORMATS)}")
+    if background_batch_size is not None and not 1 <= background_batch_size <= settings.BACKGROUND_MAX_BATCH_SIZE:
+        raise HTTPException(
+            status_code=400, detail=f"background_batch_size must be between 1 and {settings.BACKGROUND_MAX_BATCH_SIZE}"
+        )
+    if background_threads is not None and not 0 <= background_threads <= settings.BACKGROUND_MAX_THREADS:
+        raise HTTPException(
+            status_code=400, detail=f"background_threads must be between 0 and {settings.BACKGROUND_MAX_THREADS}"
+        )
     
-    # Create output directory for this session
-    output_dir = os.path.join(PROCESSED_DIR, session_id)
-    os.makedirs(output_dir, exist_ok=True)
+    output_dir = get_output_dir(session_id)
+    image_paths = [os.path.join(session_dir, f) for f in os.listdir(session_dir)]
     
-    # Copy all files to output directory as starting point
-    for filename in os.listdir(session_dir):
-        src_path = os.path.join(session_dir, filename)
-        dst_path = os.path.join(output_dir, filename)
-        shutil.copy2(src_path, dst_path)
+    # Read the face sample now; the upload is closed once this request returns
+    face_sample_data = None
+    if cluster_face and face_sample:
+        face_sample_data = await face_sample.read()
     
-    # Process with selected features
-    image_paths = [os.path.join(output_dir, f) for f in os.listdir(output_dir)]
+    # Each image is decoded once and every selected feature reads the shared frame
+    options = {
+        "cluster_face": cluster_face,
+        "remove_duplicates": remove_duplicates_flag,
+        "remove_blur": remove_blur,
+        "remove_bad_angles": remove_bad_angles_flag,
+        "sort_date": sort_date,
+        "remove_background": remove_background_flag,
+        "background_batch_size": background_batch_size,
+        "background_threads": background_threads,
+        "background_format": background_format,
+    }
     
-    # Apply face clustering if selected
-    if cluster_face:
-        face_sample_path = None
-        if face_sample:
-            # Save the face sample image
-            face_sample_path = os.path.join(output_dir, "face_sample.jpg")
+    def run_job(job):
+        # Outputs of an earlier run are updated in place, not recreated
+        os.makedirs(output_dir, exist_ok=True)
+        
+        face_sample_path = os.path.join(output_dir, "face_sample.jpg")
+        if face_sample_data is not None:
             with open(face_sample_path, "wb") as buffer:
-                shutil.copyfileobj(face_sample.file, buffer)
+                buffer.write(face_sample_data)
+        elif os.path.exists(face_sample_path):
+            os.remove(face_sample_path)
+        # Faces are matched against the sample's person instead of clustered
+        options["face_sample_path"] = face_sample_path if face_sample_data is not None else None
         
-        image_paths = cluster_by_face(image_paths, output_dir, face_sample_path)
-    
-    # Apply duplicate removal if selected
-    if remove_duplicates_flag:
-        image_paths = remove_duplicates(image_paths, output_dir)
-    
-    # Apply blur removal if selected
-    if remove_blur:
-        image_paths = remove_blur_images(image_paths, output_dir)
-    
-    # Apply bad angle removal if selected
-    if remove_bad_angles_flag:
-        image_paths = remove_bad_angles(image_paths, output_dir)
-    
-    # Apply date sorting if selected
-    if sort_date:
-        image_paths = sort_by_date(image_paths, output_dir)
+        # Let pre-analysis started during upload finish so its results are reused
+        ingestor.wait_for_session(session_id)
+        
+        # Images are read straight from the upload directory; only survivors are written
+        processed_images, stats = run_pipeline(
+            image_paths, output_dir, options,
+            progress=job.update_progress, cancel_event=job.cancel_event,
+            content_hashes=ingestor.content_hashes(session_id),
+            output_mode=output_mode,
+            graph=session_graphs.get(session_id),
+            # Previews render while the rest is written, ready for the result grid
+            on_written=lambda image: thumbnails.generate(session_id, [image["path"]])
+        )
+        return {"session_id": session_id, "processed_images": processed_images, "stats": stats}
     
-    # Apply background removal if selected
-    if remove_background_flag:
-        image_paths = remove_background(image_paths, output_dir)
+    try:
+        job = job_manager.submit(session_id, run_job)
+    except SessionBusy:
+        raise HTTPException(status_code=409, detail="Session is already being processed")
+    except JobQueueFull:
+        raise HTTPException(status_code=503, detail="Too many processing jobs, try again later")
     
-    # Create a list of processed images with metadata
-    processed_images = []
-    for path in image_paths:
-        if os.path.exists(path):
-            filename = os.path.basename(path)
-            stat = os.stat(path)
-            processed_images.append({
-                "filename": filename,
-                "path": path,
-                "size": stat.st_size,
-                "date": datetime.fromtimestamp(stat.st_mtime).isoformat()
-            })
+    return {"job_id": job.id, "session_id": session_id, "status": job.status}
+
+@app.get("/api/jobs/{job_id}")
+async def get_job(job_id: str):
+    """Get the status, per-stage progress and result of a processing job"""
+    job = job_manager.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job.to_dict()
+
+@app.post("/api/jobs/{job_id}/cancel")
+async def cancel_job(job_id: str):
+    """Cancel a queued or running processing job"""
+    job = job_manager.cancel(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job.to_dict()
+
+@app.get("/api/cache")
+async def cache_stats():
+    """Get hit/miss counters and size of the analysis cache"""
+    cache = get_cache()
+    if cache is None:
+        return {"enabled": False}
+    return {"enabled": True, **cache.stats()}
+
+@app.get("/api/storage")
+async def storage_stats():
+    """Get the disk use of upload sessions and what the janitor reclaimed"""
+    return janitor.stats()
+
+@app.get("/api/models")
+async def model_stats():
+    """Get load state, load time and memory use of the shared models"""
+    return registry.stats()
+
+@app.get("/metrics")
+async def prometheus_metrics():
+    """Get stage timings and job, image and cache counters in the Prometheus text format"""
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/api/results/{session_id}/{relative_path:path}")
+async def get_result_file(session_id: str, relative_path: str):
+    """Serve one processed image, whether written to disk or only listed in the manifest"""
+    output_dir = get_output_dir(session_id)
+    path = resolve_output(output_dir, relative_path)
+    if path is None or not os.path.isfile(path):
+        raise HTTPException(status_code=404, detail="Image not found")
+    return FileResponse(path)
+
+@app.get("/api/thumbnails/{session_id}/{size}/{relative_path:path}")
+async def get_thumbnail(
+    session_id: str,
+    size: int,
+    relative_path: str,
+    if_none_match: Optional[str] = Header(None)
+):
+    """Serve a WebP preview of one processed image, at most size pixels on its longer side"""
+    if size not in thumbnails.sizes:
+        raise HTTPException(
+            status_code=400, detail=f"size must be one of {', '.join(str(s) for s in thumbnails.sizes)}"
+        )
+    output_dir = get_output_dir(session_id)
+    path = resolve_output(output_dir, relative_path)
+    if path is None or not os.path.isfile(path):
+        raise HTTPException(status_code=404, detail="Image not found")
     
-    return {"session_id": session_id, "processed_images": processed_images}
+    # Cached previews cost a stat; missing ones are rendered from a reduced decode
+    try:
+        thumbnail_path, etag = await run_in_threadpool(thumbnails.get, path, size)
+    except (ValueError, cv2.error):
+        raise HTTPException(status_code=415, detail="Could not render a preview of this image")
+    headers = {"ETag": etag, "Cache-Control": THUMBNAIL_CACHE_CONTROL}
+    if if_none_match and etag in [tag.strip() for tag in if_none_match.split(",")]:
+        return Response(status_code=304, headers=headers)
+    return FileResponse(thumbnail_path, media_type="image/webp", headers=headers)
 
 @app.get("/api/download/{session_id}")
-async def download_results(session_id: str):
-    """Download processed images as a ZIP file"""
+async def download_results(
+    session_id: str,
+    compress: bool = True,
+    range_header: Optional[str] = Header(None, alias="Range"),
+    if_range: Optional[str] = Header(None)
+):
+    """Download processed images as a ZIP file, streamed while it is built"""
+    # Held until the ZIP is sent, so the janitor cannot trash files mid-stream;
+    # released by whichever comes first, the end of the stream or the response
+    hold = janitor.hold(safe_session_id(session_id))
+    try:
+        archive, headers, status_code = download_archive(session_id, compress, range_header, if_range)
+    except BaseException:
+        hold.release()
+        raise
+    return StreamingResponse(
+        hold.stream(archive), status_code=status_code, media_type="application/zip",
+        headers=headers, background=BackgroundTask(hold.release)
+    )
+
+def download_archive(session_id, compress, range_header, if_range):
+    """The ZIP stream, headers and status code of a download request"""
     # Validate session
-    output_dir = os.path.join(PROCESSED_DIR, session_id)
+    output_dir = get_output_dir(session_id)
     if not os.path.exists(output_dir):
         raise HTTPException(status_code=404, detail="Session not found")
     
-    # Create a temporary ZIP file
-    zip_filename = f"processed_images_{session_id}.zip"
-    zip_path = os.path.join(tempfile.gettempdir(), zip_filename)
-    
-    with zipfile.ZipFile(zip_path, 'w') as zipf:
-        for root, _, files in os.walk(output_dir):
-            for file in files:
-                file_path = os.path.join(root, file)
-                arcname = os.path.relpath(file_path, output_dir)
-                zipf.write(file_path, arcname)
+    # Compressed formats are stored as-is; compress=false stores everything
+    archive = ZipStream(archive_files(output_dir), compress=compress)
+    headers = {"Content-Disposition": f'attachment; filename="processed_images_{session_id}.zip"'}
+    if archive.size is None:
+        # Deflated entries: the length is only known once everything is sent
+        return archive.iter_bytes(), headers, 200
     
-    return FileResponse(
-        path=zip_path,
-        filename=zip_filename,
-        media_type="application/zip"
-    )
+    # Stored entries only: the length is known and downloads can resume
+    size = archive.size
+    start, end = 0, size - 1
+    status_code = 200
+    headers.update({"Accept-Ranges": "bytes", "ETag": archive.etag})
+    match = RANGE_PATTERN.fullmatch(range_header.strip()) if range_header else None
+    if match and any(match.groups()) and (not if_range or if_range == archive.etag):
+        first, last = match.groups()
+        if first:
+            start = int(first)
+            end = min(int(last), size - 1) if last else size - 1
+        else:
+            start = max(0, size - int(last))
+        if start > end:
+            raise HTTPException(
+                status_code=416, detail="Requested range not satisfiable",
+                headers={"Content-Range": f"bytes */{size}"}
+            )
+        status_code = 206
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    headers["Content-Length"] = str(end - start + 1)
+    return archive.iter_bytes(start, end), headers, status_code
 
 @app.on_event("startup")
 def startup_event():
-    """Clean up temporary directories on startup"""
-    for dir_path in [UPLOAD_DIR, PROCESSED_DIR]:
-        if os.path.exists(dir_path):
-            for item in os.listdir(dir_path):
-                item_path = os.path.join(dir_path, item)
-                if os.path.isdir(item_path):
-                    shutil.rmtree(item_path, ignore_errors=True)
-                else:
-                    os.remove(item_path)
+    """Start the session janitor and warm up models on startup"""
+    # Earlier sessions are expired in the background instead of wiped here
+    janitor.start()
+    
+    # Load models in the background; requests arriving meanwhile wait for the same load
+    if settings.WARM_UP_MODELS:
+        threading.Thread(
+            target=registry.warm_up, args=(settings.WARM_UP_MODELS,), daemon=True
+        ).start()
+
+@app.on_event("shutdown")
+def shutdown_event():
+    """Stop background processing jobs and session cleanup"""
+    janitor.stop()
+    job_manager.shutdown()
 
 # Mount static files (for serving the frontend) - moved after API routes
 app.mount("/", StaticFiles(directory=".", html=True), name="static")
@@ -0,0 +1,314 @@
+import os
+import time
+import zlib
+import struct
+import hashlib
+
+from pipeline.output import MANIFEST_FILENAME, read_manifest
+
+# Formats that are already compressed; deflating them only costs CPU
+STORED_EXTENSIONS = {
+    ".jpg", ".jpeg", ".png", ".webp", ".gif", ".heic", ".heif", ".avif",
+    ".zip", ".gz", ".mp4", ".mov",
+}
+
+# Bytes read from a file per step while streaming it into the archive
+ZIP_CHUNK_SIZE = 1024 * 1024
+
+# Values from this size on do not fit the classic 32-bit ZIP fields
+ZIP64_LIMIT = 0xFFFFFFFF
+# Entry count from which the ZIP64 end records are needed
+ZIP64_ENTRY_LIMIT = 0xFFFF
+# Deflated entries from this size on use ZIP64 sizes, leaving headroom for
+# data that deflate makes slightly larger
+ZIP64_DEFLATE_LIMIT = 0xF0000000
+
+_UTF8_FLAG = 0x0800
+_DESCRIPTOR_FLAG = 0x0008
+_STORED = 0
+_DEFLATED = 8
+_FILE_ATTRIBUTES = (0o100644 & 0xFFFF) << 16
+
+
+def _dos_datetime(mtime):
+    t = time.localtime(mtime)
+    if t.tm_year < 1980:
+        return 0, (1 << 5) | 1
+    dos_time = (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2)
+    dos_date = ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+    return dos_time, dos_date
+
+
+class _Entry:
+    def __init__(self, arcname, path, compress):
+        stat = os.stat(path)
+        self.arcname = arcname
+        self.name = arcname.encode("utf-8")
+        self.path = path
+        self.size = stat.st_size
+        self.mtime = stat.st_mtime
+        self.method = _DEFLATED if compress else _STORED
+        self.crc = None
+        self.compressed_size = None if compress else self.size
+        self.offset = None
+
+    @property
+    def zip64(self):
+        if self.method == _DEFLATED:
+            return self.size >= ZIP64_DEFLATE_LIMIT
+        return self.size >= ZIP64_LIMIT
+
+    def local_header(self):
+        dos_time, dos_date = _dos_datetime(self.mtime)
+        extra = b""
+        if self.zip64:
+            # Sizes live in the ZIP64 extra field and the data descriptor
+            known = self.size if self.method == _STORED else 0
+            extra = struct.pack("<HHQQ", 0x0001, 16, known, known)
+            sizes = (0xFFFFFFFF, 0xFFFFFFFF)
+        elif self.method == _STORED:
+            sizes = (self.size, self.size)
+        else:
+            sizes = (0, 0)
+        header = struct.pack(
+            "<IHHHHHIIIHH", 0x04034B50, 45 if self.zip64 else 20,
+            _UTF8_FLAG | _DESCRIPTOR_FLAG, self.method, dos_time, dos_date,
+            0, sizes[0], sizes[1], len(self.name), len(extra),
+        )
+        return header + self.name + extra
+
+    def data_descriptor(self):
+        if self.zip64:
+            return struct.pack("<IIQQ", 0x08074B50, self.crc, self.compressed_size, self.size)
+        return struct.pack("<IIII", 0x08074B50, self.crc, self.compressed_size, self.size)
+
+    def descriptor_size(self):
+        return 24 if self.zip64 else 16
+
+    def central_header(self):
+        dos_time, dos_date = _dos_datetime(self.mtime)
+        fields = []
+        size = self.size
+        compressed_size = self.compressed_size
+        offset = self.offset
+        if self.zip64 or size >= ZIP64_LIMIT or compressed_size >= ZIP64_LIMIT:
+            fields += [size, compressed_size]
+            size = compressed_size = 0xFFFFFFFF
+        if offset >= ZIP64_LIMIT:
+            fields.append(offset)
+            offset = 0xFFFFFFFF
+        extra = b""
+        if fields:
+            extra = struct.pack(f"<HH{len(fields)}Q", 0x0001, 8 * len(fields), *fields)
+        header = struct.pack(
+            "<IHHHHHHIIIHHHHHII", 0x02014B50, (3 << 8) | 45, 45 if extra else 20,
+            _UTF8_FLAG | _DESCRIPTOR_FLAG, self.method, dos_time, dos_date,
+            self.crc, compressed_size, size, len(self.name), len(extra), 0, 0, 0,
+            _FILE_ATTRIBUTES, offset,
+        )
+        return header + self.name + extra
+
+    def central_header_size(self):
+        # Same layout as central_header, without needing the CRC
+        count = 0
+        if self.zip64 or self.size >= ZIP64_LIMIT or self.compressed_size >= ZIP64_LIMIT:
+            count += 2
+        if self.offset >= ZIP64_LIMIT:
+            count += 1
+        return 46 + len(self.name) + (4 + 8 * count if count else 0)
+
+
+def _end_records(entry_count, directory_offset, directory_size):
+    records = b""
+    if (entry_count >= ZIP64_ENTRY_LIMIT or directory_offset >= ZIP64_LIMIT
+            or directory_size >= ZIP64_LIMIT):
+        zip64_end_offset = directory_offset + directory_size
+        records += struct.pack(
+            "<IQHHIIQQQQ", 0x06064B50, 44, (3 << 8) | 45, 45, 0, 0,
+            entry_count, entry_count, directory_size, directory_offset,
+        )
+        records += struct.pack("<IIQI", 0x07064B50, 0, zip64_end_offset, 1)
+        entry_count = min(entry_count, 0xFFFF)
+        directory_offset = min(directory_offset, 0xFFFFFFFF)
+        directory_size = min(directory_size, 0xFFFFFFFF)
+    records += struct.pack(
+        "<IHHHHIIH", 0x06054B50, 0, 0, entry_count, entry_count,
+        directory_size, directory_offset, 0,
+    )
+    return records
+
+
+def _end_records_size(entry_count, directory_offset, directory_size):
+    if (entry_count >= ZIP64_ENTRY_LIMIT or directory_offset >= ZIP64_LIMIT
+            or directory_size >= ZIP64_LIMIT):
+        return 56 + 20 + 22
+    return 22
+
+
+class ZipStream:
+    """
+    A ZIP archive (with ZIP64 where needed) generated while it is sent,
+    without a temporary file.
+
+    files is a list of (arcname, path). Files in already-compressed formats
+    (STORED_EXTENSIONS) are stored; other files are deflated unless
+    compress is False. When nothing is deflated the layout is known up
+    front: size gives the archive's length and iter_bytes can start at any
+    offset, which serves HTTP range requests. Otherwise size is None and the
+    archive can only be streamed from the start.
+    """
+
+    def __init__(self, files, compress=True):
+        self.entries = []
+        for arcname, path in files:
+            deflate = compress and os.path.splitext(arcname)[1].lower() not in STORED_EXTENSIONS
+            self.entries.append(_Entry(arcname, path, deflate))
+        self.size = None
+        if all(entry.method == _STORED for entry in self.entries):
+            self.size = self._layout()
+
+    def _layout(self):
+        offset = 0
+        for entry in self.entries:
+            entry.offset = offset
+            offset += len(entry.local_header()) + entry.size + entry.descriptor_size()
+        directory_size = sum(entry.central_header_size() for entry in self.entries)
+        return offset + directory_size + _end_records_size(len(self.entries), offset, directory_size)
+
+    @property
+    def etag(self):
+        """
+        Validator that changes whenever the archive's bytes would.
+        """
+        digest = hashlib.blake2b(digest_size=16)
+        for entry in self.entries:
+            digest.update(f"{entry.arcname}\0{entry.size}\0{entry.mtime}\0{entry.method}\n".encode("utf-8"))
+        return f'"{digest.hexdigest()}"'
+
+    def _read_stored(self, entry, start=0):
+        # Yields the stored data from `start`; the CRC is only known if read from 0
+        crc = 0
+        remaining = entry.size - start
+        with open(entry.path, "rb") as f:
+            f.seek(start)
+            while remaining > 0:
+                data = f.read(min(ZIP_CHUNK_SIZE, remaining))
+                if not data:
+                    raise IOError(f"{entry.arcname} changed while it was being archived")
+                if start == 0:
+                    crc = zlib.crc32(data, crc)
+                remaining -= len(data)
+                yield data
+        if start == 0:
+            entry.crc = crc
+
+    def _compute_crc(self, entry):
+        if entry.crc is None:
+            for _ in self._read_stored(entry):
+                pass
+        return entry.crc
+
+    def _read_deflated(self, entry):
+        compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+        crc = 0
+        size = compressed_size = 0
+        with open(entry.path, "rb") as f:
+            while True:
+                data = f.read(ZIP_CHUNK_SIZE)
+                if not data:
+                    break
+                crc = zlib.crc32(data, crc)
+                size += len(data)
+                compressed = compressor.compress(data)
+                compressed_size += len(compressed)
+                if compressed:
+                    yield compressed
+        compressed = compressor.flush()
+        compressed_size += len(compressed)
+        if compressed:
+            yield compressed
+        entry.crc = crc
+        entry.size = size
+        entry.compressed_size = compressed_size
+
+    def _parts(self):
+        """
+        Yields (length, produce) for every consecutive part of the archive;
+        produce(skip) yields the part's bytes from offset skip. length is
+        None for parts whose length is only known once they are produced.
+        """
+        offset = 0
+        for entry in self.entries:
+            entry.offset = offset
+            header = entry.local_header()
+            yield len(header), lambda skip, header=header: iter((header[skip:],))
+            offset += len(header)
+            if entry.method == _STORED:
+                yield entry.size, lambda skip, entry=entry: self._read_stored(entry, skip)
+                offset += entry.size
+            else:
+                yield None, lambda skip, entry=entry: self._read_deflated(entry)
+                offset += entry.compressed_size
+
+            def descriptor(skip, entry=entry):
+                self._compute_crc(entry)
+                yield entry.data_descriptor()[skip:]
+            yield entry.descriptor_size(), descriptor
+            offset += entry.descriptor_size()
+
+        directory_offset = offset
+        directory_size = sum(entry.central_header_size() for entry in self.entries)
+
+        def directory(skip):
+            # A range starting late skipped the data of earlier entries
+            for entry in self.entries:
+                self._compute_crc(entry)
+            data = b"".join(entry.central_header() for entry in self.entries)
+            data += _end_records(len(self.entries), directory_offset, directory_size)
+            yield data[skip:]
+        yield directory_size + _end_records_size(len(self.entries), directory_offset, directory_size), directory
+
+    def iter_bytes(self, start=0, end=None):
+        """
+        Yields the archive's bytes from start up to and including end (the
+        whole archive by default). Starting past 0 requires a known size.
+        """
+        if start and self.size is None:
+            raise ValueError("Only archives of stored entries can start at an offset")
+        position = 0
+        for length, produce in self._parts():
+            if end is not None and position > end:
+                return
+            if length is not None and position + length <= start:
+                # Before the requested range; nothing to read
+                position += length
+                continue
+            skip = max(0, start - position)
+            position += skip
+            for data in produce(skip):
+                if end is not None:
+                    data = data[:end + 1 - position]
+                if data:
+                    yield data
+                position += len(data)
+                if end is not None and position > end:
+                    return
+
+
+def archive_files(output_dir):
+    """
+    The (arcname, path) pairs of a processed session in a stable order:
+    files written to output_dir, plus outputs that were only listed in the
+    manifest, read from their source.
+    """
+    files = {}
+    for root, _, names in os.walk(output_dir):
+        for name in names:
+            path = os.path.join(root, name)
+            arcname = os.path.relpath(path, output_dir).replace(os.sep, "/")
+            if arcname != MANIFEST_FILENAME:
+                files[arcname] = path
+    for entry in read_manifest(output_dir):
+        if not entry["written"] and os.path.exists(entry["source"]):
+            files.setdefault(entry["relative_path"], entry["source"])
+    return sorted(files.items())
@@ -0,0 +1,421 @@
+"""
+Task queues of the "broker" executor.
+
+Tasks and results cross the broker as pickles, and unpickling runs code:
+whoever can write to a broker can run code in every worker and in the
+coordinator. A broker is therefore a trust boundary. SQLiteBroker creates
+its file readable and writable by its owner only; share it only between
+processes of one user (or one trusted group), and never point BROKER_URL
+at a file that others can write.
+"""
+import os
+import time
+import uuid
+import pickle
+import socket
+import sqlite3
+import logging
+import threading
+from collections import OrderedDict
+import concurrent.futures
+from concurrent.futures import Executor, Future
+
+from pipeline import settings
+
+# Seconds a worker waits for a task before checking whether to stop
+CLAIM_TIMEOUT = 1.0
+
+# Tasks left in a queue file this long are dropped when an executor opens
+# it; their coordinator is gone, so nobody would collect their results
+STALE_TASK_SECONDS = 24 * 3600
+
+# Task ids per query when collecting results from a queue file, below
+# SQLite's limit on bound parameters
+_IDS_PER_QUERY = 500
+
+# Permissions of a new queue file: owner only, as its pickles are run.
+# SQLite gives the -wal and -shm files the same permissions
+_QUEUE_FILE_MODE = 0o600
+
+logger = logging.getLogger(__name__)
+
+
+class Broker:
+    """
+    Task queue between a coordinator and the workers pulling its work.
+
+    Tasks and results are opaque bytes, keyed by an id the coordinator
+    picks, so a backend only stores and moves bytes; a networked broker
+    implements the same methods. A claimed task is leased to its worker:
+    when it is not completed within lease_seconds it is handed out again.
+    """
+
+    def put(self, task_id, payload):
+        raise NotImplementedError
+
+    def claim(self, worker_id, timeout=0.0):
+        """
+        Leases the oldest waiting task to worker_id and returns (task_id,
+        payload), or None when no task arrives within timeout seconds.
+        """
+        raise NotImplementedError
+
+    def complete(self, task_id, result):
+        """
+        Stores the result of a claimed task. Ignored for cancelled tasks.
+        """
+        raise NotImplementedError
+
+    def take_results(self, task_ids, timeout=0.0):
+        """
+        Removes and returns {task_id: result} for the finished tasks among
+        task_ids, waiting up to timeout seconds for at least one.
+        """
+        raise NotImplementedError
+
+    def cancel(self, task_id):
+        """
+        Forgets a task, whatever its state; a worker running it finishes
+        but its result is dropped. Returns True if no worker had claimed it.
+        """
+        raise NotImplementedError
+
+    def purge(self, max_age):
+        """
+        Drops tasks submitted more than max_age seconds ago.
+        """
+
+    def stats(self):
+        """
+        Number of tasks by state: queued, running and done.
+        """
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class InProcessBroker(Broker):
+    """
+    Broker held in memory, for workers that are threads of the coordinator.
+    """
+
+    def __init__(self, lease_seconds=None):
+        self.lease_seconds = lease_seconds or settings.BROKER_LEASE_SECONDS
+        self._queued = OrderedDict()
+        self._running = {}
+        self._done = {}
+        self._condition = threading.Condition()
+
+    def put(self, task_id, payload):
+        with self._condition:
+            self._queued[task_id] = payload
+            self._condition.notify_all()
+
+    def _requeue_expired(self):
+        now = time.monotonic()
+        for task_id, (payload, _, leased_until) in list(self._running.items()):
+            if leased_until < now:
+                del self._running[task_id]
+                self._queued[task_id] = payload
+
+    def claim(self, worker_id, timeout=0.0):
+        with self._condition:
+            self._requeue_expired()
+            if not self._queued:
+                self._condition.wait(timeout)
+                self._requeue_expired()
+                if not self._queued:
+                    return None
+            task_id, payload = self._queued.popitem(last=False)
+            self._running[task_id] = (payload, worker_id, time.monotonic() + self.lease_seconds)
+            return task_id, payload
+
+    def complete(self, task_id, result):
+        with self._condition:
+            if self._running.pop(task_id, None) is not None:
+                self._done[task_id] = result
+                self._condition.notify_all()
+
+    def take_results(self, task_ids, timeout=0.0):
+        with self._condition:
+            self._condition.wait_for(lambda: any(task_id in self._done for task_id in task_ids), timeout)
+            return {task_id: self._done.pop(task_id) for task_id in task_ids if task_id in self._done}
+
+    def cancel(self, task_id):
+        with self._condition:
+            queued = self._queued.pop(task_id, None) is not None
+            self._running.pop(task_id, None)
+            self._done.pop(task_id, None)
+            return queued
+
+    def stats(self):
+        with self._condition:
+            return {"queued": len(self._queued), "running": len(self._running), "done": len(self._done)}
+
+
+class SQLiteBroker(Broker):
+    """
+    Broker kept in a SQLite file, shared by the coordinator and worker
+    processes on the same machine, or any mounting the same file system.
+    Workers poll it every poll_seconds while it is empty. The file is
+    created owner-only; anyone able to write it can run code in the
+    processes using it (see the module docstring).
+    """
+
+    def __init__(self, path, lease_seconds=None, poll_seconds=None):
+        self.path = path
+        self.lease_seconds = lease_seconds or settings.BROKER_LEASE_SECONDS
+        self.poll_seconds = poll_seconds or settings.BROKER_POLL_SECONDS
+        self._local = threading.local()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._create_private(path)
+        conn = self._conn()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS tasks ("
+            " id TEXT PRIMARY KEY, state TEXT NOT NULL, payload BLOB, result BLOB,"
+            " worker TEXT, leased_until REAL, created REAL NOT NULL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS tasks_state ON tasks (state)")
+
+    @staticmethod
+    def _create_private(path):
+        # Created before SQLite opens it, which would use the umask
+        try:
+            os.close(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, _QUEUE_FILE_MODE))
+        except FileExistsError:
+            if os.stat(path).st_mode & 0o022:
+                logger.warning(f"Broker queue {path} is writable by other users, who can run code in its workers")
+
+    def _conn(self):
+        # Connections cannot be shared across threads; every thread opens its own
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def put(self, task_id, payload):
+        self._conn().execute(
+            "INSERT INTO tasks (id, state, payload, created) VALUES (?, 'queued', ?, ?)",
+            (task_id, payload, time.time())
+        )
+
+    def _claim_once(self, worker_id):
+        conn = self._conn()
+        now = time.time()
+        # Taking the write lock first keeps two workers from claiming one task
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT id, payload FROM tasks"
+                " WHERE state = 'queued' OR (state = 'running' AND leased_until < ?)"
+                " ORDER BY rowid LIMIT 1",
+                (now,)
+            ).fetchone()
+            if row is not None:
+                conn.execute(
+                    "UPDATE tasks SET state = 'running', worker = ?, leased_until = ? WHERE id = ?",
+                    (worker_id, now + self.lease_seconds, row[0])
+                )
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return row
+
+    def claim(self, worker_id, timeout=0.0):
+        deadline = time.monotonic() + timeout
+        while True:
+            row = self._claim_once(worker_id)
+            if row is not None or time.monotonic() >= deadline:
+                return row
+            time.sleep(self.poll_seconds)
+
+    def complete(self, task_id, result):
+        self._conn().execute(
+            "UPDATE tasks SET state = 'done', result = ?, payload = NULL WHERE id = ?",
+            (result, task_id)
+        )
+
+    def take_results(self, task_ids, timeout=0.0):
+        conn = self._conn()
+        deadline = time.monotonic() + timeout
+        task_ids = list(task_ids)
+        while True:
+            results = {}
+            for start in range(0, len(task_ids), _IDS_PER_QUERY):
+                ids = task_ids[start:start + _IDS_PER_QUERY]
+                placeholders = ",".join("?" * len(ids))
+                results.update(conn.execute(
+                    f"SELECT id, result FROM tasks WHERE state = 'done' AND id IN ({placeholders})", ids
+                ).fetchall())
+            if results:
+                ids = list(results)
+                for start in range(0, len(ids), _IDS_PER_QUERY):
+                    chunk = ids[start:start + _IDS_PER_QUERY]
+                    conn.execute(f"DELETE FROM tasks WHERE id IN ({','.join('?' * len(chunk))})", chunk)
+                return results
+            if time.monotonic() >= deadline:
+                return results
+            time.sleep(self.poll_seconds)
+
+    def cancel(self, task_id):
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT state FROM tasks WHERE id = ?", (task_id,)).fetchone()
+            conn.execute("DELETE FROM tasks WHERE id = ?", (task_id,))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return row is not None and row[0] == "queued"
+
+    def purge(self, max_age):
+        deleted = self._conn().execute("DELETE FROM tasks WHERE created < ?", (time.time() - max_age,)).rowcount
+        if deleted:
+            logger.info(f"Dropped {deleted} stale tasks from {self.path}")
+
+    def stats(self):
+        counts = dict(self._conn().execute("SELECT state, COUNT(*) FROM tasks GROUP BY state").fetchall())
+        return {state: counts.get(state, 0) for state in ("queued", "running", "done")}
+
+    def close(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+
+def open_broker(url=None):
+    """
+    Returns the broker for url (settings.BROKER_URL by default):
+    "memory://" or "sqlite:///path" ("sqlite:////abs/path" for an
+    absolute path).
+    """
+    url = url or settings.BROKER_URL
+    if url == "memory://":
+        return InProcessBroker()
+    if url.startswith("sqlite:///"):
+        return SQLiteBroker(url[len("sqlite:///"):])
+    raise ValueError(f"Unsupported broker URL: {url}")
+
+
+def run_worker(broker, worker_id=None, stop_event=None):
+    """
+    Runs the tasks of broker until stop_event is set. A task is a pickled
+    (function, args, kwargs); its result is stored as a pickled (True,
+    value), or (False, exception) when the function raised. Payloads are
+    unpickled as they come, so only run workers on a trusted broker.
+    """
+    worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}-{threading.get_ident()}"
+    while stop_event is None or not stop_event.is_set():
+        task = broker.claim(worker_id, CLAIM_TIMEOUT)
+        if task is None:
+            continue
+        task_id, payload = task
+        try:
+            func, args, kwargs = pickle.loads(payload)
+            outcome = (True, func(*args, **kwargs))
+        except Exception as e:
+            outcome = (False, e)
+        try:
+            result = pickle.dumps(outcome, protocol=pickle.HIGHEST_PROTOCOL)
+        except Exception as e:
+            result = pickle.dumps((False, RuntimeError(f"Could not send the result of task {task_id}: {e}")))
+        broker.complete(task_id, result)
+
+
+class BrokerExecutor(Executor):
+    """
+    Executor whose tasks are queued on a broker and run by whichever
+    workers pull them; with local_workers, that many worker threads of
+    this process pull them too. Functions and arguments are pickled, as
+    with a process pool. A future stays pending until its result arrives,
+    so cancelling it also drops a task already running.
+    """
+
+    def __init__(self, broker, local_workers=0):
+        self.broker = broker
+        self.broker.purge(STALE_TASK_SECONDS)
+        self._futures = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._threads = [threading.Thread(target=self._collect, name="broker-collector", daemon=True)]
+        for index in range(local_workers):
+            self._threads.append(threading.Thread(
+                target=run_worker, args=(broker, f"{os.getpid()}-local-{index}", self._stop),
+                name=f"broker-worker-{index}", daemon=True
+            ))
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, fn, /, *args, **kwargs):
+        if self._stop.is_set():
+            raise RuntimeError("cannot schedule new futures after shutdown")
+        payload = pickle.dumps((fn, args, kwargs), protocol=pickle.HIGHEST_PROTOCOL)
+        task_id = uuid.uuid4().hex
+        future = Future()
+        # Registered before queuing, so even an immediate result finds it
+        with self._lock:
+            self._futures[task_id] = future
+        self.broker.put(task_id, payload)
+        future.add_done_callback(lambda f: self._cancelled(task_id, f))
+        return future
+
+    def _cancelled(self, task_id, future):
+        if future.cancelled():
+            with self._lock:
+                self._futures.pop(task_id, None)
+            try:
+                self.broker.cancel(task_id)
+            except Exception as e:
+                logger.warning(f"Could not cancel task {task_id}: {e}")
+
+    def _collect(self):
+        poll = settings.BROKER_POLL_SECONDS
+        while not self._stop.is_set():
+            with self._lock:
+                task_ids = list(self._futures)
+            if not task_ids:
+                self._stop.wait(poll)
+                continue
+            try:
+                results = self.broker.take_results(task_ids, poll)
+            except Exception as e:
+                logger.warning(f"Could not collect results from the broker: {e}")
+                self._stop.wait(CLAIM_TIMEOUT)
+                continue
+            for task_id, result in results.items():
+                with self._lock:
+                    future = self._futures.pop(task_id, None)
+                if future is None or not future.set_running_or_notify_cancel():
+                    continue
+                try:
+                    ok, value = pickle.loads(result)
+                except Exception as e:
+                    future.set_exception(e)
+                    continue
+                if ok:
+                    future.set_result(value)
+                else:
+                    future.set_exception(value)
+
+    def shutdown(self, wait=True, *, cancel_futures=False):
+        with self._lock:
+            futures = list(self._futures.values())
+        if cancel_futures:
+            for future in futures:
+                future.cancel()
+        elif wait:
+            # Results still arrive while waiting; the collector keeps running
+            concurrent.futures.wait(futures)
+        self._stop.set()
+        if wait:
+            for thread in self._threads:
+                thread.join()
@@ -0,0 +1,165 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
+from pipeline import settings
+
+# Check the cache size after this many inserts on a connection
+EVICTION_CHECK_INTERVAL = 100
+
+# Evict down to this fraction of the size cap
+EVICTION_TARGET = 0.9
+
+
+def encode_json_value(value):
+    """
+    json.dumps default for cached values: datetimes become tagged objects.
+    """
+    if isinstance(value, datetime):
+        return {"__datetime__": value.isoformat()}
+    raise TypeError(f"Cannot cache value of type {type(value).__name__}")
+
+
+def decode_json_object(obj):
+    """
+    json.loads object_hook reversing encode_json_value.
+    """
+    if "__datetime__" in obj:
+        return datetime.fromisoformat(obj["__datetime__"])
+    return obj
+
+
+class AnalysisCache:
+    """
+    On-disk store of per-image analysis results.
+
+    Entries are keyed by the content hash of the file plus the stage's
+    analysis version, so results survive across sessions and renames and are
+    recomputed when an algorithm or its parameters change. The store is a
+    SQLite database in WAL mode, safe to share between worker processes;
+    each thread gets its own connection. When the stored values exceed
+    max_bytes the least recently used entries are evicted.
+    """
+
+    def __init__(self, path, max_bytes=None):
+        self.path = path
+        self.max_bytes = max_bytes or settings.ANALYSIS_CACHE_MAX_BYTES
+        self.hits = 0
+        self.misses = 0
+        self._local = threading.local()
+        self._counter_lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                " key TEXT PRIMARY KEY,"
+                " value TEXT NOT NULL,"
+                " size INTEGER NOT NULL,"
+                " last_used REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used)")
+            self._local.conn = conn
+            self._local.inserts = 0
+        return conn
+
+    @staticmethod
+    def make_key(content_hash, version):
+        return f"{content_hash}:{version}"
+
+    def get(self, content_hash, version):
+        """
+        Returns the cached dict for this content and analysis version, or None.
+        """
+        key = self.make_key(content_hash, version)
+        conn = self._connect()
+        row = conn.execute("SELECT value FROM entries WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        conn.execute("UPDATE entries SET last_used = ? WHERE key = ?", (time.time(), key))
+        return json.loads(row[0], object_hook=decode_json_object)
+
+    def put(self, content_hash, version, values):
+        """
+        Stores a dict of JSON-serializable values (datetimes allowed).
+        """
+        key = self.make_key(content_hash, version)
+        value = json.dumps(values, default=encode_json_value)
+        conn = self._connect()
+        conn.execute(
+            "INSERT OR REPLACE INTO entries (key, value, size, last_used) VALUES (?, ?, ?, ?)",
+            (key, value, len(key) + len(value), time.time()),
+        )
+        self._local.inserts += 1
+        if self._local.inserts % EVICTION_CHECK_INTERVAL == 0:
+            self.evict()
+
+    def evict(self):
+        """
+        Deletes least recently used entries until the store is under its cap.
+        Returns the number of entries removed.
+        """
+        conn = self._connect()
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        if total <= self.max_bytes:
+            return 0
+        excess = total - int(self.max_bytes * EVICTION_TARGET)
+        freed = 0
+        rows = conn.execute("SELECT key, size FROM entries ORDER BY last_used").fetchall()
+        doomed = []
+        for key, size in rows:
+            if freed >= excess:
+                break
+            doomed.append((key,))
+            freed += size
+        conn.execute("BEGIN")
+        conn.executemany("DELETE FROM entries WHERE key = ?", doomed)
+        conn.execute("COMMIT")
+        return len(doomed)
+
+    def record(self, hits, misses):
+        """
+        Adds hit/miss counts. Lookups often happen in worker processes, so
+        callers report their counts here rather than get() counting itself.
+        """
+        with self._counter_lock:
+            self.hits += hits
+            self.misses += misses
+
+    def stats(self):
+        conn = self._connect()
+        entries, size = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries").fetchone()
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "entries": entries,
+            "bytes": size,
+            "max_bytes": self.max_bytes,
+        }
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache():
+    """
+    Returns the process-wide analysis cache, or None if it is disabled.
+    """
+    global _cache
+    if not settings.ANALYSIS_CACHE_PATH:
+        return None
+    with _cache_lock:
+        if _cache is None:
+            _cache = AnalysisCache(settings.ANALYSIS_CACHE_PATH)
+        return _cache
@@ -0,0 +1,139 @@
+import os
+import argparse
+import mimetypes
+from time import perf_counter
+
+from pipeline import settings
+from pipeline.engine import run_pipeline, STAGE_OPTIONS
+from pipeline.executor import shutdown_pools
+from pipeline.incremental import JournaledGraph
+from pipeline.metrics import configure_logging
+from pipeline.output import OUTPUT_MODES, CUTOUT_FORMATS
+
+# Folder inside the input tree that --in-place writes to; never scanned
+IN_PLACE_DIRNAME = "_processed"
+
+# Checkpoint journal kept in the output folder unless --journal is given
+JOURNAL_FILENAME = ".checkpoint.jsonl"
+
+# Seconds between two progress lines of the same phase
+PROGRESS_INTERVAL = 10
+
+
+def scan_images(root, skip=()):
+    """
+    Paths of the image files under root, in a stable order. Hidden files
+    and folders, and the folders in skip (such as the output folder), are
+    left out.
+    """
+    skip = {os.path.abspath(path) for path in skip}
+    paths = []
+    for directory, dirnames, filenames in os.walk(root):
+        dirnames[:] = sorted(
+            name for name in dirnames
+            if not name.startswith(".") and os.path.abspath(os.path.join(directory, name)) not in skip
+        )
+        for name in sorted(filenames):
+            mime_type, _ = mimetypes.guess_type(name)
+            if not name.startswith(".") and mime_type and mime_type.startswith("image/"):
+                paths.append(os.path.join(directory, name))
+    return paths
+
+
+class ProgressPrinter:
+    """
+    Progress callback for run_pipeline that prints a line per phase at
+    most every interval seconds, and when a phase completes.
+    """
+
+    def __init__(self, interval=PROGRESS_INTERVAL):
+        self.interval = interval
+        self._last = {}
+
+    def __call__(self, phase, done, total):
+        now = perf_counter()
+        if done == total or now - self._last.get(phase, 0.0) >= self.interval:
+            self._last[phase] = now
+            print(f"  {phase}: {done}/{total}", flush=True)
+
+
+def _print_summary(stats, elapsed):
+    total = stats["total_images"]
+    rate = total / elapsed if elapsed else 0.0
+    print(f"{total} images in {elapsed:.1f}s ({rate:.1f} images/s), "
+          f"{stats['processed_images']} kept, {stats['errors']} errors")
+    removed = {key: value for key, value in stats.items() if key.endswith("_removed")}
+    if removed:
+        print("  " + ", ".join(f"{key.replace('_', ' ')}: {value}" for key, value in removed.items()))
+    if stats.get("reused_analyses"):
+        print(f"  {stats['reused_analyses']} analyses resumed from the journal")
+    print(f"  stage order: {', '.join(stats['plan'])}")
+    for stage, spans in stats["timings"].items():
+        print(f"  {stage:<20}" + ", ".join(f"{span} {seconds:.1f}s" for span, seconds in spans.items()))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m pipeline",
+        description="Run the image pipeline over a directory tree, resuming an interrupted run"
+    )
+    parser.add_argument("input_dir")
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument("--output", help="folder the kept images are placed in, by feature folder and "
+                                         "path relative to input_dir")
+    target.add_argument("--in-place", action="store_true",
+                        help=f"place the kept images inside input_dir, under {IN_PLACE_DIRNAME}")
+    for name in STAGE_OPTIONS:
+        parser.add_argument("--" + name.replace("_", "-"), action="store_true")
+    parser.add_argument("--face-sample", help="with --cluster-face, keep only images showing this person")
+    parser.add_argument("--background-format", choices=list(CUTOUT_FORMATS))
+    parser.add_argument("--output-mode", choices=list(OUTPUT_MODES), help="defaults to OUTPUT_MODE")
+    parser.add_argument("--executor", choices=["process", "thread", "serial", "broker"], help="defaults to IMAGE_EXECUTOR")
+    parser.add_argument("--workers", type=int, help="defaults to IMAGE_WORKERS")
+    parser.add_argument("--journal", help=f"checkpoint journal (default: {JOURNAL_FILENAME} in the output folder)")
+    parser.add_argument("--restart", action="store_true", help="discard the journal of an earlier run")
+    args = parser.parse_args(argv)
+
+    if not os.path.isdir(args.input_dir):
+        parser.error(f"not a directory: {args.input_dir}")
+    if not any(getattr(args, name) for name in STAGE_OPTIONS):
+        parser.error("enable at least one feature")
+    if args.face_sample and not os.path.isfile(args.face_sample):
+        parser.error(f"face sample not found: {args.face_sample}")
+
+    configure_logging()
+    if args.executor:
+        settings.EXECUTOR_KIND = args.executor
+    if args.workers:
+        settings.WORKER_COUNT = args.workers
+
+    output_dir = os.path.join(args.input_dir, IN_PLACE_DIRNAME) if args.in_place else args.output
+    os.makedirs(output_dir, exist_ok=True)
+    journal_path = args.journal or os.path.join(output_dir, JOURNAL_FILENAME)
+    if args.restart and os.path.exists(journal_path):
+        os.remove(journal_path)
+
+    # Results of --in-place runs are never inputs, whichever mode this run uses
+    paths = scan_images(args.input_dir, skip=[output_dir, os.path.join(args.input_dir, IN_PLACE_DIRNAME)])
+    # Kept images keep their place in the tree, so equal names never collide
+    output_names = {path: os.path.relpath(path, args.input_dir) for path in paths}
+    options = {name: getattr(args, name) for name in STAGE_OPTIONS}
+    options.update(face_sample_path=args.face_sample, background_format=args.background_format)
+
+    graph = JournaledGraph(journal_path)
+    print(f"{len(paths)} images under {args.input_dir}"
+          + (f", resuming from {graph.loaded} journaled results" if graph.loaded else ""), flush=True)
+    start = perf_counter()
+    try:
+        _, stats = run_pipeline(
+            paths, output_dir, options, progress=ProgressPrinter(),
+            output_mode=args.output_mode, graph=graph, output_names=output_names
+        )
+    except KeyboardInterrupt:
+        print(f"Interrupted; run the same command again to resume from {journal_path}")
+        return 130
+    finally:
+        graph.close()
+        shutdown_pools()
+    _print_summary(stats, perf_counter() - start)
+    return 0
@@ -0,0 +1,835 @@
+import os
+import logging
+import functools
+import threading
+from time import perf_counter
+from datetime import datetime
+
+from pipeline import settings
+from pipeline.frame import ImageFrame
+from pipeline.executor import iter_images, ImageError
+from pipeline.cache import get_cache
+from pipeline.output import link_or_copy, materialize, write_manifest, read_manifest
+from pipeline.models import get_model
+from pipeline.metrics import metrics, SpanTimer, add_spans
+from pipeline.planner import plan_stages, stage_estimates
+from features.face_detection import analyze_face_detections, face_detection_version
+from features.face_cluster import (
+    analyze_face_embeddings, has_faces, select_with_faces, frame_face_folder, face_embedder_available,
+    face_embedding_version, face_selection_version
+)
+from features.remove_duplicates import analyze_hashes, analyze_hash_batch, select_unique, HASH_ANALYSIS_VERSION
+from features.remove_blur import analyze_blur, analyze_blur_batch, is_sharp, BLUR_ANALYSIS_VERSION
+from features.remove_bad_angles import has_good_angle
+from features.sort_by_date import (
+    analyze_date, select_by_date, frame_date_folder, DATE_ANALYSIS_VERSION
+)
+
+# Feature flags understood by build_stages, in declared order: the output
+# folder comes from the last enabled one, whatever order the planner runs them in
+STAGE_OPTIONS = [
+    "cluster_face",
+    "remove_duplicates",
+    "remove_blur",
+    "remove_bad_angles",
+    "sort_date",
+    "remove_background",
+]
+
+logger = logging.getLogger(__name__)
+
+
+class PipelineCancelled(Exception):
+    """
+    Raised by run_pipeline when its cancel event is set.
+    """
+
+
+class Stage:
+    """
+    One pipeline step.
+
+    analyze(frame) computes the stage's compact per-image result into
+    frame.summary while the frame's pixels are decoded. keep(frame) is a
+    per-image predicate on the summary, evaluated right after the analysis:
+    an image it rejects is not analyzed any further. select(frames) returns
+    the frames to keep, in order, for decisions that look at all images;
+    prefilter marks a cheap select that only drops frames, run on every
+    image before the predicates so they see fewer images. subdir is the output folder for
+    survivors (a string, or a callable taking the frame). Stages that change
+    pixels replace the plain file copy with write_batch(pairs), which writes
+    up to batch_size (src, dst) pairs and returns None or an exception per
+    pair; rename(filename) gives their output name and output_version
+    identifies what they render, for reusing outputs across runs.
+
+    analyze_batch(frames), when set, does analyze's work for several frames
+    at once, for analyses that vectorize across images; it is used for the
+    images of a worker's batch whose results are not cached.
+
+    When cache_version is set, the summary keys listed in cache_fields are
+    cached by file content under that version and analyze is skipped on a hit.
+    requires names stages whose summary fields analyze or keep reads.
+    select_version identifies parameters of select beyond the analysis, so
+    that memoized selections are only reused when they match.
+    """
+
+    def __init__(self, name, subdir, analyze=None, keep=None, select=None, prefilter=False,
+                 stat_key=None, write_batch=None, batch_size=1, rename=None, output_version=None,
+                 cache_version=None, cache_fields=(), requires=(), select_version=None,
+                 analyze_batch=None):
+        self.name = name
+        self.subdir = subdir
+        self.analyze = analyze
+        self.analyze_batch = analyze_batch
+        self.keep = keep
+        self.select = select
+        self.prefilter = prefilter
+        self.stat_key = stat_key
+        self.write_batch = write_batch
+        self.batch_size = batch_size
+        self.rename = rename
+        self.output_version = output_version
+        self.cache_version = cache_version
+        self.cache_fields = cache_fields
+        self.requires = requires
+        self.select_version = select_version
+
+    def output_subdir(self, frame):
+        if callable(self.subdir):
+            return self.subdir(frame)
+        return self.subdir
+
+
+def _decode_version(version):
+    # Results from full-resolution decodes differ from proxy ones; cache apart
+    return version if settings.PROXY_DECODING else f"{version}:full"
+
+
+def build_stages(options):
+    """
+    Builds the enabled stages, in declared order; plan_stages decides the
+    order they run in. options maps the names in STAGE_OPTIONS to booleans.
+    """
+    stages = []
+    if options.get("cluster_face") or options.get("remove_bad_angles"):
+        # Faces are detected once per image for every face feature, on a
+        # decode fine enough for the smallest faces one of them needs
+        small_faces = bool(options.get("cluster_face"))
+        stages.append(Stage(
+            "detect_faces", None,
+            analyze=lambda frame: analyze_face_detections(
+                frame, get_model("face_detector"), small_faces),
+            cache_version=_decode_version(face_detection_version(small_faces)),
+            cache_fields=("faces", "face_landmarks", "face_image_size"),
+        ))
+    if options.get("cluster_face"):
+        sample_path = options.get("face_sample_path")
+        if face_embedder_available():
+            # Faces are embedded and grouped by identity, one folder per person.
+            # Embedding is a stage of its own so only images every predicate
+            # kept are embedded
+            embedding_version = _decode_version(f"{face_detection_version()}:{face_embedding_version()}")
+            stages.append(Stage(
+                "embed_faces", None,
+                analyze=lambda frame: analyze_face_embeddings(frame, get_model("face_embedder")),
+                cache_version=embedding_version,
+                cache_fields=("face_embeddings",), requires=("detect_faces",),
+            ))
+            stages.append(Stage(
+                "cluster_face", frame_face_folder,
+                keep=has_faces,
+                select=functools.partial(select_with_faces, sample_path=sample_path),
+                requires=("detect_faces",),
+                select_version=f"{face_selection_version(sample_path)}:{embedding_version}",
+            ))
+        else:
+            stages.append(Stage(
+                "cluster_face", "images_with_faces", keep=has_faces, requires=("detect_faces",),
+            ))
+    if options.get("remove_duplicates"):
+        stages.append(Stage(
+            "remove_duplicates", "unique_images",
+            analyze=analyze_hashes, analyze_batch=analyze_hash_batch, select=select_unique, prefilter=True,
+            stat_key="duplicates_removed",
+            cache_version=_decode_version(HASH_ANALYSIS_VERSION), cache_fields=("dhash", "phash"),
+        ))
+    if options.get("remove_blur"):
+        stages.append(Stage(
+            "remove_blur", "sharp_images",
+            analyze=analyze_blur, analyze_batch=analyze_blur_batch, keep=is_sharp,
+            stat_key="blur_removed",
+            cache_version=_decode_version(BLUR_ANALYSIS_VERSION), cache_fields=("blur_score", "is_blurry"),
+        ))
+    if options.get("remove_bad_angles"):
+        stages.append(Stage(
+            "remove_bad_angles", "good_angles",
+            keep=has_good_angle,
+            stat_key="bad_angles_removed", requires=("detect_faces",),
+        ))
+    if options.get("sort_date"):
+        stages.append(Stage(
+            "sort_date", frame_date_folder,
+            analyze=analyze_date, select=select_by_date,
+            cache_version=DATE_ANALYSIS_VERSION, cache_fields=("exif_date",),
+        ))
+    if options.get("remove_background"):
+        # Imported lazily: loading rembg is expensive and only this stage needs it
+        from features.remove_background import remove_backgrounds, nobg_filename
+        output_format = options.get("background_format") or settings.BACKGROUND_FORMAT
+        stages.append(Stage(
+            "remove_background", "no_background",
+            write_batch=functools.partial(
+                remove_backgrounds,
+                threads=options.get("background_threads"),
+                output_format=output_format,
+            ),
+            batch_size=options.get("background_batch_size") or settings.BACKGROUND_BATCH_SIZE,
+            rename=lambda filename: nobg_filename(filename, output_format),
+            output_version=f"{settings.REMBG_MODEL}:{output_format}",
+        ))
+    return stages
+
+
+# Analysis stages built once per worker thread/process, keyed by options
+_local = threading.local()
+
+
+def _analysis_stages(options):
+    """
+    The stages of options that run per image, by name, in declared order.
+    """
+    key = tuple(sorted((name, bool(options.get(name))) for name in STAGE_OPTIONS))
+    cache = getattr(_local, "stages", None)
+    if cache is None:
+        cache = _local.stages = {}
+    if key not in cache:
+        # Background removal has no analysis step; don't load rembg in workers
+        analysis_options = dict(options, remove_background=False)
+        cache[key] = {s.name: s for s in build_stages(analysis_options) if s.analyze or s.keep}
+    return cache[key]
+
+
+def _analyzed(frame, stage):
+    # Fields memoized by an earlier run arrive with the work item
+    return bool(stage.cache_fields) and all(field in frame.summary for field in stage.cache_fields)
+
+
+def _cached_analysis(cache, frame, stage):
+    try:
+        return cache.get(frame.content_hash, stage.cache_version)
+    except Exception as e:
+        logger.warning(f"Analysis cache lookup failed for {frame.filename}: {e}")
+        return None
+
+
+def _store_analysis(cache, frame, stage):
+    try:
+        values = {field: frame.summary[field] for field in stage.cache_fields}
+        cache.put(frame.content_hash, stage.cache_version, values)
+    except Exception as e:
+        logger.warning(f"Analysis cache update failed for {frame.filename}: {e}")
+
+
+class _ImageAnalysis:
+    """
+    The analysis of one item of analyze_images: its frame, the stages it
+    still has to run, in order, and what running them recorded.
+    """
+
+    def __init__(self, item, stages, cache):
+        path, content_hash = item[:2]
+        self.planned = len(item) > 2
+        if self.planned:
+            self.run = [stages[name] for name in item[2]]
+        else:
+            self.run = [s for s in stages.values() if s.analyze]
+        self.frame = ImageFrame(path, content_hash)
+        if self.planned:
+            self.frame.summary.update(item[3])
+        self.cache = cache
+        self.position = 0
+        self.hits = self.misses = 0
+        self.timer = SpanTimer()
+        self.failed = []
+
+    def _uses_cache(self, stage):
+        return self.cache is not None and stage.cache_version is not None
+
+    def _next(self, stage):
+        # Past stage, or past the end when its predicate rejects the image
+        if self.planned and stage.keep is not None and not stage.keep(self.frame):
+            self.position = len(self.run)
+        else:
+            self.position += 1
+
+    def advance(self):
+        """
+        Runs the stages in order until one with analyze_batch has to compute
+        its result, and returns that stage, or None once every stage ran.
+        """
+        frame = self.frame
+        while self.position < len(self.run):
+            stage = self.run[self.position]
+            if stage.analyze and not _analyzed(frame, stage):
+                use_cache = self._uses_cache(stage)
+                start, decoded = perf_counter(), frame.decode_seconds
+                span = "compute"
+                try:
+                    cached = _cached_analysis(self.cache, frame, stage) if use_cache else None
+                    if cached is not None:
+                        frame.summary.update(cached)
+                        self.hits += 1
+                        span = "cache"
+                    else:
+                        if use_cache:
+                            self.misses += 1
+                        if stage.analyze_batch is not None:
+                            # Computed with the other images of the batch that reach it
+                            return stage
+                        stage.analyze(frame)
+                        if use_cache:
+                            _store_analysis(self.cache, frame, stage)
+                except Exception as e:
+                    logger.warning(f"Error processing {frame.filename} in {stage.name}: {e}")
+                    self.failed.append(stage.name)
+                finally:
+                    self.add_time(stage, span, perf_counter() - start, frame.decode_seconds - decoded)
+            self._next(stage)
+        frame.release()
+        return None
+
+    def add_time(self, stage, span, seconds, decode):
+        if decode:
+            self.timer.add(stage.name, "decode", decode)
+        self.timer.add(stage.name, span, seconds - decode)
+
+    def finish_batch(self, stage, seconds, decode, error=None):
+        """
+        Records the batched analysis of stage, which advance returned, and
+        moves past it.
+        """
+        if error is not None:
+            logger.warning(f"Error processing {self.frame.filename} in {stage.name}: {error}")
+            self.failed.append(stage.name)
+        elif self._uses_cache(stage):
+            _store_analysis(self.cache, self.frame, stage)
+        self.add_time(stage, "compute", seconds, decode)
+        self._next(stage)
+
+    def result(self):
+        spans = self.timer.to_dict()
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"Analyzed {self.frame.filename}: " + ", ".join(
+                f"{stage} " + "/".join(f"{span} {seconds * 1000:.1f}ms" for span, seconds in values.items())
+                for stage, values in spans.items()
+            ))
+        return self.frame.summary, self.hits, self.misses, spans, self.failed
+
+
+def _analyze_batch(stage, analyses):
+    """
+    Runs stage.analyze_batch on the frames of analyses, falling back to
+    analyze frame by frame when the batch fails, so that one unreadable
+    image does not fail the others. The batch's compute time is shared
+    evenly; every frame keeps its own decode time.
+    """
+    frames = [analysis.frame for analysis in analyses]
+    decoded = [frame.decode_seconds for frame in frames]
+    errors = [None] * len(frames)
+    start = perf_counter()
+    try:
+        stage.analyze_batch(frames)
+    except Exception:
+        for index, frame in enumerate(frames):
+            try:
+                stage.analyze(frame)
+            except Exception as e:
+                errors[index] = e
+    decodes = [frame.decode_seconds - before for frame, before in zip(frames, decoded)]
+    share = (perf_counter() - start - sum(decodes)) / len(frames)
+    for analysis, decode, error in zip(analyses, decodes, errors):
+        analysis.finish_batch(stage, share + decode, decode, error)
+
+
+def analyze_images(items, options):
+    """
+    Runs every enabled stage's analysis on a batch of images; this is the
+    unit of work sent to workers. Each image is analyzed as analyze_image
+    describes, decoded once and not at all when every result is cached,
+    but the stages with analyze_batch compute together for all the images
+    of the batch that reach them. Returns one analyze_image result per item.
+    """
+    stages = _analysis_stages(options)
+    cache = get_cache()
+    analyses = [_ImageAnalysis(item, stages, cache) for item in items]
+    active = analyses
+    while active:
+        waiting = {}
+        for analysis in active:
+            stage = analysis.advance()
+            if stage is not None:
+                waiting.setdefault(stage.name, (stage, []))[1].append(analysis)
+        active = []
+        for stage, group in waiting.values():
+            _analyze_batch(stage, group)
+            active.extend(group)
+    return [analysis.result() for analysis in analyses]
+
+
+def analyze_image(item, options):
+    """
+    Runs every enabled stage's analysis on one image, decoding it only once
+    and not at all when every stage's result is in the analysis cache.
+    A failing stage leaves no result, so its predicate or selection drops
+    the image. item is a (path, content_hash) pair, content_hash possibly
+    None, or a (path, content_hash, stage_names, summary) tuple giving the
+    stages to run in plan order and the summary fields already known: then
+    the image stops at the first predicate that rejects it.
+    Returns (summary, cache_hits, cache_misses, spans, failed_stages). spans
+    maps each stage run to the seconds it spent decoding (the first stage to
+    need pixels pays for them), computing, or looking up the analysis cache.
+    """
+    return analyze_images([item], options)[0]
+
+
+def _check_cancelled(cancel_event):
+    if cancel_event is not None and cancel_event.is_set():
+        raise PipelineCancelled()
+
+
+def _analysis_node(stage, image_key):
+    return ("analyze", stage.name, stage.cache_version, image_key)
+
+
+def _first_pending(frame, stages, missing):
+    """
+    Index in stages of the first analysis still missing for frame, walking
+    the plan with the fields known so far, or None when every analysis is
+    known or a predicate already rejects the frame.
+    """
+    for index, stage in enumerate(stages):
+        if stage in missing:
+            return index
+        if stage.keep is not None and not stage.keep(frame):
+            return None
+    return None
+
+
+def analyze_frames(frames, stages, options, stats, progress=None, cancel_event=None,
+                   content_hashes=None, graph=None, image_keys=None, phase="analyze"):
+    """
+    Runs the per-image part of stages, in plan order, on all frames on the
+    configured worker pool, in input order; progress is reported as phase.
+    content_hashes optionally maps paths to content hashes already known.
+    With a SessionGraph (and image_keys mapping paths to its image keys),
+    results memoized by earlier runs are reused and an image is only sent
+    to the workers when an analysis it still needs is missing. The measured
+    per-image cost of every stage feeds the planner's estimates.
+    """
+    content_hashes = content_hashes or {}
+    cache = get_cache()
+    stats.setdefault("cache_hits", 0)
+    stats.setdefault("cache_misses", 0)
+    stats.setdefault("reused_analyses", 0)
+    stats.setdefault("errors", 0)
+    timings = stats.setdefault("timings", {})
+    names = [stage.name for stage in stages]
+
+    work = []
+    for frame in frames:
+        missing = [stage for stage in stages if stage.analyze]
+        if graph is not None:
+            missing = []
+            for stage in stages:
+                if not stage.analyze:
+                    continue
+                memo = graph.get(_analysis_node(stage, image_keys[frame.path]))
+                if memo is None:
+                    missing.append(stage)
+                else:
+                    frame.summary.update(memo)
+                    stats["reused_analyses"] += 1
+        first = _first_pending(frame, stages, missing)
+        if first is not None:
+            # Memoized fields travel with the item, so workers skip those
+            # analyses but can still evaluate the predicates reading them
+            item = (frame.path, content_hashes.get(frame.path), tuple(names[first:]), dict(frame.summary))
+            work.append((frame, missing, item))
+
+    costs = {}
+    summaries = iter_images(
+        functools.partial(analyze_images, options=options),
+        [item for _, _, item in work],
+        batched=True,
+    )
+    try:
+        for done, ((frame, missing, _), result) in enumerate(zip(work, summaries), 1):
+            if isinstance(result, ImageError):
+                logger.warning(f"Error processing {frame.filename}: {result.error}")
+                frame.error = result.error
+                stats["errors"] += 1
+                metrics.inc("image_errors_total", phase="analyze")
+            else:
+                summary, hits, misses, spans, failed = result
+                frame.summary.update(summary)
+                stats["cache_hits"] += hits
+                stats["cache_misses"] += misses
+                if failed:
+                    stats["errors"] += 1
+                    metrics.inc("image_errors_total", phase="analyze")
+                if cache is not None:
+                    cache.record(hits, misses)
+                metrics.inc("cache_hits_total", hits)
+                metrics.inc("cache_misses_total", misses)
+                metrics.observe_spans(spans)
+                add_spans(timings, spans)
+                for stage, values in spans.items():
+                    cost = costs.setdefault(stage, [0.0, 0])
+                    cost[0] += sum(values.values())
+                    cost[1] += 1
+                if graph is not None:
+                    for stage in missing:
+                        # A failed or skipped stage left no fields; it is retried next run
+                        if all(field in summary for field in stage.cache_fields):
+                            values = {field: summary[field] for field in stage.cache_fields}
+                            graph.put(_analysis_node(stage, image_keys[frame.path]), values)
+            if progress:
+                progress(phase, done, len(work))
+            _check_cancelled(cancel_event)
+    finally:
+        # Cancels the images not started yet if we stop early
+        summaries.close()
+    if not work and progress:
+        progress(phase, len(frames), len(frames))
+    for stage, (seconds, images) in costs.items():
+        stage_estimates.record_cost(stage, seconds, images)
+
+
+def filter_frames(frames, stages, stats):
+    """
+    Keeps the frames that every predicate among stages accepts, evaluated in
+    plan order, and records for each predicate how many frames it was the
+    first to reject, and its pass rate for the planner.
+    """
+    predicates = [stage for stage in stages if stage.keep is not None]
+    if not predicates:
+        return frames
+    seen = dict.fromkeys((stage.name for stage in predicates), 0)
+    rejected = dict(seen)
+    kept = []
+    for frame in frames:
+        for stage in predicates:
+            seen[stage.name] += 1
+            if not stage.keep(frame):
+                rejected[stage.name] += 1
+                break
+        else:
+            kept.append(frame)
+    for stage in predicates:
+        passed = seen[stage.name] - rejected[stage.name]
+        logger.info(f"{stage.name}: kept {passed} of {seen[stage.name]} images")
+        if stage.stat_key:
+            # Added up over the calls of one run (see filter_prefiltered)
+            stats[stage.stat_key] = stats.get(stage.stat_key, 0) + rejected[stage.name]
+        stage_estimates.record_pass_rate(stage.name, passed, seen[stage.name])
+    return kept
+
+
+def select_frames(frames, stages, stats, progress=None, graph=None, image_keys=None):
+    """
+    Applies each stage's keep/drop decision in order and records the counts.
+    With a SessionGraph, a stage's decision is reused when the same frames
+    reach it as in an earlier run.
+    """
+    selecting = [stage for stage in stages if stage.select is not None]
+    stats.setdefault("reused_selections", 0)
+    timings = stats.setdefault("timings", {})
+    for done, stage in enumerate(selecting, 1):
+        before = len(frames)
+        start = perf_counter()
+        memo = node = None
+        if graph is not None:
+            inputs = graph.inputs_key(image_keys[frame.path] for frame in frames)
+            node = ("select", stage.name, stage.cache_version, stage.select_version, inputs)
+            memo = graph.get(node)
+        if memo is not None:
+            by_key = {image_keys[frame.path]: frame for frame in frames}
+            frames = []
+            for key, summary in memo:
+                by_key[key].summary.update(summary)
+                frames.append(by_key[key])
+            stats["reused_selections"] += 1
+        else:
+            frames = stage.select(frames)
+            if node is not None:
+                graph.put(node, [(image_keys[frame.path], dict(frame.summary)) for frame in frames])
+        elapsed = perf_counter() - start
+        metrics.observe("select_seconds", elapsed, stage=stage.name)
+        add_spans(timings, {stage.name: {"select": elapsed}})
+        logger.info(f"{stage.name}: kept {len(frames)} of {before} images")
+        if stage.stat_key:
+            stats[stage.stat_key] = before - len(frames)
+        if progress:
+            progress("select", done, len(selecting))
+    return frames
+
+
+def filter_prefiltered(frames, plan, options, stats, progress=None, cancel_event=None,
+                       content_hashes=None, graph=None, image_keys=None):
+    """
+    Runs plan.sequence on the frames the prefilters keep, and returns those
+    its predicates accept. The prefilters' choice is made among the frames
+    the predicates accept: when a predicate rejects a kept frame (the leader
+    of a duplicate group, say), the prefilters run again without it, so the
+    next frame of its group takes its place. This keeps the same frames as
+    running the predicates on every frame first, but only analyzes the
+    frames that reach the sequence.
+    """
+    candidates = frames
+    analyzed = set()
+    while True:
+        kept = select_frames(candidates, plan.prefilters, stats, None, graph, image_keys)
+        new = [frame for frame in kept if frame not in analyzed]
+        if not new:
+            return kept
+        analyze_frames(new, plan.sequence, options, stats, progress, cancel_event,
+                       content_hashes, graph, image_keys)
+        analyzed.update(new)
+        rejected = set(new) - set(filter_frames(new, plan.sequence, stats))
+        if not rejected:
+            return kept
+        candidates = [frame for frame in candidates if frame not in rejected]
+
+
+def _render_node(stage, image_key):
+    return ("render", stage.name, stage.output_version, image_key)
+
+
+def _reuse_render(graph, node, output_dir, dst_path):
+    """
+    Places an output rendered by an earlier run at dst_path, if it still
+    exists. Returns True on success.
+    """
+    previous = graph.get(node)
+    if previous is None:
+        return False
+    previous_path = os.path.join(output_dir, previous)
+    if not os.path.isfile(previous_path):
+        return False
+    if os.path.abspath(previous_path) != os.path.abspath(dst_path):
+        os.makedirs(os.path.dirname(dst_path), exist_ok=True)
+        link_or_copy(previous_path, dst_path)
+    return True
+
+
+def _remove_stale_outputs(output_dir, previous_entries, kept_paths):
+    """
+    Deletes files an earlier run wrote that this run no longer produces,
+    and the folders left empty.
+    """
+    for entry in previous_entries:
+        if not entry.get("written") or entry["relative_path"] in kept_paths:
+            continue
+        path = os.path.join(output_dir, entry["relative_path"])
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            continue
+        parent = os.path.dirname(path)
+        while os.path.abspath(parent) != os.path.abspath(output_dir):
+            try:
+                os.rmdir(parent)
+            except OSError:
+                break
+            parent = os.path.dirname(parent)
+
+
+def write_survivors(frames, stages, output_dir, progress=None, cancel_event=None,
+                    output_mode=None, stats=None, graph=None, image_keys=None, output_names=None,
+                    on_written=None):
+    """
+    Places the surviving images once, into the folder of the last stage, and
+    writes a manifest of them. Unchanged images are linked, copied or only
+    listed according to output_mode (see pipeline.output); only a
+    pixel-changing stage such as background removal encodes new files, a
+    batch of images at a time.
+
+    With a SessionGraph, output_dir may hold an earlier run's outputs:
+    rendered images are reused from there instead of being encoded again,
+    and files that are no longer produced are removed. output_names maps
+    image paths to the name they get in their folder, which may be a
+    relative path; it defaults to the file name. on_written, if given, is
+    called with each image's result as soon as the image is placed.
+    """
+    # Helper stages such as face detection have no folder of their own
+    last = next((s for s in reversed(stages) if s.subdir is not None), None)
+    transform = next((s for s in reversed(stages) if s.write_batch), None)
+    batch_size = max(1, transform.batch_size) if transform else 1
+    previous_entries = read_manifest(output_dir) if graph is not None else []
+    if stats is not None:
+        stats["reused_renders"] = 0
+    # Write time is attributed to the stage that renders, or to placing files
+    write_stage = transform.name if transform else "output"
+    timer = SpanTimer()
+    known_dirs = set()
+
+    results = []
+    manifest = []
+    done = 0
+    try:
+        for start in range(0, len(frames), batch_size):
+            _check_cancelled(cancel_event)
+            targets = []
+            for frame in frames[start:start + batch_size]:
+                subdir = last.output_subdir(frame) if last else ""
+                filename = output_names.get(frame.path, frame.filename) if output_names else frame.filename
+                if transform:
+                    filename = transform.rename(filename)
+                dst_path = os.path.join(output_dir, subdir, filename)
+                targets.append((frame, filename, dst_path))
+
+            errors = [None] * len(targets)
+            if transform:
+                pending = []
+                for index, (frame, _, dst_path) in enumerate(targets):
+                    if graph is not None and _reuse_render(
+                            graph, _render_node(transform, image_keys[frame.path]), output_dir, dst_path):
+                        if stats is not None:
+                            stats["reused_renders"] += 1
+                        continue
+                    os.makedirs(os.path.dirname(dst_path), exist_ok=True)
+                    if os.path.lexists(dst_path):
+                        # Never write through a link to a source image
+                        os.remove(dst_path)
+                    pending.append(index)
+                if pending:
+                    t0 = perf_counter()
+                    pending_errors = transform.write_batch(
+                        [(targets[i][0].path, targets[i][2]) for i in pending]
+                    )
+                    # A batch is rendered at once; share its time among its images
+                    share = (perf_counter() - t0) / len(pending)
+                    for index, error in zip(pending, pending_errors):
+                        errors[index] = error
+                        metrics.observe("stage_seconds", share, stage=write_stage, span="write")
+                    timer.add(write_stage, "write", share * len(pending))
+
+            for (frame, filename, dst_path), error in zip(targets, errors):
+                try:
+                    if error is not None:
+                        raise error
+                    if transform:
+                        written = True
+                    else:
+                        t0 = perf_counter()
+                        written = materialize(frame.path, dst_path, output_mode, known_dirs)
+                        elapsed = perf_counter() - t0
+                        metrics.observe("stage_seconds", elapsed, stage=write_stage, span="write")
+                        timer.add(write_stage, "write", elapsed)
+
+                    relative_path = os.path.relpath(dst_path, output_dir).replace(os.sep, "/")
+                    if transform and graph is not None:
+                        graph.put(_render_node(transform, image_keys[frame.path]), relative_path)
+                    stat = os.stat(dst_path if written else frame.path)
+                    manifest.append({"relative_path": relative_path, "source": frame.path, "written": written})
+                    image = {
+                        "filename": filename,
+                        "path": dst_path if written else frame.path,
+                        "relative_path": relative_path,
+                        "size": stat.st_size,
+                        "date": datetime.fromtimestamp(stat.st_mtime).isoformat()
+                    }
+                    results.append(image)
+                except Exception as e:
+                    logger.warning(f"Error writing {frame.filename}: {e}")
+                    metrics.inc("image_errors_total", phase="write")
+                    if stats is not None:
+                        stats["errors"] = stats.get("errors", 0) + 1
+                else:
+                    if on_written is not None:
+                        on_written(image)
+                done += 1
+                if progress:
+                    progress("write", done, len(frames))
+    except PipelineCancelled:
+        # Keep every file on disk listed so the next run can clean it up
+        listed = {entry["relative_path"] for entry in manifest}
+        write_manifest(output_dir, manifest + [e for e in previous_entries if e["relative_path"] not in listed])
+        raise
+
+    kept_paths = {entry["relative_path"] for entry in manifest if entry["written"]}
+    _remove_stale_outputs(output_dir, previous_entries, kept_paths)
+    write_manifest(output_dir, manifest)
+    if stats is not None:
+        add_spans(stats.setdefault("timings", {}), timer.to_dict())
+    return results
+
+
+def run_pipeline(image_paths, output_dir, options, progress=None, cancel_event=None,
+                 content_hashes=None, output_mode=None, graph=None, output_names=None, on_written=None):
+    """
+    Runs the enabled stages over image_paths and writes only the survivors
+    into output_dir. Returns (processed_images, stats).
+
+    The stages run in the order plan_stages gives (listed in stats["plan"]):
+    cheap prefilters such as duplicate removal on every image first, then
+    the per-image predicates, cheapest to reject an image first, and the
+    analyses and selections only the survivors need. A duplicate group is
+    represented by its first image that the predicates accept (see
+    filter_prefiltered). Output folders follow
+    the declared stage order, whatever the execution order.
+
+    progress, if given, is called as progress(phase, done, total) for the
+    "prefilter", "analyze", "select" and "write" phases. Setting cancel_event (a
+    threading.Event) stops the run with PipelineCancelled. content_hashes
+    maps paths to content hashes computed at upload, to avoid rehashing.
+    output_mode overrides settings.OUTPUT_MODE for this run.
+
+    graph, a SessionGraph, makes the run incremental: analyses, selections
+    and rendered outputs memoized by earlier runs of the same session are
+    reused, and output_dir is updated in place rather than expected empty.
+    output_names optionally maps paths to names inside the output folders,
+    such as paths relative to a scanned directory tree. on_written(image)
+    is called with each entry of processed_images once that image is placed.
+    """
+    stages = build_stages(options)
+    plan = plan_stages(stages)
+    frames = [ImageFrame(path) for path in image_paths]
+    stats = {"total_images": len(frames), "errors": 0, "timings": {}, "plan": plan.stage_names()}
+    metrics.inc("images_in_total", len(frames))
+    image_keys = None
+    if graph is not None:
+        content_hashes = content_hashes or {}
+        image_keys = {path: graph.image_key(path, content_hashes.get(path)) for path in image_paths}
+
+    if plan.prefilters:
+        analyze_frames(frames, plan.prefilters, options, stats, progress, cancel_event,
+                       content_hashes, graph, image_keys, phase="prefilter")
+        survivors = filter_prefiltered(frames, plan, options, stats, progress, cancel_event,
+                                       content_hashes, graph, image_keys)
+    else:
+        analyze_frames(frames, plan.sequence, options, stats, progress, cancel_event,
+                       content_hashes, graph, image_keys)
+        survivors = filter_frames(frames, plan.sequence, stats)
+    survivors = select_frames(survivors, plan.selects, stats, progress, graph, image_keys)
+
+    if options.get("cluster_face"):
+        # Identity clusters when faces were embedded, else one group of all faces
+        clusters = {f.summary.get("face_cluster") for f in survivors} - {None}
+        stats["face_clusters"] = len(clusters) or (1 if survivors else 0)
+
+    processed_images = write_survivors(
+        survivors, stages, output_dir, progress, cancel_event, output_mode,
+        stats, graph, image_keys, output_names, on_written
+    )
+    if options.get("remove_background"):
+        stats["backgrounds_removed"] = len(processed_images)
+    stats["processed_images"] = len(processed_images)
+    metrics.inc("images_out_total", len(processed_images))
+    # Seconds per stage and span (decode, compute, cache, select, write),
+    # summed over the images of this run
+    stats["timings"] = {
+        stage: {span: round(seconds, 3) for span, seconds in spans.items()}
+        for stage, spans in stats["timings"].items()
+    }
+    return processed_images, stats
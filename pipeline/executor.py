@@ -0,0 +1,252 @@
+import os
+import atexit
+import ctypes
+import logging
+import functools
+import itertools
+import multiprocessing
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import cv2
+
+from pipeline import settings
+from pipeline.broker import BrokerExecutor, InProcessBroker, open_broker
+from pipeline.metrics import configure_logging, metrics
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+logger = logging.getLogger(__name__)
+
+
+class ImageError:
+    """
+    Returned in place of a result when the work for one image raised.
+    """
+
+    def __init__(self, item, error):
+        self.item = item
+        self.error = error
+
+    def __repr__(self):
+        return f"ImageError({self.item!r}, {self.error!r})"
+
+
+def _init_worker():
+    # Each worker handles one image at a time; keep OpenCV from
+    # oversubscribing the cores with its own thread pool.
+    cv2.setNumThreads(1)
+    configure_logging()
+
+
+def _call_isolated(func, item):
+    try:
+        return func(item)
+    except Exception as e:
+        return ImageError(item, f"{type(e).__name__}: {e}")
+
+
+def _call_chunk(func, chunk):
+    return [func(item) for item in chunk]
+
+
+def _call_batch(func, chunk):
+    try:
+        return func(chunk)
+    except Exception:
+        # Retried one item at a time, so only the failing item gets an ImageError
+        return [_call_isolated(lambda item: func([item])[0], item) for item in chunk]
+
+
+def _rss_of(pid):
+    with open(f"/proc/{pid}/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+def process_tree_rss():
+    """
+    Resident memory in bytes of this process and its child processes (the
+    workers of a process pool), or None where /proc is unavailable.
+    """
+    try:
+        total = _rss_of(os.getpid())
+    except (OSError, ValueError, IndexError):
+        return None
+    children = set()
+    try:
+        for task in os.listdir("/proc/self/task"):
+            with open(f"/proc/self/task/{task}/children") as f:
+                children.update(f.read().split())
+    except OSError:
+        pass
+    for pid in children:
+        try:
+            total += _rss_of(pid)
+        except (OSError, ValueError, IndexError):
+            # The child exited meanwhile
+            continue
+    return total
+
+
+@functools.lru_cache(maxsize=None)
+def _libc():
+    try:
+        return ctypes.CDLL("libc.so.6")
+    except OSError:
+        return None
+
+
+def _trim_heap():
+    # Decoded images are freed into the C heap; glibc keeps freed pages
+    # mapped until asked to return them, which would keep RSS high
+    libc = _libc()
+    if libc is not None and hasattr(libc, "malloc_trim"):
+        libc.malloc_trim(0)
+
+
+def _over_ceiling(ceiling):
+    if not ceiling:
+        return False
+    rss = process_tree_rss()
+    if rss is None or rss <= ceiling:
+        return False
+    _trim_heap()
+    rss = process_tree_rss()
+    return rss is not None and rss > ceiling
+
+
+def _get_pool(kind, workers):
+    """
+    Returns a pool shared across calls, created on first use.
+    """
+    key = (kind, workers)
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            if kind == "process":
+                pool = ProcessPoolExecutor(
+                    max_workers=workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=_init_worker,
+                )
+            elif kind == "thread":
+                pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="image-worker")
+            elif kind == "broker":
+                broker = open_broker()
+                # An in-memory queue is only reachable by threads of this process
+                pool = BrokerExecutor(broker, local_workers=workers if isinstance(broker, InProcessBroker) else 0)
+            else:
+                raise ValueError(f"Unknown executor kind: {kind}")
+            _pools[key] = pool
+        return pool
+
+
+def shutdown_pools():
+    """
+    Shut down every shared pool.
+    """
+    with _pools_lock:
+        for pool in _pools.values():
+            pool.shutdown(wait=True, cancel_futures=True)
+        _pools.clear()
+
+
+atexit.register(shutdown_pools)
+
+
+def iter_images(func, items, kind=None, workers=None, chunk_size=None, window=None, memory_ceiling=None,
+                batched=False):
+    """
+    Applies func to every item and yields the results in input order as they
+    become available. With batched, func is called on a whole chunk of items
+    and returns their results as a list, for work that vectorizes across images.
+
+    Work is fanned out to a process or thread pool, or to the workers of a
+    broker (settings.EXECUTOR_KIND), in chunks of settings.CHUNK_SIZE. An
+    exception for one item does not affect the others: its result is an
+    ImageError instead. With "process" or "broker", func and the items must
+    be picklable. Closing the generator early cancels the work that has not
+    started yet.
+
+    Items are consumed lazily and streamed through a bounded window: at most
+    `window` items (settings.PIPELINE_WINDOW) are submitted or waiting to be
+    yielded at once, so memory does not grow with the number of items. While
+    the resident memory of the process and its workers is above
+    memory_ceiling bytes (settings.MEMORY_CEILING_MB), no further work is
+    submitted until earlier results drain, and fewer images are kept in
+    flight; one chunk always stays in flight so processing never stalls.
+    """
+    kind = kind or settings.EXECUTOR_KIND
+    workers = workers or settings.WORKER_COUNT
+    chunk_size = chunk_size or settings.CHUNK_SIZE
+    if batched:
+        call = functools.partial(_call_batch, func)
+    else:
+        call = functools.partial(_call_chunk, functools.partial(_call_isolated, func))
+
+    # Broker workers run elsewhere, whatever the local worker count
+    if kind == "serial" or (workers <= 1 and kind != "broker"):
+        items = iter(items)
+        while True:
+            chunk = list(itertools.islice(items, chunk_size if batched else 1))
+            if not chunk:
+                return
+            yield from call(chunk)
+
+    pool = _get_pool(kind, workers)
+    if kind == "thread" and not batched:
+        # Chunks only save inter-process round trips
+        chunk_size = 1
+    window = max(window or settings.PIPELINE_WINDOW or 2 * workers * chunk_size, chunk_size)
+    if memory_ceiling is None:
+        memory_ceiling = settings.MEMORY_CEILING_MB * 1024 * 1024
+
+    # With a ceiling, start with one chunk in flight and admit one more per
+    # chunk completed while memory allows; halve the limit when above it
+    limit = chunk_size if memory_ceiling else window
+    items = iter(items)
+    pending = deque()
+    in_flight = 0
+    try:
+        while True:
+            chunk = list(itertools.islice(items, chunk_size))
+            if not chunk:
+                break
+            while pending:
+                if in_flight + len(chunk) <= limit:
+                    if not _over_ceiling(memory_ceiling):
+                        break
+                    metrics.inc("memory_waits_total")
+                    logger.debug("Memory above the ceiling, waiting for results before submitting more")
+                    limit = max(chunk_size, limit // 2)
+                future, size = pending.popleft()
+                in_flight -= size
+                yield from future.result()
+                if limit < window:
+                    limit += chunk_size
+            pending.append((pool.submit(call, chunk), len(chunk)))
+            in_flight += len(chunk)
+        while pending:
+            future, size = pending.popleft()
+            in_flight -= size
+            yield from future.result()
+    finally:
+        for future, _ in pending:
+            future.cancel()
+
+
+def submit_image(func, item, kind=None, workers=None):
+    """
+    Schedules func(item) on the shared pool without waiting for it and
+    returns a Future whose result is func's result or an ImageError.
+    With the "serial" executor the work runs on a single background thread.
+    """
+    kind = kind or settings.EXECUTOR_KIND
+    workers = workers or settings.WORKER_COUNT
+    if kind == "serial" or (workers <= 1 and kind != "broker"):
+        pool = _get_pool("thread", 1)
+    else:
+        pool = _get_pool(kind, workers)
+    return pool.submit(_call_isolated, func, item)
@@ -0,0 +1,207 @@
+import hashlib
+import io
+import os
+from contextlib import contextmanager
+from time import perf_counter
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from features.remove_blur import resize_image
+from pipeline import settings
+
+# Width of the downscaled working copy shared by the analysis stages
+WORKING_WIDTH = 1024
+
+# JPEG DCT scaling factors OpenCV can decode at, largest first
+REDUCTION_FACTORS = (8, 4, 2)
+
+_REDUCED_FLAGS = {
+    (2, False): cv2.IMREAD_REDUCED_COLOR_2,
+    (4, False): cv2.IMREAD_REDUCED_COLOR_4,
+    (8, False): cv2.IMREAD_REDUCED_COLOR_8,
+    (2, True): cv2.IMREAD_REDUCED_GRAYSCALE_2,
+    (4, True): cv2.IMREAD_REDUCED_GRAYSCALE_4,
+    (8, True): cv2.IMREAD_REDUCED_GRAYSCALE_8,
+}
+
+# EXIF orientations that swap width and height when applied
+_TRANSPOSING_ORIENTATIONS = (5, 6, 7, 8)
+
+
+def content_hasher():
+    """
+    Returns a new hash object for file contents; see ImageFrame.content_hash.
+    """
+    return hashlib.blake2b(digest_size=20)
+
+
+class ImageFrame:
+    """
+    A single image decoded once and shared by every pipeline stage.
+
+    The file is read from disk once. Pixel data (BGR, grayscale and the
+    downscaled working copy) is derived lazily from those bytes on first
+    access and cached. Stages that only need a lower resolution ask
+    for a `proxy()`, which JPEG decoders produce directly through DCT
+    scaling without decoding the full frame. Stages store their compact
+    results in `summary`, after which `release()` drops the pixel buffers so
+    only the summary stays in memory for the selection step.
+
+    Time spent reading and decoding the file accumulates in
+    `decode_seconds`, so stages can be timed apart from their decodes.
+    """
+
+    # Large sessions keep one frame per image alive until selection
+    __slots__ = (
+        "path", "filename", "summary", "error", "decode_seconds", "_data", "_bgr", "_gray",
+        "_working", "_working_gray", "_proxies", "_size", "_mtime", "_content_hash", "_decoding_depth",
+    )
+
+    def __init__(self, path, content_hash=None):
+        self.path = path
+        self.filename = os.path.basename(path)
+        self.summary = {}
+        self.error = None
+        self._data = None
+        self._bgr = None
+        self._gray = None
+        self._working = None
+        self._working_gray = None
+        self._proxies = {}
+        self._size = None
+        self._mtime = None
+        self._content_hash = content_hash
+        self.decode_seconds = 0.0
+        self._decoding_depth = 0
+
+    @contextmanager
+    def _decoding(self):
+        # Nested decodes (a header read falling back to a full decode) count once
+        self._decoding_depth += 1
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self._decoding_depth -= 1
+            if not self._decoding_depth:
+                self.decode_seconds += perf_counter() - start
+
+    def _read(self):
+        if self._data is None:
+            with self._decoding():
+                self._data = np.fromfile(self.path, dtype=np.uint8)
+        return self._data
+
+    @property
+    def buffered(self):
+        """The file bytes if a stage already read them, else None."""
+        return self._data
+
+    @property
+    def content_hash(self):
+        """
+        Hash of the file bytes, used to key cached analysis results.
+        May be passed in when it was computed while the file was uploaded.
+        """
+        if self._content_hash is None:
+            hasher = content_hasher()
+            hasher.update(self._read())
+            self._content_hash = hasher.hexdigest()
+        return self._content_hash
+
+    @property
+    def bgr(self):
+        if self._bgr is None:
+            with self._decoding():
+                self._bgr = cv2.imdecode(self._read(), cv2.IMREAD_COLOR)
+            if self._bgr is None:
+                raise ValueError(f"Could not decode image: {self.filename}")
+        return self._bgr
+
+    @property
+    def gray(self):
+        if self._gray is None:
+            self._gray = cv2.cvtColor(self.bgr, cv2.COLOR_BGR2GRAY)
+        return self._gray
+
+    def proxy(self, min_width, grayscale=False):
+        """
+        Returns (image, scale): the image decoded at the coarsest JPEG
+        reduction (1/2, 1/4 or 1/8) that is still at least min_width pixels
+        wide, optionally straight to grayscale. scale is the factor that maps
+        proxy coordinates back to full-resolution ones. With
+        settings.PROXY_DECODING off, the full-resolution image is returned.
+        """
+        factor = 1
+        if settings.PROXY_DECODING:
+            width, _ = self.size
+            factor = next((f for f in REDUCTION_FACTORS if width // f >= min_width), 1)
+
+        key = (factor, grayscale)
+        if key not in self._proxies:
+            if factor == 1:
+                image = self.gray if grayscale else self.bgr
+            else:
+                with self._decoding():
+                    image = cv2.imdecode(self._read(), _REDUCED_FLAGS[key])
+                if image is None:
+                    raise ValueError(f"Could not decode image: {self.filename}")
+            self._proxies[key] = image
+
+        image = self._proxies[key]
+        # The longer side is unaffected by EXIF rotation, unlike the width
+        scale = max(self.size) / max(image.shape[:2])
+        return image, scale
+
+    @property
+    def working(self):
+        """BGR copy resized to at most WORKING_WIDTH pixels wide."""
+        if self._working is None:
+            image, _ = self.proxy(WORKING_WIDTH)
+            self._working = resize_image(image, width=WORKING_WIDTH)
+        return self._working
+
+    @property
+    def working_gray(self):
+        """Grayscale copy at most WORKING_WIDTH pixels wide, decoded as grayscale."""
+        if self._working_gray is None:
+            image, _ = self.proxy(WORKING_WIDTH, grayscale=True)
+            self._working_gray = resize_image(image, width=WORKING_WIDTH)
+        return self._working_gray
+
+    @property
+    def size(self):
+        """
+        (width, height) of the full-resolution image as decoded (with EXIF
+        orientation applied), read from the header without decoding pixels.
+        """
+        if self._size is None:
+            with self._decoding():
+                try:
+                    with Image.open(io.BytesIO(self._read().tobytes())) as img:
+                        width, height = img.size
+                        orientation = img.getexif().get(0x0112)
+                    if orientation in _TRANSPOSING_ORIENTATIONS:
+                        width, height = height, width
+                    self._size = (width, height)
+                except Exception:
+                    h, w = self.bgr.shape[:2]
+                    self._size = (w, h)
+        return self._size
+
+    @property
+    def mtime(self):
+        if self._mtime is None:
+            self._mtime = os.stat(self.path).st_mtime
+        return self._mtime
+
+    def release(self):
+        """Drop the file bytes and pixel buffers, keeping `summary`."""
+        self._data = None
+        self._bgr = None
+        self._gray = None
+        self._working = None
+        self._working_gray = None
+        self._proxies = {}
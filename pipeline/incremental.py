@@ -0,0 +1,170 @@
+import os
+import json
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+from pipeline import settings
+from pipeline.cache import encode_json_value, decode_json_object
+
+logger = logging.getLogger(__name__)
+
+
+class SessionGraph:
+    """
+    Memoized stage results of one upload session, so that re-running it
+    with different options only computes what is new or invalidated.
+
+    The pipeline is a small DAG: every stage analyzes every image, the
+    selections run as a chain, and a pixel-changing stage renders the
+    survivors. Nodes are keyed by (kind, stage, parameters, inputs):
+
+    - ("analyze", stage, version, image): the stage's summary fields of one image
+    - ("select", stage, version, inputs): the frames kept from an ordered
+      input set, with the summaries the selection added
+    - ("render", stage, version, image): where the rendered output of one
+      image was written
+
+    Images are identified by content hash, or by path, size and mtime when
+    the hash is not known. Parameters are part of each stage's version, so
+    changing them misses the old nodes instead of invalidating them.
+
+    With max_nodes, the least recently used nodes are dropped beyond that
+    many; a dropped node is only computed again.
+    """
+
+    def __init__(self, max_nodes=None):
+        self.max_nodes = max_nodes
+        self._nodes = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def image_key(path, content_hash=None):
+        if content_hash:
+            return content_hash
+        stat = os.stat(path)
+        return f"{os.path.abspath(path)}:{stat.st_size}:{stat.st_mtime_ns}"
+
+    @staticmethod
+    def inputs_key(image_keys):
+        """
+        Short key for an ordered set of images.
+        """
+        digest = hashlib.blake2b(digest_size=16)
+        for key in image_keys:
+            digest.update(key.encode("utf-8"))
+            digest.update(b"\0")
+        return digest.hexdigest()
+
+    def get(self, node):
+        with self._lock:
+            value = self._nodes.get(node)
+            if value is not None:
+                self._nodes.move_to_end(node)
+            return value
+
+    def put(self, node, value):
+        with self._lock:
+            self._nodes[node] = value
+            self._nodes.move_to_end(node)
+            self._evict()
+
+    def _evict(self):
+        if self.max_nodes:
+            while len(self._nodes) > self.max_nodes:
+                self._nodes.popitem(last=False)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._nodes)
+
+
+def _journal_value(value):
+    # Summaries can hold numpy scalars; datetimes are tagged as in the cache
+    if hasattr(value, "item"):
+        return value.item()
+    return encode_json_value(value)
+
+
+class JournaledGraph(SessionGraph):
+    """
+    A SessionGraph that also appends every node to a JSON lines journal and
+    loads an existing one, so a run interrupted midway resumes with every
+    analysis, selection and render it had finished. A last line cut short
+    by the interruption is dropped from the file. Nothing is evicted: the
+    journal of a run is replayed whole.
+    """
+
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+        self.loaded = 0
+        if os.path.exists(path):
+            complete = 0
+            with open(path, "rb") as f:
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        break
+                    complete += len(line)
+                    try:
+                        node, value = json.loads(line, object_hook=decode_json_object)
+                    except ValueError:
+                        continue
+                    self._nodes[tuple(node)] = value
+                    self.loaded += 1
+            # Otherwise the first line appended would continue the cut one
+            os.truncate(path, complete)
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._file = open(path, "a", encoding="utf-8")
+
+    def put(self, node, value):
+        try:
+            line = json.dumps([node, value], default=_journal_value)
+        except TypeError as e:
+            # Still reused within this run, only not after a restart
+            logger.warning(f"Could not journal {node[0]} {node[1]}: {e}")
+            line = None
+        with self._lock:
+            self._nodes[node] = value
+            self._nodes.move_to_end(node)
+            if line is not None:
+                self._file.write(line + "\n")
+                self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+class SessionGraphs:
+    """
+    The SessionGraph of every session, created on first use. Together they
+    hold at most max_nodes nodes (settings.SESSION_GRAPH_MAX_NODES by
+    default), checked whenever a graph is handed out: the graphs of the
+    least recently processed sessions are dropped first, and a single
+    session beyond the limit drops its own least recently used nodes.
+    """
+
+    def __init__(self, max_nodes=None):
+        self.max_nodes = settings.SESSION_GRAPH_MAX_NODES if max_nodes is None else max_nodes
+        self._graphs = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, session_id):
+        with self._lock:
+            graph = self._graphs.get(session_id)
+            if graph is None:
+                graph = self._graphs[session_id] = SessionGraph(self.max_nodes)
+            self._graphs.move_to_end(session_id)
+            total = sum(len(g) for g in self._graphs.values())
+            while total > self.max_nodes > 0 and len(self._graphs) > 1:
+                _, dropped = self._graphs.popitem(last=False)
+                total -= len(dropped)
+            return graph
+
+    def forget(self, session_id):
+        with self._lock:
+            self._graphs.pop(session_id, None)
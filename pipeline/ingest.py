@@ -0,0 +1,291 @@
+import os
+import shutil
+import threading
+from collections import defaultdict
+from concurrent.futures import wait
+
+from pipeline import settings
+from pipeline.cache import get_cache
+from pipeline.executor import submit_image
+from pipeline.frame import content_hasher
+
+# Cheap stages analyzed while uploads arrive; their results land in the
+# analysis cache so processing the session later gets cache hits
+PREANALYSIS_OPTIONS = {"remove_duplicates": True, "sort_date": True}
+
+class UploadOutOfOrder(Exception):
+    """
+    Raised when a chunk does not start where the received data ends.
+    """
+
+    def __init__(self, offset):
+        super().__init__(f"Upload continues at offset {offset}")
+        self.offset = offset
+
+
+class ChunkRejected(Exception):
+    """
+    Raised when a chunk's body does not match its declared range, or the
+    received data would run past the declared total. The chunk's bytes
+    are discarded; the upload continues at offset.
+    """
+
+    def __init__(self, message, offset):
+        super().__init__(message)
+        self.offset = offset
+
+
+def _preanalyze(item):
+    # Imported here so the ingest module does not pull in every feature
+    from pipeline.engine import analyze_image
+    return analyze_image(item, PREANALYSIS_OPTIONS)
+
+
+class Ingestor:
+    """
+    Receives uploaded files into per-session directories.
+
+    Files are streamed to disk in chunks while their content hash is computed,
+    and each finished file is queued for background pre-analysis. Chunked
+    uploads are appended to a partial file that survives dropped connections,
+    so a client can ask for the received offset and resume from there.
+    """
+
+    def __init__(self, upload_dir, partial_dir):
+        self.upload_dir = upload_dir
+        # Kept apart from the upload dir, whose entries are all sessions
+        self.partial_dir = partial_dir
+        self._hashes = {}
+        self._partial_hashers = {}
+        # Total size declared by the first chunk of each partial upload
+        self._totals = {}
+        self._file_locks = {}
+        self._pending = defaultdict(list)
+        self._lock = threading.Lock()
+
+    def session_dir(self, session_id):
+        return os.path.join(self.upload_dir, session_id)
+
+    def _partial_path(self, session_id, filename):
+        return os.path.join(self.partial_dir, session_id, filename)
+
+    def save_stream(self, session_id, filename, fileobj):
+        """
+        Copies fileobj into the session, hashing it on the way. Returns the path.
+        """
+        path = os.path.join(self.session_dir(session_id), filename)
+        hasher = content_hasher()
+        with open(path, "wb") as buffer:
+            while True:
+                chunk = fileobj.read(settings.UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                hasher.update(chunk)
+                buffer.write(chunk)
+        self._file_landed(session_id, path, hasher.hexdigest())
+        return path
+
+    def received_offset(self, session_id, filename):
+        """
+        Bytes received so far for a chunked upload, and whether it is complete.
+        """
+        final_path = os.path.join(self.session_dir(session_id), filename)
+        if os.path.exists(final_path):
+            return os.path.getsize(final_path), True
+        partial_path = self._partial_path(session_id, filename)
+        if os.path.exists(partial_path):
+            return os.path.getsize(partial_path), False
+        return 0, False
+
+    def receiving(self, session_id):
+        """
+        Whether a chunked upload of the session is waiting for more chunks.
+        """
+        try:
+            with os.scandir(os.path.join(self.partial_dir, session_id)) as entries:
+                return any(True for _ in entries)
+        except FileNotFoundError:
+            return False
+
+    def begin_chunk(self, session_id, filename, start, end, total):
+        """
+        Validates that the chunk of bytes start..end (inclusive) continues
+        the partial file and returns a ChunkWriter for its body. Only one
+        chunk of a file is received at a time: a concurrent one is rejected
+        with UploadOutOfOrder. A chunk declaring another total than the
+        earlier chunks of the file raises ChunkRejected.
+        """
+        key = (session_id, filename)
+        with self._lock:
+            lock = self._file_locks.setdefault(key, threading.Lock())
+        if not lock.acquire(blocking=False):
+            raise UploadOutOfOrder(self.received_offset(session_id, filename)[0])
+        try:
+            offset, complete = self.received_offset(session_id, filename)
+            if complete or start != offset:
+                raise UploadOutOfOrder(offset)
+            with self._lock:
+                if offset:
+                    declared = self._totals.setdefault(key, total)
+                else:
+                    # A new upload, or one started over
+                    declared = self._totals[key] = total
+            if declared != total:
+                raise ChunkRejected(f"Chunk declares a {total}-byte file, earlier chunks {declared} bytes", offset)
+            os.makedirs(os.path.dirname(self._partial_path(session_id, filename)), exist_ok=True)
+        except BaseException:
+            lock.release()
+            raise
+        return ChunkWriter(self, session_id, filename, start, end, total, lock)
+
+    def append_chunk(self, session_id, filename, data):
+        """
+        Appends bytes to the partial file and the running content hash. Call
+        it through the ChunkWriter of begin_chunk, which holds the file's lock.
+        """
+        partial_path = self._partial_path(session_id, filename)
+        key = (session_id, filename)
+        with self._lock:
+            hasher = self._partial_hashers.get(key)
+            if hasher is None:
+                # First chunk, or the server restarted mid-upload: rehash what we have
+                hasher = content_hasher()
+                if os.path.exists(partial_path):
+                    with open(partial_path, "rb") as existing:
+                        for block in iter(lambda: existing.read(settings.UPLOAD_CHUNK_SIZE), b""):
+                            hasher.update(block)
+                self._partial_hashers[key] = hasher
+        with open(partial_path, "ab") as buffer:
+            buffer.write(data)
+        hasher.update(data)
+
+    def discard_chunk(self, session_id, filename, start):
+        """
+        Truncates the partial file back to start, dropping a rejected chunk.
+        """
+        with self._lock:
+            # Rehashed from the file on the next chunk
+            self._partial_hashers.pop((session_id, filename), None)
+        partial_path = self._partial_path(session_id, filename)
+        if os.path.exists(partial_path):
+            os.truncate(partial_path, start)
+
+    def finish_if_complete(self, session_id, filename, total):
+        """
+        Moves the partial file into the session once `total` bytes arrived.
+        Returns the received offset and whether the file is complete. More
+        than total bytes discards the partial file and raises ChunkRejected.
+        """
+        offset, complete = self.received_offset(session_id, filename)
+        if complete or offset < total:
+            return offset, complete
+        partial_path = self._partial_path(session_id, filename)
+        if offset > total:
+            with self._lock:
+                self._partial_hashers.pop((session_id, filename), None)
+                self._totals.pop((session_id, filename), None)
+            os.remove(partial_path)
+            raise ChunkRejected(f"Received {offset} bytes of a {total}-byte file; upload it again", 0)
+        final_path = os.path.join(self.session_dir(session_id), filename)
+        with self._lock:
+            hasher = self._partial_hashers.pop((session_id, filename), None)
+            self._totals.pop((session_id, filename), None)
+        if hasher is None:
+            hasher = content_hasher()
+            with open(partial_path, "rb") as existing:
+                for block in iter(lambda: existing.read(settings.UPLOAD_CHUNK_SIZE), b""):
+                    hasher.update(block)
+        os.replace(partial_path, final_path)
+        self._file_landed(session_id, final_path, hasher.hexdigest())
+        return offset, True
+
+    def _file_landed(self, session_id, path, content_hash):
+        with self._lock:
+            self._hashes[path] = content_hash
+        if settings.PREANALYZE_UPLOADS and get_cache() is not None:
+            future = submit_image(_preanalyze, (path, content_hash))
+            with self._lock:
+                self._pending[session_id].append(future)
+
+    def content_hashes(self, session_id):
+        """
+        Content hashes of the session's files computed during upload, by path.
+        """
+        prefix = self.session_dir(session_id) + os.sep
+        with self._lock:
+            return {path: h for path, h in self._hashes.items() if path.startswith(prefix)}
+
+    def wait_for_session(self, session_id):
+        """
+        Blocks until the session's queued pre-analysis has finished.
+        """
+        with self._lock:
+            pending = self._pending.pop(session_id, [])
+        wait(pending)
+
+    def forget_session(self, session_id):
+        """
+        Drops the in-memory state and partial files of a session.
+        """
+        prefix = self.session_dir(session_id) + os.sep
+        with self._lock:
+            for future in self._pending.pop(session_id, []):
+                future.cancel()
+            for path in [p for p in self._hashes if p.startswith(prefix)]:
+                del self._hashes[path]
+            for key in [k for k in self._partial_hashers if k[0] == session_id]:
+                del self._partial_hashers[key]
+            for key in [k for k in self._totals if k[0] == session_id]:
+                del self._totals[key]
+            for key in [k for k in self._file_locks if k[0] == session_id]:
+                del self._file_locks[key]
+        shutil.rmtree(os.path.join(self.partial_dir, session_id), ignore_errors=True)
+
+
+class ChunkWriter:
+    """
+    Receives the body of one chunk of a chunked upload, holding the file's
+    lock until closed. The body must be exactly end - start + 1 bytes: a
+    body of any other length is discarded and raises ChunkRejected.
+    """
+
+    def __init__(self, ingestor, session_id, filename, start, end, total, lock):
+        self.ingestor = ingestor
+        self.session_id = session_id
+        self.filename = filename
+        self.start = start
+        self.length = end - start + 1
+        self.total = total
+        self.received = 0
+        self._lock = lock
+
+    def write(self, data):
+        if self.received + len(data) > self.length:
+            self._reject()
+        self.ingestor.append_chunk(self.session_id, self.filename, data)
+        self.received += len(data)
+
+    def finish(self):
+        """
+        Checks the body length and moves a completed file into the session.
+        Returns the received offset and whether the file is complete.
+        """
+        if self.received != self.length:
+            self._reject()
+        return self.ingestor.finish_if_complete(self.session_id, self.filename, self.total)
+
+    def _reject(self):
+        self.ingestor.discard_chunk(self.session_id, self.filename, self.start)
+        raise ChunkRejected(
+            f"Chunk body does not match its Content-Range ({self.length} bytes)", self.start
+        )
+
+    def close(self):
+        self._lock.release()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        # A dropped connection keeps what arrived; the client resumes from there
+        self.close()
@@ -0,0 +1,291 @@
+import os
+import time
+import uuid
+import shutil
+import logging
+import threading
+
+from pipeline import settings
+from pipeline.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class SessionJanitor:
+    """
+    Removes upload sessions in the background, so disk use stays bounded
+    and startup does not have to wipe earlier sessions.
+
+    Every root holds one folder per session (uploads, partial uploads,
+    processed outputs). A session expires ttl_seconds after its last
+    activity: the newest file time in its folders, or a touch() by the app.
+    While all sessions together use more than quota_bytes, the least
+    recently active ones are removed too. Sessions for which is_busy
+    returns true, or that the app holds while it streams their files in or
+    out (see hold()), are never removed. Sessions for which is_receiving
+    returns true (a chunked upload is waiting for its next chunk) only
+    expire, they are not removed to meet the quota.
+
+    Sizes are kept per session between sweeps: a session's folders are only
+    walked again when the session is new, one of its folders changed, or it
+    was touched, held or busy since it was last measured.
+
+    Removal only renames a session's folders into trash_dir, so the session
+    disappears at once; the files are deleted afterwards on the janitor's
+    thread. on_remove(session_id) is called to drop in-memory state.
+    """
+
+    def __init__(self, roots, trash_dir=None, ttl_seconds=None, quota_bytes=None, interval=None,
+                 is_busy=None, is_receiving=None, on_remove=None):
+        self.roots = list(roots)
+        self.trash_dir = trash_dir or settings.TRASH_DIR
+        self.ttl_seconds = settings.SESSION_TTL_SECONDS if ttl_seconds is None else ttl_seconds
+        self.quota_bytes = settings.STORAGE_QUOTA_BYTES if quota_bytes is None else quota_bytes
+        self.interval = interval or settings.JANITOR_INTERVAL_SECONDS
+        self.is_busy = is_busy or (lambda session_id: False)
+        self.is_receiving = is_receiving or (lambda session_id: False)
+        self.on_remove = on_remove
+        self._touched = {}
+        self._holds = {}
+        # {session_id: [folders, bytes, last_modified]} as of the last measure,
+        # folders being (path, mtime) pairs; only the sweep reads or writes it
+        self._sessions = {}
+        self._dirty = set()
+        self._stats = {"sessions": 0, "bytes": 0, "reclaimed_bytes": 0,
+                       "removed_sessions": {"ttl": 0, "quota": 0}, "last_sweep": None}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def touch(self, session_id):
+        """
+        Records activity on a session, postponing its expiry.
+        """
+        with self._lock:
+            self._touched[session_id] = time.time()
+            self._dirty.add(session_id)
+
+    def hold(self, session_id):
+        """
+        Keeps a session from being removed until the returned SessionHold is
+        released, for example while an upload or a download is streaming.
+        """
+        with self._lock:
+            self._holds[session_id] = self._holds.get(session_id, 0) + 1
+            self._touched[session_id] = time.time()
+            self._dirty.add(session_id)
+        return SessionHold(self, session_id)
+
+    def _release(self, hold):
+        with self._lock:
+            if hold.released:
+                return
+            hold.released = True
+            count = self._holds.pop(hold.session_id) - 1
+            if count:
+                self._holds[hold.session_id] = count
+            # Files were written or read while held: measure the session again
+            self._touched[hold.session_id] = time.time()
+            self._dirty.add(hold.session_id)
+
+    def _in_use(self, session_id):
+        with self._lock:
+            if session_id in self._holds:
+                return True
+        return self.is_busy(session_id)
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._loop, name="session-janitor", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _loop(self):
+        # The first sweep runs right away, off the startup path
+        while not self._stop.is_set():
+            try:
+                self.sweep()
+            except Exception as e:
+                logger.warning(f"Session cleanup failed: {e}")
+            self._stop.wait(self.interval)
+
+    def _scan(self):
+        """
+        Size and last activity of every session on disk, as
+        {session_id: [paths, bytes, last_active]}. Sessions that did not
+        change since the last sweep keep their measured size.
+        """
+        found = {}
+        for root in self.roots:
+            try:
+                entries = [e for e in os.scandir(root) if e.is_dir(follow_symlinks=False)]
+            except FileNotFoundError:
+                continue
+            for entry in entries:
+                if entry.name.startswith("."):
+                    continue
+                try:
+                    mtime = entry.stat(follow_symlinks=False).st_mtime
+                except OSError:
+                    continue
+                found.setdefault(entry.name, []).append((entry.path, mtime))
+
+        with self._lock:
+            dirty, self._dirty = self._dirty, set()
+        for session_id in set(self._sessions) - set(found):
+            del self._sessions[session_id]
+        for session_id, folders in found.items():
+            cached = self._sessions.get(session_id)
+            if cached is not None and session_id not in dirty and cached[0] == folders:
+                continue
+            in_use = self._in_use(session_id)
+            size, last_modified = self._measure([path for path, _ in folders])
+            self._sessions[session_id] = [folders, size, last_modified]
+            if in_use or self._in_use(session_id):
+                # Files may still be changing: measure it again next sweep
+                with self._lock:
+                    self._dirty.add(session_id)
+
+        sessions = {}
+        with self._lock:
+            for session_id, (folders, size, last_modified) in self._sessions.items():
+                last_active = max(last_modified, self._touched.get(session_id, 0.0))
+                sessions[session_id] = [[path for path, _ in folders], size, last_active]
+        return sessions
+
+    def _measure(self, paths):
+        """
+        Total size and newest modification time of the files under paths.
+        Hard-linked files (kept images linked into the outputs) are counted
+        once.
+        """
+        size, last_modified = 0, 0.0
+        seen = set()
+        for path in paths:
+            for directory, _, filenames in os.walk(path):
+                for file_path in [directory] + [os.path.join(directory, name) for name in filenames]:
+                    try:
+                        stat = os.lstat(file_path)
+                    except OSError:
+                        continue
+                    last_modified = max(last_modified, stat.st_mtime)
+                    if file_path != directory and (stat.st_dev, stat.st_ino) not in seen:
+                        seen.add((stat.st_dev, stat.st_ino))
+                        size += stat.st_size
+        return size, last_modified
+
+    def sweep(self, now=None):
+        """
+        Removes expired sessions, then the least recently active ones while
+        over the quota, and empties the trash. Returns the removed session
+        ids by reason.
+        """
+        now = time.time() if now is None else now
+        sessions = self._scan()
+        removed = {"ttl": [], "quota": []}
+        total = sum(size for _, size, _ in sessions.values())
+
+        by_age = sorted(sessions.items(), key=lambda item: item[1][2])
+        for session_id, (paths, size, last_active) in by_age:
+            expired = self.ttl_seconds and last_active < now - self.ttl_seconds
+            over_quota = self.quota_bytes and total > self.quota_bytes
+            if not (expired or over_quota) or self._in_use(session_id):
+                continue
+            if not expired and self.is_receiving(session_id):
+                continue
+            reason = "ttl" if expired else "quota"
+            if not self._remove(session_id, paths):
+                continue
+            removed[reason].append(session_id)
+            total -= size
+            with self._lock:
+                self._stats["reclaimed_bytes"] += size
+                self._stats["removed_sessions"][reason] += 1
+            metrics.inc("sessions_removed_total", reason=reason)
+            metrics.inc("storage_reclaimed_bytes_total", size)
+            logger.info(f"Removed session {session_id} ({reason}, {size / (1024 * 1024):.1f} MB)")
+
+        with self._lock:
+            self._stats.update(sessions=len(sessions) - len(removed["ttl"]) - len(removed["quota"]),
+                               bytes=total, last_sweep=now)
+        metrics.set("storage_bytes", total)
+        self._empty_trash()
+        return removed
+
+    def _remove(self, session_id, paths):
+        """
+        Moves the session's folders into the trash, unless it was held since
+        the sweep checked it. Returns whether the session was removed.
+        """
+        os.makedirs(self.trash_dir, exist_ok=True)
+        # Under the lock, so no hold() can start while the folders move
+        with self._lock:
+            if session_id in self._holds:
+                return False
+            for path in paths:
+                try:
+                    # Same filesystem, so this is instant whatever the session's size
+                    os.rename(path, os.path.join(self.trash_dir, f"{session_id}-{uuid.uuid4().hex}"))
+                except OSError as e:
+                    logger.warning(f"Could not move {path} to the trash: {e}")
+                    shutil.rmtree(path, ignore_errors=True)
+            self._touched.pop(session_id, None)
+            self._dirty.discard(session_id)
+        self._sessions.pop(session_id, None)
+        if self.on_remove:
+            self.on_remove(session_id)
+        return True
+
+    def _empty_trash(self):
+        # Also clears what an interrupted run left behind
+        try:
+            entries = list(os.scandir(self.trash_dir))
+        except FileNotFoundError:
+            return
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                shutil.rmtree(entry.path, ignore_errors=True)
+            else:
+                try:
+                    os.remove(entry.path)
+                except OSError:
+                    pass
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats, removed_sessions=dict(self._stats["removed_sessions"]))
+        stats.update(ttl_seconds=self.ttl_seconds, quota_bytes=self.quota_bytes)
+        return stats
+
+
+class SessionHold:
+    """
+    A hold on a session, from SessionJanitor.hold(). Use it as a context
+    manager, or release() it; releasing it again does nothing.
+    """
+
+    def __init__(self, janitor, session_id):
+        self.janitor = janitor
+        self.session_id = session_id
+        self.released = False
+
+    def release(self):
+        self.janitor._release(self)
+
+    def stream(self, chunks):
+        """
+        Yields from chunks, releasing the hold once they are exhausted or
+        the stream is closed.
+        """
+        try:
+            yield from chunks
+        finally:
+            self.release()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
@@ -0,0 +1,170 @@
+import logging
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from pipeline import settings
+from pipeline.engine import PipelineCancelled
+from pipeline.metrics import metrics
+
+QUEUED = "queued"
+RUNNING = "running"
+COMPLETED = "completed"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+FINISHED_STATES = (COMPLETED, FAILED, CANCELLED)
+
+logger = logging.getLogger(__name__)
+
+
+class JobQueueFull(Exception):
+    """
+    Raised when the job queue has no room for another job.
+    """
+
+
+class SessionBusy(Exception):
+    """
+    Raised when a session already has a job queued or running.
+    """
+
+
+class Job:
+    """
+    A processing run for one session, executed in the background.
+    """
+
+    def __init__(self, session_id):
+        self.id = str(uuid.uuid4())
+        self.session_id = session_id
+        self.status = QUEUED
+        self.progress = {}
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.cancel_event = threading.Event()
+        self._lock = threading.Lock()
+
+    def update_progress(self, phase, done, total):
+        with self._lock:
+            self.progress[phase] = {"done": done, "total": total}
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                "job_id": self.id,
+                "session_id": self.session_id,
+                "status": self.status,
+                "progress": {phase: dict(p) for phase, p in self.progress.items()},
+                "result": self.result,
+                "error": self.error,
+                "created_at": self.created_at,
+                "started_at": self.started_at,
+                "finished_at": self.finished_at,
+            }
+
+
+class JobManager:
+    """
+    Runs jobs on a bounded pool of background threads.
+
+    At most max_concurrent jobs run at once; further jobs wait in the
+    executor's queue, and submissions beyond max_queued are rejected.
+    Finished jobs are kept for retention_seconds.
+    """
+
+    def __init__(self, max_concurrent=None, max_queued=None, retention_seconds=None):
+        self.max_concurrent = max_concurrent or settings.MAX_CONCURRENT_JOBS
+        self.max_queued = max_queued or settings.MAX_QUEUED_JOBS
+        self.retention_seconds = retention_seconds or settings.JOB_RETENTION_SECONDS
+        self._executor = ThreadPoolExecutor(max_workers=self.max_concurrent, thread_name_prefix="job")
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def submit(self, session_id, func):
+        """
+        Queues func(job) to run in the background and returns the job.
+        func reports progress through job.update_progress and should stop
+        with PipelineCancelled once job.cancel_event is set.
+        """
+        with self._lock:
+            self._prune()
+            active = [j for j in self._jobs.values() if j.status not in FINISHED_STATES]
+            if any(j.session_id == session_id for j in active):
+                raise SessionBusy(session_id)
+            if len(active) >= self.max_queued:
+                raise JobQueueFull()
+            job = Job(session_id)
+            self._jobs[job.id] = job
+        self._executor.submit(self._run, job, func)
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def session_active(self, session_id):
+        """
+        Whether the session has a job queued or running.
+        """
+        with self._lock:
+            return any(j.session_id == session_id and j.status not in FINISHED_STATES
+                       for j in self._jobs.values())
+
+    def cancel(self, job_id):
+        """
+        Requests cancellation. A queued job never starts; a running job stops
+        at its next checkpoint. Returns the job, or None if unknown.
+        """
+        job = self.get(job_id)
+        if job is None:
+            return None
+        job.cancel_event.set()
+        with job._lock:
+            if job.status == QUEUED:
+                job.status = CANCELLED
+                job.finished_at = time.time()
+                metrics.inc("jobs_total", status=CANCELLED)
+        return job
+
+    def shutdown(self):
+        for job in list(self._jobs.values()):
+            job.cancel_event.set()
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def _run(self, job, func):
+        with job._lock:
+            if job.status != QUEUED:
+                return
+            job.status = RUNNING
+            job.started_at = time.time()
+        metrics.inc("jobs_running")
+        try:
+            result = func(job)
+        except PipelineCancelled:
+            self._finish(job, CANCELLED)
+        except Exception as e:
+            logger.error(f"Job {job.id} failed: {e}")
+            self._finish(job, FAILED, error=str(e))
+        else:
+            self._finish(job, COMPLETED, result=result)
+
+    def _finish(self, job, status, result=None, error=None):
+        with job._lock:
+            job.status = status
+            job.result = result
+            job.error = error
+            job.finished_at = time.time()
+        metrics.inc("jobs_running", -1)
+        metrics.inc("jobs_total", status=status)
+        metrics.observe("job_seconds", job.finished_at - job.started_at)
+
+    def _prune(self):
+        cutoff = time.time() - self.retention_seconds
+        for job_id, job in list(self._jobs.items()):
+            if job.finished_at is not None and job.finished_at < cutoff:
+                del self._jobs[job_id]
@@ -0,0 +1,162 @@
+import bisect
+import logging
+import threading
+from collections import defaultdict
+
+from pipeline import settings
+
+# Prefix of every exported metric name
+METRIC_PREFIX = "imageprocessor_"
+
+# Upper bounds (seconds) of the timing histogram buckets, from a proxy
+# decode of a small JPEG to a background removal batch
+SECONDS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# Help text of the exported metrics, and their type
+METRICS = {
+    "stage_seconds": ("histogram", "Time spent per image in a pipeline stage, by span (decode, compute, write)"),
+    "select_seconds": ("histogram", "Time spent in a stage's selection step, per run"),
+    "job_seconds": ("histogram", "Duration of finished processing jobs"),
+    "jobs_total": ("counter", "Processing jobs finished, by final status"),
+    "jobs_running": ("gauge", "Processing jobs currently running"),
+    "images_in_total": ("counter", "Images entering the pipeline"),
+    "images_out_total": ("counter", "Images kept and placed in an output folder"),
+    "image_errors_total": ("counter", "Images that failed, by phase (analyze, write)"),
+    "cache_hits_total": ("counter", "Stage analyses served from the analysis cache"),
+    "cache_misses_total": ("counter", "Stage analyses computed after an analysis cache miss"),
+    "memory_waits_total": ("counter", "Times image work was held back because memory was above MEMORY_CEILING_MB"),
+    "thumbnails_total": ("counter", "Thumbnails rendered in the background or on request, or served from the cache, by source"),
+    "sessions_removed_total": ("counter", "Upload sessions removed by the janitor, by reason (ttl, quota)"),
+    "storage_reclaimed_bytes_total": ("counter", "Bytes freed by removing upload sessions and their outputs"),
+    "storage_bytes": ("gauge", "Bytes used by upload sessions and their outputs at the last janitor sweep"),
+}
+
+LOG_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+
+# Packages whose loggers follow settings.LOG_LEVEL; other libraries keep
+# logging warnings only
+APP_LOGGERS = ("features", "pipeline", "benchmarks")
+
+
+def configure_logging():
+    """
+    Sets up logging at settings.LOG_LEVEL for the app's own modules. Called
+    by the app and by every worker process, which starts with no logging
+    configuration.
+    """
+    logging.basicConfig(format=LOG_FORMAT)
+    for name in APP_LOGGERS:
+        logging.getLogger(name).setLevel(settings.LOG_LEVEL)
+
+
+class SpanTimer:
+    """
+    Accumulates per-stage spans for one image or run, as
+    {stage: {span: seconds}}. Workers return these with their results, so
+    the process that owns the metrics can record them.
+    """
+
+    def __init__(self):
+        self.spans = defaultdict(lambda: defaultdict(float))
+
+    def add(self, stage, span, seconds):
+        self.spans[stage][span] += seconds
+
+    def to_dict(self):
+        return {stage: dict(spans) for stage, spans in self.spans.items()}
+
+
+def add_spans(totals, spans):
+    """
+    Adds {stage: {span: seconds}} spans into totals, in place.
+    """
+    for stage, values in spans.items():
+        stage_totals = totals.setdefault(stage, {})
+        for span, seconds in values.items():
+            stage_totals[span] = stage_totals.get(span, 0.0) + seconds
+
+
+class MetricsRegistry:
+    """
+    Process-wide counters, gauges and histograms, rendered in the
+    Prometheus text exposition format. Metrics are identified by a name from
+    METRICS and a set of labels given as keyword arguments.
+    """
+
+    def __init__(self):
+        self._values = {}
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._values[key] = value
+
+    def observe(self, name, seconds, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                # Per-bucket counts (the last one is +Inf), sum and count
+                histogram = self._histograms[key] = [[0] * (len(SECONDS_BUCKETS) + 1), 0.0, 0]
+            histogram[0][bisect.bisect_left(SECONDS_BUCKETS, seconds)] += 1
+            histogram[1] += seconds
+            histogram[2] += 1
+
+    def observe_spans(self, spans):
+        """
+        Records {stage: {span: seconds}} spans of one image in stage_seconds.
+        """
+        for stage, values in spans.items():
+            for span, seconds in values.items():
+                self.observe("stage_seconds", seconds, stage=stage, span=span)
+
+    def render(self):
+        with self._lock:
+            values = dict(self._values)
+            histograms = {key: (list(h[0]), h[1], h[2]) for key, h in self._histograms.items()}
+
+        lines = []
+        for name, (kind, help_text) in METRICS.items():
+            full_name = METRIC_PREFIX + name
+            lines.append(f"# HELP {full_name} {help_text}")
+            lines.append(f"# TYPE {full_name} {kind}")
+            if kind == "histogram":
+                for (metric, labels), (buckets, total, count) in sorted(histograms.items()):
+                    if metric != name:
+                        continue
+                    cumulative = 0
+                    for bound, bucket in zip(SECONDS_BUCKETS + ("+Inf",), buckets):
+                        cumulative += bucket
+                        lines.append(f"{full_name}_bucket{_labels(labels + (('le', bound),))} {cumulative}")
+                    lines.append(f"{full_name}_sum{_labels(labels)} {total:.6f}")
+                    lines.append(f"{full_name}_count{_labels(labels)} {count}")
+            else:
+                for (metric, labels), value in sorted(values.items()):
+                    if metric == name:
+                        lines.append(f"{full_name}{_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    pairs = []
+    for key, value in labels:
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pairs.append(f'{key}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+# Shared by the pipeline, the job manager and the /metrics endpoint
+metrics = MetricsRegistry()
@@ -0,0 +1,193 @@
+import os
+import time
+import logging
+import threading
+
+import numpy as np
+
+from pipeline import settings
+
+logger = logging.getLogger(__name__)
+
+
+def _rss_bytes():
+    """
+    Current resident set size of this process, or None where unavailable.
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class ModelRegistry:
+    """
+    Process-wide store of loaded models (ONNX sessions, cascades, ...).
+
+    Models are loaded lazily on first use and then shared by every request.
+    Models that are not safe to call from several threads at once are
+    registered with per_thread=True and loaded once per thread instead.
+    Load time and the approximate change in resident memory are recorded
+    for every load.
+    """
+
+    def __init__(self):
+        self._specs = {}
+        self._models = {}
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._load_locks = {}
+        self._stats = {}
+
+    def register(self, name, loader, warm_up=None, per_thread=False):
+        """
+        Registers loader() as the way to build model `name`. warm_up(model),
+        if given, runs once after loading to prime lazy allocations.
+        """
+        with self._lock:
+            self._specs[name] = (loader, warm_up, per_thread)
+            self._load_locks[name] = threading.Lock()
+            self._stats[name] = {"loads": 0, "load_seconds": 0.0, "memory_bytes": None,
+                                 "per_thread": per_thread}
+
+    def get(self, name):
+        """
+        Returns model `name`, loading it on first use.
+        """
+        if name not in self._specs:
+            raise KeyError(f"Unknown model: {name}")
+        loader, warm_up, per_thread = self._specs[name]
+        if per_thread:
+            models = getattr(self._local, "models", None)
+            if models is None:
+                models = self._local.models = {}
+            if name not in models:
+                models[name] = self._load(name, loader, warm_up)
+            return models[name]
+
+        model = self._models.get(name)
+        if model is None:
+            # Concurrent first requests wait for one load instead of each loading
+            with self._load_locks[name]:
+                model = self._models.get(name)
+                if model is None:
+                    model = self._models[name] = self._load(name, loader, warm_up)
+        return model
+
+    def _load(self, name, loader, warm_up):
+        rss_before = _rss_bytes()
+        start = time.perf_counter()
+        model = loader()
+        if warm_up is not None:
+            warm_up(model)
+        elapsed = time.perf_counter() - start
+        rss_after = _rss_bytes()
+
+        with self._lock:
+            stats = self._stats[name]
+            stats["loads"] += 1
+            stats["load_seconds"] = round(elapsed, 3)
+            if rss_before is not None and rss_after is not None:
+                stats["memory_bytes"] = max(0, rss_after - rss_before)
+        logger.info(f"Loaded model {name} in {elapsed:.2f}s")
+        return model
+
+    def __contains__(self, name):
+        return name in self._specs
+
+    def warm_up(self, names):
+        """
+        Loads the named models now so the first request does not pay for it.
+        Failures are reported and otherwise ignored.
+        """
+        for name in names:
+            try:
+                self.get(name)
+            except Exception as e:
+                logger.warning(f"Could not warm up model {name}: {e}")
+
+    def stats(self):
+        """
+        Load counts, last load time and memory use of every registered model.
+        """
+        with self._lock:
+            return {name: dict(stats, loaded=stats["loads"] > 0) for name, stats in self._stats.items()}
+
+
+def _load_face_detector():
+    # Imported here: the features package itself uses the registry
+    from features.face_detection import load_face_detector
+    return load_face_detector()
+
+
+def _load_face_embedder():
+    from features.face_cluster import load_face_embedder
+    return load_face_embedder()
+
+
+def _load_rembg_session():
+    from rembg import new_session
+    return new_session(settings.REMBG_MODEL)
+
+
+def _warm_up_rembg(session):
+    from PIL import Image
+    from rembg import remove
+    remove(Image.fromarray(np.zeros((64, 64, 3), dtype=np.uint8)), session=session)
+
+
+def _rembg_model_path(session):
+    download = getattr(type(session), "download_models", None)
+    if download is not None:
+        return str(download())
+    home = os.path.expanduser(os.getenv("U2NET_HOME", os.path.join("~", ".u2net")))
+    return os.path.join(home, f"{settings.REMBG_MODEL}.onnx")
+
+
+def _load_onnx_session(threads):
+    import onnxruntime as ort
+    # Loading the rembg session first makes sure the model file is downloaded
+    rembg_session = registry.get("rembg")
+    options = ort.SessionOptions()
+    options.intra_op_num_threads = threads
+    return ort.InferenceSession(
+        _rembg_model_path(rembg_session),
+        sess_options=options,
+        providers=rembg_session.inner_session.get_providers(),
+    )
+
+
+registry = ModelRegistry()
+_register_lock = threading.Lock()
+
+# OpenCV cascades and DNN networks (YuNet, SFace) keep per-call state, so
+# every thread gets its own copy
+registry.register("face_detector", _load_face_detector, per_thread=True)
+registry.register("face_embedder", _load_face_embedder, per_thread=True)
+# ONNX Runtime sessions can be run from several threads at once
+registry.register("rembg", _load_rembg_session, warm_up=_warm_up_rembg)
+
+
+def get_model(name):
+    """
+    Returns a model from the process-wide registry.
+    """
+    return registry.get(name)
+
+
+def get_onnx_session(threads=0):
+    """
+    Returns the ONNX Runtime session of the rembg model, for running it
+    directly. threads sets intra-op parallelism; 0 reuses the session inside
+    the shared rembg session, other values load one session per count, so
+    they are capped at settings.BACKGROUND_MAX_THREADS.
+    """
+    if not threads:
+        return registry.get("rembg").inner_session
+    threads = min(threads, settings.BACKGROUND_MAX_THREADS)
+    name = f"rembg-onnx:{threads}"
+    with _register_lock:
+        if name not in registry:
+            registry.register(name, lambda: _load_onnx_session(threads))
+    return registry.get(name)
@@ -0,0 +1,111 @@
+import errno
+import json
+import os
+import shutil
+
+from pipeline import settings
+
+OUTPUT_MODES = ("link", "copy", "manifest")
+
+# Formats of images with a removed background, which keep transparency,
+# with their file extensions
+CUTOUT_FORMATS = {"png": ".png", "webp": ".webp"}
+
+# Name of the file listing the outputs of a run and their sources
+MANIFEST_FILENAME = "manifest.json"
+
+# Linux ioctl that clones a file's extents (reflink) on btrfs, XFS, etc.
+FICLONE = 0x40049409
+
+
+def _reflink(src, dst):
+    import fcntl
+    with open(src, "rb") as src_file, open(dst, "wb") as dst_file:
+        fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+    shutil.copystat(src, dst)
+
+
+def link_or_copy(src, dst):
+    """
+    Places src at dst without copying data where the filesystem allows it:
+    a reflink first, then a hardlink, then a plain copy.
+    Returns the method used.
+    """
+    if os.path.lexists(dst):
+        os.remove(dst)
+    try:
+        _reflink(src, dst)
+        return "reflink"
+    except (ImportError, OSError):
+        if os.path.exists(dst):
+            os.remove(dst)
+    try:
+        os.link(src, dst)
+        return "hardlink"
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP, errno.EACCES):
+            raise
+    shutil.copy2(src, dst)
+    return "copy"
+
+
+def materialize(src, dst, mode=None, known_dirs=None):
+    """
+    Places an unchanged source image at dst according to the output mode.
+    Returns True if a file now exists at dst, False in manifest mode.
+    known_dirs, a set shared across calls, records the folders already
+    created so each is only created once; on network filesystems every
+    check is a round trip.
+    """
+    mode = mode or settings.OUTPUT_MODE
+    if mode == "manifest":
+        return False
+    folder = os.path.dirname(dst)
+    if known_dirs is None or folder not in known_dirs:
+        os.makedirs(folder, exist_ok=True)
+        if known_dirs is not None:
+            known_dirs.add(folder)
+    if mode == "copy":
+        if os.path.lexists(dst):
+            # dst may be a link to src left by an earlier run
+            os.remove(dst)
+        shutil.copy2(src, dst)
+    else:
+        link_or_copy(src, dst)
+    return True
+
+
+def write_manifest(output_dir, entries):
+    """
+    Writes the manifest of a run: one entry per output with its
+    relative_path, source file and whether it was written to disk.
+    """
+    with open(os.path.join(output_dir, MANIFEST_FILENAME), "w") as f:
+        json.dump({"images": entries}, f, indent=2)
+
+
+def read_manifest(output_dir):
+    """
+    Returns the manifest entries of a run, or [] if it has none.
+    """
+    path = os.path.join(output_dir, MANIFEST_FILENAME)
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return json.load(f).get("images", [])
+
+
+def resolve_output(output_dir, relative_path):
+    """
+    Returns the file backing an output: the written file, or for
+    manifest-only outputs the source it refers to. None if unknown.
+    """
+    path = os.path.normpath(os.path.join(output_dir, relative_path))
+    if not path.startswith(os.path.normpath(output_dir) + os.sep):
+        return None
+    if os.path.isfile(path):
+        return path
+    for entry in read_manifest(output_dir):
+        if entry["relative_path"] == relative_path:
+            return entry["source"]
+    return None
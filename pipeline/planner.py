@@ -0,0 +1,126 @@
+import threading
+
+# Per-image cost (seconds) assumed for a stage's analysis until a run has
+# measured it: face detection dominates, hashing and metadata reads are cheap
+DEFAULT_COSTS = {
+    "detect_faces": 0.25,
+    "embed_faces": 0.1,
+    "remove_blur": 0.05,
+    "remove_duplicates": 0.01,
+    "sort_date": 0.001,
+}
+DEFAULT_COST = 0.05
+
+# Share of images a predicate is assumed to keep until it has been measured
+DEFAULT_PASS_RATE = 0.5
+
+# Weight of the latest run in the running estimates, so they follow changes
+# in the images (and in the analysis cache) without jumping on one odd run
+ESTIMATE_WEIGHT = 0.3
+
+# Smallest reject rate used for ranking, so predicates that rarely reject
+# anything are still ordered by their cost
+MIN_REJECT_RATE = 0.01
+
+
+class StageEstimates:
+    """
+    Running estimates, from the runs of this process, of every stage's
+    per-image analysis cost and of every predicate's pass rate.
+    """
+
+    def __init__(self):
+        self._costs = {}
+        self._pass_rates = {}
+        self._lock = threading.Lock()
+
+    def cost(self, name):
+        with self._lock:
+            return self._costs.get(name, DEFAULT_COSTS.get(name, DEFAULT_COST))
+
+    def pass_rate(self, name):
+        with self._lock:
+            return self._pass_rates.get(name, DEFAULT_PASS_RATE)
+
+    def record_cost(self, name, seconds, images):
+        if images:
+            with self._lock:
+                self._costs[name] = _blend(self._costs.get(name), seconds / images)
+
+    def record_pass_rate(self, name, passed, seen):
+        if seen:
+            with self._lock:
+                self._pass_rates[name] = _blend(self._pass_rates.get(name), passed / seen)
+
+
+def _blend(previous, measured):
+    if previous is None:
+        return measured
+    return previous + ESTIMATE_WEIGHT * (measured - previous)
+
+
+class StagePlan:
+    """
+    The order a run executes its stages in.
+
+    prefilters are run first, on every image: their analysis and then their
+    selection, which only drops frames. sequence is run per image, with the
+    predicates (stages with keep) first, cheapest to reject an image first,
+    and an image stops at the first predicate that rejects it; the analyses
+    only survivors need follow. selects are the remaining selection steps,
+    in declared order.
+    """
+
+    def __init__(self, prefilters, sequence, selects):
+        self.prefilters = prefilters
+        self.sequence = sequence
+        self.selects = selects
+
+    def stage_names(self):
+        return [stage.name for stage in self.prefilters + self.sequence]
+
+
+def plan_stages(stages, estimates=None):
+    """
+    Plans the execution of stages built by build_stages. Predicates are
+    independent keep/drop tests, so any order keeps the same images; they
+    are ordered greedily by the cost of the analyses still needed to
+    evaluate them over their reject rate, which minimizes the expected work
+    per image. estimates defaults to those measured by this process.
+    """
+    if estimates is None:
+        estimates = stage_estimates
+    by_name = {stage.name: stage for stage in stages}
+    per_image = [s for s in stages if not s.prefilter and (s.analyze or s.keep)]
+    sequence = []
+    placed = set()
+
+    def unplaced(stage):
+        # The stage and the analyses it reads, those not in the sequence yet
+        needed = [by_name[name] for name in stage.requires if name in by_name and name not in placed]
+        return needed + ([stage] if stage.name not in placed else [])
+
+    def rank(stage):
+        cost = sum(estimates.cost(s.name) for s in unplaced(stage) if s.analyze)
+        return cost / max(1 - estimates.pass_rate(stage.name), MIN_REJECT_RATE)
+
+    def place(stage):
+        for needed in unplaced(stage):
+            sequence.append(needed)
+            placed.add(needed.name)
+
+    predicates = [s for s in per_image if s.keep is not None]
+    while predicates:
+        # Ties keep the declared order
+        best = min(predicates, key=rank)
+        predicates.remove(best)
+        place(best)
+    for stage in per_image:
+        place(stage)
+
+    selects = [s for s in stages if s.select is not None and not s.prefilter]
+    return StagePlan([s for s in stages if s.prefilter], sequence, selects)
+
+
+# Shared by every run of this process
+stage_estimates = StageEstimates()
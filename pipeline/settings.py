@@ -0,0 +1,129 @@
+import os
+
+# Settings are read from environment variables so deployments can tune them
+# without code changes.
+
+# How per-image work is fanned out: "process", "thread", "serial" or
+# "broker". Thread pools suit stages dominated by GIL-releasing OpenCV calls;
+# "broker" queues the work on BROKER_URL for worker processes to pull.
+EXECUTOR_KIND = os.environ.get("IMAGE_EXECUTOR", "process")
+
+# Number of workers in the pool (defaults to the number of CPUs)
+WORKER_COUNT = int(os.environ.get("IMAGE_WORKERS", "0")) or os.cpu_count() or 1
+
+# Images handed to a worker per task; analyses with a batched form (see
+# Stage.analyze_batch) compute all of them at once
+CHUNK_SIZE = int(os.environ.get("IMAGE_CHUNK_SIZE", "8"))
+
+# Task queue of the "broker" executor: "memory://" runs IMAGE_WORKERS worker
+# threads in this process; "sqlite:///path" is a queue file that workers
+# started with `python -m pipeline.worker` pull from, on this machine or any
+# sharing the file system (images are passed by path). Tasks and results
+# are pickles, which run code when loaded: the queue file is created
+# owner-only, and must never be writable by anyone untrusted
+BROKER_URL = os.environ.get("BROKER_URL", "memory://")
+
+# Seconds a worker may hold a task before it is handed to another worker,
+# so the tasks of a worker that died are not lost
+BROKER_LEASE_SECONDS = int(os.environ.get("BROKER_LEASE_SECONDS", "300"))
+
+# Seconds between two polls of a SQLite queue when it has nothing to hand out
+BROKER_POLL_SECONDS = float(os.environ.get("BROKER_POLL_SECONDS", "0.05"))
+
+# Images submitted to the pool or waiting to be collected at once; bounds
+# memory on large sessions (0: twice the workers times the chunk size)
+PIPELINE_WINDOW = int(os.environ.get("PIPELINE_WINDOW", "0"))
+
+# Resident memory (MB) of the app and its worker processes above which no
+# new image work is submitted until in-flight images finish (0: no ceiling).
+# Set it below the container limit, leaving room for the largest decodes.
+MEMORY_CEILING_MB = int(os.environ.get("MEMORY_CEILING_MB", "0"))
+
+# Processing jobs allowed to run at the same time
+MAX_CONCURRENT_JOBS = int(os.environ.get("MAX_CONCURRENT_JOBS", "2"))
+
+# Jobs allowed to wait or run before new submissions are rejected
+MAX_QUEUED_JOBS = int(os.environ.get("MAX_QUEUED_JOBS", "16"))
+
+# Seconds a finished job stays queryable
+JOB_RETENTION_SECONDS = int(os.environ.get("JOB_RETENTION_SECONDS", "3600"))
+
+# Persistent cache of per-image analysis results, keyed by file content.
+# Set ANALYSIS_CACHE_PATH to an empty string to disable it.
+ANALYSIS_CACHE_PATH = os.environ.get("ANALYSIS_CACHE_PATH", "temp/cache/analysis.sqlite3")
+
+# Size cap of the analysis cache; least recently used entries are evicted
+ANALYSIS_CACHE_MAX_BYTES = int(os.environ.get("ANALYSIS_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+
+# Results memoized in memory for re-runs of upload sessions (analyses,
+# selections, renders), over all sessions; the least recently used ones are
+# dropped and computed again if needed (0: no limit)
+SESSION_GRAPH_MAX_NODES = int(os.environ.get("SESSION_GRAPH_MAX_NODES", "200000"))
+
+# Bytes read per step while streaming an upload to disk
+UPLOAD_CHUNK_SIZE = int(os.environ.get("UPLOAD_CHUNK_SIZE", str(1024 * 1024)))
+
+# Analyze cheap features (hashes, EXIF date) in the background as files land
+PREANALYZE_UPLOADS = os.environ.get("PREANALYZE_UPLOADS", "1") != "0"
+
+# How surviving images are placed in the output folder: "link" (reflink or
+# hardlink, falling back to a copy), "copy", or "manifest" (only list them)
+OUTPUT_MODE = os.environ.get("OUTPUT_MODE", "link")
+
+# Decode JPEGs at reduced resolution (DCT scaling) for stages that analyze
+# downscaled images; set to 0 to always decode full frames
+PROXY_DECODING = os.environ.get("PROXY_DECODING", "1") != "0"
+
+# rembg model used for background removal
+REMBG_MODEL = os.environ.get("REMBG_MODEL", "u2net")
+
+# Background removal defaults, overridable per request: images per ONNX
+# inference, ONNX Runtime intra-op threads (0 lets it decide) and the output
+# format ("png" or "webp", both with alpha)
+BACKGROUND_BATCH_SIZE = int(os.environ.get("BACKGROUND_BATCH_SIZE", "8"))
+BACKGROUND_THREADS = int(os.environ.get("BACKGROUND_THREADS", "0"))
+BACKGROUND_FORMAT = os.environ.get("BACKGROUND_FORMAT", "png")
+
+# Largest values requests may ask for: every distinct thread count loads its
+# own copy of the model, and every image of a batch is held decoded
+BACKGROUND_MAX_BATCH_SIZE = int(os.environ.get("BACKGROUND_MAX_BATCH_SIZE", "32"))
+BACKGROUND_MAX_THREADS = int(os.environ.get("BACKGROUND_MAX_THREADS", "0")) or os.cpu_count() or 1
+
+# Face detector shared by the face features: "haar" (OpenCV's frontal face
+# cascade) or "yunet" (OpenCV's YuNet CNN, face_detection_yunet_2023mar.onnx
+# from the OpenCV model zoo, at FACE_DETECTOR_MODEL). YuNet is faster, finds
+# turned faces and gives the landmarks used to align face embeddings; the
+# cascade is used when its model file is missing.
+FACE_DETECTOR = os.environ.get("FACE_DETECTOR", "haar")
+FACE_DETECTOR_MODEL = os.environ.get("FACE_DETECTOR_MODEL", "models/face_detection_yunet_2023mar.onnx")
+
+# SFace ONNX model (face_recognition_sface_2021dec.onnx from the OpenCV
+# model zoo) used to compute face embeddings. When the file is missing, face
+# clustering only separates images with faces from images without.
+FACE_EMBEDDING_MODEL = os.environ.get("FACE_EMBEDDING_MODEL", "models/face_recognition_sface_2021dec.onnx")
+
+# Comma-separated models to load at startup instead of on first use
+# (e.g. "face_detector,face_embedder,rembg")
+WARM_UP_MODELS = [name.strip() for name in os.environ.get("WARM_UP_MODELS", "").split(",") if name.strip()]
+
+# Logging level of the app and its workers; per-image messages are logged
+# at DEBUG, so the console stays quiet on large sessions
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+
+# Previews of processed images: WebP files keyed by content hash and size,
+# generated in the background as a job writes each image. THUMBNAIL_SIZES
+# lists the longest sides (pixels) served; the oldest files are evicted
+# above the cap
+THUMBNAIL_DIR = os.environ.get("THUMBNAIL_DIR", "temp/cache/thumbnails")
+THUMBNAIL_SIZES = [int(size) for size in os.environ.get("THUMBNAIL_SIZES", "256,1024").split(",") if size.strip()]
+THUMBNAIL_QUALITY = int(os.environ.get("THUMBNAIL_QUALITY", "80"))
+THUMBNAIL_CACHE_MAX_BYTES = int(os.environ.get("THUMBNAIL_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+
+# Upload sessions and their outputs are removed by a background janitor:
+# after SESSION_TTL_SECONDS without activity, and oldest first while all
+# sessions together use more than STORAGE_QUOTA_BYTES (0: no quota).
+# Removed folders are moved to TRASH_DIR and deleted from there
+SESSION_TTL_SECONDS = int(os.environ.get("SESSION_TTL_SECONDS", str(24 * 3600)))
+STORAGE_QUOTA_BYTES = int(os.environ.get("STORAGE_QUOTA_BYTES", str(10 * 1024 ** 3)))
+JANITOR_INTERVAL_SECONDS = int(os.environ.get("JANITOR_INTERVAL_SECONDS", "60"))
+TRASH_DIR = os.environ.get("TRASH_DIR", "temp/trash")
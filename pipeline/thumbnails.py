@@ -0,0 +1,224 @@
+import os
+import time
+import uuid
+import logging
+import threading
+from collections import OrderedDict, defaultdict
+
+import cv2
+import numpy as np
+
+from pipeline import settings
+from pipeline.executor import submit_image, ImageError
+from pipeline.frame import ImageFrame
+from pipeline.metrics import metrics
+
+# Part of every ETag; bump it when rendering changes so clients refetch
+THUMBNAIL_VERSION = "webp:v1"
+
+# Files JPEG DCT scaling applies to; other formats are decoded in full,
+# keeping their alpha channel (background-removed cutouts)
+_JPEG_EXTENSIONS = (".jpg", ".jpeg")
+
+# Content hashes remembered by file path, size and modification time, so
+# serving a cached thumbnail does not rehash its source
+HASH_MEMO_ENTRIES = 100_000
+
+# Seconds between two scans of the cache for eviction; images are queued
+# one by one while a job writes them, so the queue often runs empty
+EVICTION_INTERVAL_SECONDS = 30
+
+logger = logging.getLogger(__name__)
+
+
+def thumbnail_path(directory, content_hash, size):
+    # Two-level layout keeps directories small on large caches
+    return os.path.join(directory, content_hash[:2], f"{content_hash}_{size}.webp")
+
+
+def render_thumbnail(frame, size):
+    """
+    Returns the frame's pixels with the longer side scaled down to at most
+    size pixels. JPEGs are decoded at the coarsest DCT reduction that is
+    still large enough, so previews never decode the full frame.
+    """
+    if os.path.splitext(frame.path)[1].lower() in _JPEG_EXTENSIONS:
+        width, height = frame.size
+        image, _ = frame.proxy(max(1, size * width // max(width, height)))
+    else:
+        image = cv2.imdecode(np.fromfile(frame.path, dtype=np.uint8), cv2.IMREAD_UNCHANGED)
+        if image is None:
+            raise ValueError(f"Could not decode image: {frame.filename}")
+        if image.dtype == np.uint16:
+            image = (image >> 8).astype(np.uint8)
+    longest = max(image.shape[:2])
+    if longest > size:
+        scale = size / longest
+        image = cv2.resize(image, (max(1, round(image.shape[1] * scale)), max(1, round(image.shape[0] * scale))),
+                           interpolation=cv2.INTER_AREA)
+    return image
+
+
+def write_thumbnails(item):
+    """
+    Renders the missing thumbnails of one image; the unit of work sent to
+    workers. item is (path, content_hash, sizes, directory, quality), with
+    content_hash None when unknown. Returns the content hash.
+    """
+    path, content_hash, sizes, directory, quality = item
+    frame = ImageFrame(path, content_hash)
+    # The hash is computed from the bytes the decode reads anyway
+    content_hash = frame.content_hash
+    for size in sizes:
+        target = thumbnail_path(directory, content_hash, size)
+        if os.path.exists(target):
+            continue
+        ok, encoded = cv2.imencode(".webp", render_thumbnail(frame, size), [cv2.IMWRITE_WEBP_QUALITY, quality])
+        if not ok:
+            raise ValueError(f"Could not encode a thumbnail of {frame.filename}")
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        # Written aside and renamed, so readers never see a partial file
+        partial = f"{target}.{uuid.uuid4().hex}.tmp"
+        encoded.tofile(partial)
+        os.replace(partial, target)
+    frame.release()
+    return content_hash
+
+
+class ThumbnailStore:
+    """
+    On-disk cache of image previews, keyed by content hash and size.
+
+    generate() renders a session's results in the background on the shared
+    worker pool; get() serves a preview, rendering it on the spot when the
+    background work has not reached it yet. Above max_bytes the oldest
+    files are evicted, at most every EVICTION_INTERVAL_SECONDS.
+    """
+
+    def __init__(self, directory=None, sizes=None, quality=None, max_bytes=None):
+        self.directory = directory or settings.THUMBNAIL_DIR
+        self.sizes = list(sizes or settings.THUMBNAIL_SIZES)
+        self.quality = quality or settings.THUMBNAIL_QUALITY
+        self.max_bytes = max_bytes or settings.THUMBNAIL_CACHE_MAX_BYTES
+        self._hashes = OrderedDict()
+        self._pending = defaultdict(list)
+        self._last_eviction = 0.0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _file_key(path):
+        stat = os.stat(path)
+        return os.path.abspath(path), stat.st_size, stat.st_mtime_ns
+
+    def _remember(self, key, content_hash):
+        with self._lock:
+            self._hashes[key] = content_hash
+            self._hashes.move_to_end(key)
+            while len(self._hashes) > HASH_MEMO_ENTRIES:
+                self._hashes.popitem(last=False)
+
+    def etag(self, content_hash, size):
+        return f'"{content_hash}-{size}-{THUMBNAIL_VERSION}"'
+
+    def generate(self, session_id, paths):
+        """
+        Queues every size of the given images for rendering in the
+        background; the oldest thumbnails are evicted once the session has
+        nothing left queued.
+        """
+        for path in paths:
+            try:
+                key = self._file_key(path)
+            except OSError:
+                continue
+            with self._lock:
+                content_hash = self._hashes.get(key)
+            if content_hash and all(os.path.exists(thumbnail_path(self.directory, content_hash, size))
+                                    for size in self.sizes):
+                continue
+            future = submit_image(write_thumbnails, (path, content_hash, self.sizes, self.directory, self.quality))
+            # Tracked before the callback is attached, which may run at once
+            with self._lock:
+                self._pending[session_id].append(future)
+            future.add_done_callback(lambda f, key=key: self._generated(session_id, key, f))
+
+    def _generated(self, session_id, key, future):
+        with self._lock:
+            pending = self._pending.get(session_id, [])
+            if future in pending:
+                pending.remove(future)
+            evict = False
+            if not pending:
+                self._pending.pop(session_id, None)
+                now = time.monotonic()
+                evict = now - self._last_eviction >= EVICTION_INTERVAL_SECONDS
+                if evict:
+                    self._last_eviction = now
+        if not future.cancelled():
+            error = future.exception()
+            result = None if error else future.result()
+            if isinstance(result, ImageError):
+                error = result.error
+            if error:
+                logger.warning(f"Could not render thumbnails of {key[0]}: {error}")
+            else:
+                self._remember(key, result)
+                metrics.inc("thumbnails_total", len(self.sizes), source="background")
+        if evict:
+            # Callbacks run on the pool's own thread; scan the cache elsewhere
+            threading.Thread(target=self.evict, daemon=True).start()
+
+    def get(self, path, size):
+        """
+        Returns (thumbnail path, ETag) of the image at path, rendering the
+        thumbnail now if it is not cached yet.
+        """
+        key = self._file_key(path)
+        with self._lock:
+            content_hash = self._hashes.get(key)
+        if content_hash is None or not os.path.exists(thumbnail_path(self.directory, content_hash, size)):
+            content_hash = write_thumbnails((path, content_hash, [size], self.directory, self.quality))
+            self._remember(key, content_hash)
+            metrics.inc("thumbnails_total", source="request")
+        else:
+            metrics.inc("thumbnails_total", source="cache")
+        return thumbnail_path(self.directory, content_hash, size), self.etag(content_hash, size)
+
+    def forget_session(self, session_id):
+        """
+        Cancels the session's thumbnails not rendered yet.
+        """
+        with self._lock:
+            pending = self._pending.pop(session_id, [])
+        for future in pending:
+            future.cancel()
+
+    def evict(self):
+        """
+        Deletes the oldest thumbnails while the cache is above max_bytes.
+        Returns the number of files deleted.
+        """
+        entries = []
+        total = 0
+        try:
+            shards = list(os.scandir(self.directory))
+        except FileNotFoundError:
+            return 0
+        for shard in shards:
+            if not shard.is_dir():
+                continue
+            for entry in os.scandir(shard.path):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+                total += stat.st_size
+        removed = 0
+        for _, file_size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= file_size
+            removed += 1
+        return removed
@@ -0,0 +1,57 @@
+import sys
+import logging
+import argparse
+import multiprocessing
+
+from pipeline import settings
+from pipeline.broker import open_broker, run_worker
+from pipeline.executor import _init_worker
+from pipeline.metrics import configure_logging
+
+logger = logging.getLogger(__name__)
+
+
+def _run(url):
+    _init_worker()
+    try:
+        run_worker(open_broker(url))
+    except KeyboardInterrupt:
+        # A task cut short is handed to another worker once its lease ends
+        pass
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m pipeline.worker",
+        description="Run the image work queued on a broker by the app or the batch CLI (IMAGE_EXECUTOR=broker)"
+    )
+    parser.add_argument("--broker", default=settings.BROKER_URL, help="defaults to BROKER_URL")
+    parser.add_argument("--processes", type=int, default=settings.WORKER_COUNT,
+                        help="worker processes to run (defaults to IMAGE_WORKERS)")
+    args = parser.parse_args(argv)
+
+    if args.broker == "memory://":
+        parser.error("an in-memory broker is only reachable from its own process; use a sqlite:/// URL")
+    try:
+        open_broker(args.broker).close()
+    except ValueError as e:
+        parser.error(str(e))
+
+    configure_logging()
+    logger.info(f"Running {args.processes} workers on {args.broker}")
+    context = multiprocessing.get_context("spawn")
+    processes = [context.Process(target=_run, args=(args.broker,), name=f"worker-{index}")
+                 for index in range(args.processes)]
+    for process in processes:
+        process.start()
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        for process in processes:
+            process.join()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -24,8 +24,17 @@ document.addEventListener('DOMContentLoaded', function() {
     const sortDate = document.getElementById('sort-date');
     const removeBackground = document.getElementById('remove-background');
     
+    // Chunked upload settings
+    const UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024;
+    const UPLOAD_MAX_RETRIES = 5;
+    
+    // Preview sizes (longer side, pixels) served by the thumbnail endpoint
+    const GRID_THUMBNAIL_SIZE = 256;
+    const MODAL_PREVIEW_SIZE = 1024;
+    
     // Uploaded images storage
     let uploadedImages = [];
+    let uploadSessionId = null;
     let stream = null;
     
     // Event Listeners
@@ -135,23 +144,9 @@ document.addEventListener('DOMContentLoaded', function() {
         processButton.disabled = true;
         processButton.textContent = 'Processing...';
         
-        // Create form data for the API request
-        const formData = new FormData();
-        
-        // Add all images to the form data
-        uploadedImages.forEach(img => {
-            formData.append('files', img.file);
-        });
-        
-        // First upload the images
-        fetch('/api/upload', {
-            method: 'POST',
-            body: formData
-        })
-        .then(response => response.json())
-        .then(data => {
-            const sessionId = data.session_id;
-            
+        // First upload the images in resumable chunks
+        uploadImagesResumable()
+        .then(sessionId => {
             // Create form data for processing
             const processFormData = new FormData();
             processFormData.append('session_id', sessionId);
@@ -174,7 +169,13 @@ document.addEventListener('DOMContentLoaded', function() {
                 body: processFormData
             });
         })
-        .then(response => response.json())
+        .then(response => {
+            if (!response.ok) {
+                throw new Error(`Processing request failed: ${response.status}`);
+            }
+            return response.json();
+        })
+        .then(job => waitForJob(job.job_id))
         .then(data => {
             // Store the session ID for download
             window.currentSessionId = data.session_id;
@@ -193,12 +194,111 @@ document.addEventListener('DOMContentLoaded', function() {
             console.error('Error processing images:', error);
             alert('Error processing images. Please try again.');
             
+            // Start over in a new session next time, in case this one is gone
+            uploadSessionId = null;
+            uploadedImages.forEach(img => { img.uploaded = false; });
+            
             // Reset button state
             processButton.disabled = false;
             processButton.innerHTML = '<img src="assets/process-icon.svg" alt="Process" class="process-icon">Process Images';
         });
     }
     
+    // Upload the selected images and resolve with the session id. The session
+    // is kept across runs and only new images are sent, so processing again
+    // with other options reuses the server's results for unchanged stages.
+    async function uploadImagesResumable() {
+        if (!uploadSessionId) {
+            const response = await fetch('/api/sessions', { method: 'POST' });
+            uploadSessionId = (await response.json()).session_id;
+        }
+        
+        for (let i = 0; i < uploadedImages.length; i++) {
+            if (uploadedImages[i].uploaded) continue;
+            processButton.textContent = `Uploading ${i + 1}/${uploadedImages.length}...`;
+            await uploadFileResumable(uploadSessionId, uploadedImages[i].file);
+            uploadedImages[i].uploaded = true;
+        }
+        return uploadSessionId;
+    }
+    
+    // Upload one file in chunks, resuming from the server's offset after failures
+    async function uploadFileResumable(sessionId, file) {
+        if (file.size === 0) return;
+        const url = `/api/upload/${sessionId}/${encodeURIComponent(file.name)}`;
+        let offset = await fetchUploadOffset(url);
+        let failures = 0;
+        
+        while (offset < file.size) {
+            const end = Math.min(offset + UPLOAD_CHUNK_SIZE, file.size);
+            try {
+                const response = await fetch(url, {
+                    method: 'PUT',
+                    headers: { 'Content-Range': `bytes ${offset}-${end - 1}/${file.size}` },
+                    body: file.slice(offset, end)
+                });
+                const data = await response.json();
+                if (response.status === 409) {
+                    // The server has a different amount of data; continue from there
+                    offset = data.detail.offset;
+                } else if (!response.ok) {
+                    throw new Error(`Upload of ${file.name} failed: ${response.status}`);
+                } else {
+                    offset = data.complete ? file.size : data.offset;
+                    failures = 0;
+                }
+            } catch (error) {
+                if (++failures > UPLOAD_MAX_RETRIES) throw error;
+                await new Promise(resolve => setTimeout(resolve, 1000 * failures));
+                offset = await fetchUploadOffset(url);
+            }
+        }
+    }
+    
+    // Bytes of a file the server already has
+    async function fetchUploadOffset(url) {
+        try {
+            const response = await fetch(url);
+            if (!response.ok) return 0;
+            const data = await response.json();
+            return data.offset;
+        } catch (error) {
+            return 0;
+        }
+    }
+    
+    // Poll a processing job until it finishes and resolve with its result
+    function waitForJob(jobId) {
+        return new Promise((resolve, reject) => {
+            function poll() {
+                fetch(`/api/jobs/${jobId}`)
+                    .then(response => response.json())
+                    .then(job => {
+                        if (job.status === 'completed') {
+                            resolve(job.result);
+                        } else if (job.status === 'failed' || job.status === 'cancelled') {
+                            reject(new Error(job.error || `Job ${job.status}`));
+                        } else {
+                            showJobProgress(job.progress);
+                            setTimeout(poll, 1000);
+                        }
+                    })
+                    .catch(reject);
+            }
+            poll();
+        });
+    }
+    
+    // Show the progress of the current processing phase on the process button
+    function showJobProgress(progress) {
+        const phases = ['write', 'select', 'analyze', 'prefilter'];
+        const phase = phases.find(name => progress && progress[name]);
+        if (!phase) return;
+        const { done, total } = progress[phase];
+        const percent = total ? Math.round((done / total) * 100) : 0;
+        processButton.textContent = `Processing... ${phase} ${percent}%`;
+    }
+    
     // Simulate processing based on selected features
     function simulateProcessing() {
         // In a real app, this would be handled by the backend
@@ -276,8 +376,9 @@ document.addEventListener('DOMContentLoaded', function() {
             if (img.preview) {
                 imgElement.src = img.preview;
             } else if (img.path) {
-                // For images from the server, create a URL using the filename
-                imgElement.src = `/temp/processed/${window.currentSessionId}/${img.filename}`;
+                // Images from the server are shown as small previews
+                showPreview(imgElement, img, GRID_THUMBNAIL_SIZE);
+                imgElement.loading = 'lazy';
             }
             
             imgElement.alt = img.filename;
@@ -322,6 +423,24 @@ document.addEventListener('DOMContentLoaded', function() {
         resultsContainer.scrollIntoView({ behavior: 'smooth' });
     }
     
+    // URL of a processed image, which may live in a stage subfolder or only in the manifest
+    function processedImageUrl(img) {
+        const relativePath = img.relative_path || img.filename;
+        const encodedPath = relativePath.split('/').map(encodeURIComponent).join('/');
+        return `/api/results/${window.currentSessionId}/${encodedPath}`;
+    }
+    
+    // Show a processed image's preview, falling back to the original if it cannot be rendered
+    function showPreview(imgElement, img, size) {
+        const relativePath = img.relative_path || img.filename;
+        const encodedPath = relativePath.split('/').map(encodeURIComponent).join('/');
+        imgElement.onerror = () => {
+            imgElement.onerror = null;
+            imgElement.src = processedImageUrl(img);
+        };
+        imgElement.src = `/api/thumbnails/${window.currentSessionId}/${size}/${encodedPath}`;
+    }
+    
     // Format file size
     function formatFileSize(bytes) {
         if (bytes === 0) return '0 Bytes';
@@ -367,7 +486,7 @@ document.addEventListener('DOMContentLoaded', function() {
         if (img.preview) {
             modalImg.src = img.preview;
         } else if (img.path) {
-            modalImg.src = `/temp/processed/${window.currentSessionId}/${img.filename}`;
+            showPreview(modalImg, img, MODAL_PREVIEW_SIZE);
         }
         
         modal.style.display = 'block';
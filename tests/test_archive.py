@@ -0,0 +1,141 @@
+"""
+Tests for the streaming ZIP writer and the download route: archives read
+back with zipfile (ZIP64 forced on small files by lowering the limits),
+and byte ranges must be exact slices of the full archive.
+"""
+import io
+import os
+import zipfile
+
+import pytest
+from fastapi.testclient import TestClient
+
+from pipeline import archive
+from pipeline.archive import ZipStream, archive_files
+
+
+def write_files(directory, files):
+    for arcname, data in files.items():
+        path = os.path.join(directory, *arcname.split("/"))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(data)
+
+
+@pytest.fixture
+def files():
+    return {
+        "keep/a.jpg": os.urandom(3000),
+        "keep/b.png": os.urandom(10),
+        "notes.txt": b"all kept images\n" * 500,
+        "empty.jpg": b"",
+        "clusters/é.jpg": os.urandom(700),
+    }
+
+
+@pytest.fixture
+def output_dir(tmp_path, files):
+    write_files(str(tmp_path), files)
+    return str(tmp_path)
+
+
+def read_back(data):
+    with zipfile.ZipFile(io.BytesIO(data)) as zf:
+        assert zf.testzip() is None
+        return {info.filename: zf.read(info) for info in zf.infolist()}
+
+
+@pytest.mark.parametrize("compress", [True, False])
+def test_read_back(output_dir, files, compress):
+    stream = ZipStream(archive_files(output_dir), compress=compress)
+    data = b"".join(stream.iter_bytes())
+    assert read_back(data) == files
+    if compress:
+        assert stream.size is None
+    else:
+        assert stream.size == len(data)
+
+
+@pytest.mark.parametrize("compress", [True, False])
+def test_forced_zip64(monkeypatch, output_dir, files, compress):
+    monkeypatch.setattr(archive, "ZIP64_LIMIT", 500)
+    monkeypatch.setattr(archive, "ZIP64_DEFLATE_LIMIT", 500)
+    monkeypatch.setattr(archive, "ZIP64_ENTRY_LIMIT", 2)
+    stream = ZipStream(archive_files(output_dir), compress=compress)
+    data = b"".join(stream.iter_bytes())
+    assert data.find(b"PK\x06\x06") != -1
+    assert read_back(data) == files
+    if not compress:
+        assert stream.size == len(data)
+
+
+def test_ranges_are_slices(output_dir):
+    stream = ZipStream(archive_files(output_dir), compress=False)
+    full = b"".join(stream.iter_bytes())
+    size = len(full)
+    boundaries = [0, 1, 29, 30, 31, 100, size // 2, size - 23, size - 22, size - 1]
+    for start in boundaries:
+        for end in boundaries:
+            if start <= end:
+                part = b"".join(ZipStream(archive_files(output_dir), compress=False).iter_bytes(start, end))
+                assert part == full[start:end + 1], (start, end)
+
+
+def test_deflated_archive_cannot_start_late(output_dir):
+    stream = ZipStream(archive_files(output_dir))
+    with pytest.raises(ValueError):
+        list(stream.iter_bytes(10))
+
+
+@pytest.fixture
+def client(monkeypatch, tmp_path):
+    # The app keeps its folders relative to the working directory
+    monkeypatch.chdir(tmp_path)
+    import main
+    return TestClient(main.app), main
+
+
+def test_download_ranges(client, files):
+    client, main = client
+    os.makedirs(main.PROCESSED_DIR, exist_ok=True)
+    write_files(os.path.join(main.PROCESSED_DIR, "session"), files)
+
+    response = client.get("/api/download/session", params={"compress": "false"})
+    assert response.status_code == 200
+    full = response.content
+    assert read_back(full) == files
+    assert response.headers["accept-ranges"] == "bytes"
+    assert int(response.headers["content-length"]) == len(full)
+    etag = response.headers["etag"]
+
+    for header, start, end in [("bytes=0-99", 0, 99), ("bytes=100-", 100, len(full) - 1),
+                               ("bytes=-50", len(full) - 50, len(full) - 1),
+                               ("bytes=10-99999999", 10, len(full) - 1)]:
+        response = client.get("/api/download/session", params={"compress": "false"}, headers={"Range": header})
+        assert response.status_code == 206
+        assert response.headers["content-range"] == f"bytes {start}-{end}/{len(full)}"
+        assert response.content == full[start:end + 1]
+
+    response = client.get("/api/download/session", params={"compress": "false"},
+                          headers={"Range": "bytes=100-", "If-Range": etag})
+    assert response.status_code == 206
+    response = client.get("/api/download/session", params={"compress": "false"},
+                          headers={"Range": "bytes=100-", "If-Range": '"stale"'})
+    assert response.status_code == 200
+    assert response.content == full
+
+    response = client.get("/api/download/session", params={"compress": "false"},
+                          headers={"Range": f"bytes={len(full)}-"})
+    assert response.status_code == 416
+    assert response.headers["content-range"] == f"bytes */{len(full)}"
+    assert main.janitor._holds == {}
+
+
+def test_download_deflated(client, files):
+    client, main = client
+    write_files(os.path.join(main.PROCESSED_DIR, "session"), files)
+    response = client.get("/api/download/session", headers={"Range": "bytes=100-"})
+    assert response.status_code == 200
+    assert "accept-ranges" not in response.headers
+    assert read_back(response.content) == files
+    assert client.get("/api/download/missing").status_code == 404
@@ -0,0 +1,77 @@
+"""
+Round trip through the broker executor: a submitted task is claimed by a
+worker, run, and its result or exception comes back to the future, with
+the in-memory queue and with a SQLite queue file.
+"""
+import os
+import stat
+
+import pytest
+
+from pipeline.broker import BrokerExecutor, InProcessBroker, SQLiteBroker
+
+TIMEOUT = 30
+
+
+def add(a, b, scale=1):
+    return (a + b) * scale
+
+
+def fail(message):
+    raise ValueError(message)
+
+
+def unpicklable():
+    return lambda: None
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def broker(request, tmp_path):
+    if request.param == "memory":
+        broker = InProcessBroker()
+    else:
+        broker = SQLiteBroker(str(tmp_path / "queue.sqlite3"), poll_seconds=0.01)
+    yield broker
+    broker.close()
+
+
+@pytest.fixture
+def executor(broker):
+    executor = BrokerExecutor(broker, local_workers=2)
+    yield executor
+    executor.shutdown()
+
+
+def test_result_round_trip(executor):
+    futures = [executor.submit(add, i, 1, scale=2) for i in range(20)]
+    assert [future.result(TIMEOUT) for future in futures] == [(i + 1) * 2 for i in range(20)]
+
+
+def test_exception_round_trip(executor):
+    future = executor.submit(fail, "bad image")
+    with pytest.raises(ValueError, match="bad image"):
+        future.result(TIMEOUT)
+    # The worker survives a failing task
+    assert executor.submit(add, 1, 2).result(TIMEOUT) == 3
+
+
+def test_results_are_taken(broker, executor):
+    executor.submit(add, 1, 2).result(TIMEOUT)
+    assert broker.stats() == {"queued": 0, "running": 0, "done": 0}
+
+
+def test_unpicklable_result():
+    broker = InProcessBroker()
+    executor = BrokerExecutor(broker, local_workers=1)
+    try:
+        future = executor.submit(unpicklable)
+        with pytest.raises(RuntimeError, match="Could not send the result"):
+            future.result(TIMEOUT)
+    finally:
+        executor.shutdown()
+
+
+def test_queue_file_is_private(tmp_path):
+    path = tmp_path / "queue.sqlite3"
+    SQLiteBroker(str(path)).close()
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o600
@@ -0,0 +1,141 @@
+"""
+Tests for the capture date reader, on small files built per container
+(JPEG, TIFF, PNG, WebP, HEIF) with the date in EXIF, GPS, XMP or PNG
+text chunks. Malformed and truncated files must read as no date instead
+of raising.
+"""
+import io
+import random
+import struct
+from datetime import datetime
+
+import pytest
+from PIL import Image, PngImagePlugin
+
+from features.capture_date import read_capture_date
+
+DATE = datetime(2021, 5, 6, 7, 8, 9)
+EXIF_DATE = "2021:05:06 07:08:09"
+
+EXIF_IFD = 0x8769
+GPS_IFD = 0x8825
+
+XMP = (b'<x:xmpmeta xmlns:x="adobe:ns:meta/"><rdf:RDF><rdf:Description '
+       b'xmp:CreateDate="2021-05-06T07:08:09+02:00"/></rdf:RDF></x:xmpmeta>')
+
+
+def exif_bytes(tags=None, gps=None):
+    exif = Image.Exif()
+    if tags:
+        exif[EXIF_IFD] = tags
+    if gps:
+        exif[GPS_IFD] = gps
+    return exif.tobytes()
+
+
+def encode(fmt, **params):
+    buffer = io.BytesIO()
+    Image.new("RGB", (16, 12), (90, 120, 150)).save(buffer, fmt, **params)
+    return buffer.getvalue()
+
+
+def jpeg_with_segment(payload):
+    # Inserted as an APP1 segment right after the start of image
+    data = encode("JPEG")
+    return data[:2] + b"\xff\xe1" + struct.pack(">H", len(payload) + 2) + payload + data[2:]
+
+
+def box(kind, payload):
+    return struct.pack(">I4s", 8 + len(payload), kind) + payload
+
+
+def heif(exif):
+    """
+    A HEIF file holding only an Exif item, stored in mdat and located
+    through iinf and iloc, as cameras write it.
+    """
+    ftyp = box(b"ftyp", b"heic" + b"\0\0\0\0" + b"mif1heic")
+    # Item data: offset of the TIFF header past the "Exif\0\0" prefix
+    item = struct.pack(">I", 6) + exif
+    hdlr = box(b"hdlr", b"\0" * 8 + b"pict" + b"\0" * 13)
+    infe = box(b"infe", b"\x02\0\0\0" + struct.pack(">HH", 1, 0) + b"Exif" + b"\0")
+    iinf = box(b"iinf", b"\0\0\0\0" + struct.pack(">H", 1) + infe)
+
+    def build(offset):
+        iloc = box(b"iloc", b"\0\0\0\0" + bytes([0x44, 0x00]) + struct.pack(">HHHHII", 1, 1, 0, 1, offset, len(item)))
+        return ftyp + box(b"meta", b"\0\0\0\0" + hdlr + iinf + iloc)
+
+    head = build(0)
+    return build(len(head) + 8) + box(b"mdat", item)
+
+
+def fixtures():
+    exif = exif_bytes({0x9003: EXIF_DATE})
+    png_text = PngImagePlugin.PngInfo()
+    png_text.add_text("Creation Time", "Thu, 06 May 2021 07:08:09 GMT")
+    png_xmp = PngImagePlugin.PngInfo()
+    png_xmp.add_itxt("XML:com.adobe.xmp", XMP.decode(), zip=True)
+    return {
+        "jpeg": encode("JPEG", exif=exif),
+        "jpeg-digitized": encode("JPEG", exif=exif_bytes({0x9004: EXIF_DATE})),
+        "jpeg-gps": encode("JPEG", exif=exif_bytes(gps={0x001D: "2021:05:06", 0x0007: (7.0, 8.0, 9.0)})),
+        "jpeg-xmp": jpeg_with_segment(b"http://ns.adobe.com/xap/1.0/\0" + XMP),
+        "tiff": encode("TIFF", exif=exif),
+        "png": encode("PNG", exif=exif),
+        "png-creation-time": encode("PNG", pnginfo=png_text),
+        "png-xmp": encode("PNG", pnginfo=png_xmp),
+        "webp": encode("WEBP", exif=exif),
+        "heif": heif(exif),
+    }
+
+
+FIXTURES = fixtures()
+
+
+@pytest.mark.parametrize("name", sorted(FIXTURES))
+def test_capture_date(name):
+    assert read_capture_date(FIXTURES[name]) == DATE
+
+
+@pytest.mark.parametrize("fmt", ["JPEG", "TIFF", "PNG", "WEBP"])
+def test_no_metadata(fmt):
+    assert read_capture_date(encode(fmt)) is None
+
+
+def test_zeroed_date():
+    assert read_capture_date(encode("JPEG", exif=exif_bytes({0x9003: "0000:00:00 00:00:00"}))) is None
+
+
+def test_reads_paths(tmp_path):
+    path = tmp_path / "photo.jpg"
+    path.write_bytes(FIXTURES["jpeg"])
+    assert read_capture_date(str(path)) == DATE
+    with pytest.raises(OSError):
+        read_capture_date(str(tmp_path / "missing.jpg"))
+
+
+@pytest.mark.parametrize("data", [b"", b"\xff\xd8", b"II*\0", b"\x89PNG\r\n\x1a\n", b"RIFF\0\0\0\0WEBP",
+                                  b"\0\0\0\x10ftypheic", b"not an image at all"])
+def test_stubs(data):
+    assert read_capture_date(data) is None
+
+
+@pytest.mark.parametrize("name", sorted(FIXTURES))
+def test_truncated(name):
+    data = FIXTURES[name]
+    for length in range(len(data)):
+        date = read_capture_date(data[:length])
+        assert date is None or date == DATE, length
+
+
+@pytest.mark.parametrize("name", sorted(FIXTURES))
+def test_corrupted(name):
+    rng = random.Random(name)
+    data = FIXTURES[name]
+    for _ in range(300):
+        corrupted = bytearray(data)
+        for _ in range(rng.randint(1, 8)):
+            # Corruption concentrated in the metadata at the head of the file
+            corrupted[rng.randrange(min(len(data), 400))] = rng.randrange(256)
+        date = read_capture_date(bytes(corrupted))
+        assert date is None or isinstance(date, datetime)
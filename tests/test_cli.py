@@ -0,0 +1,112 @@
+"""
+Resume test for the batch CLI: a run whose journal is cut partway, as by
+an interruption, must only analyze again the images whose analyses were
+lost, and end with the same output as an uninterrupted run.
+"""
+import json
+import os
+import shutil
+
+import cv2
+import numpy as np
+import pytest
+
+from pipeline import cli, engine, settings
+
+FEATURES = ["--remove-duplicates", "--remove-blur", "--sort-date"]
+
+
+def write_images(directory, count=12):
+    rng = np.random.default_rng(0)
+    paths = []
+    for index in range(count):
+        image = rng.integers(0, 256, size=(96, 128, 3), dtype=np.uint8)
+        if index % 4 == 3:
+            # A few blurry images for the predicate to drop
+            image = cv2.GaussianBlur(image, (31, 31), 0)
+        path = os.path.join(directory, "sub" if index % 2 else "", f"image_{index:02d}.png")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        cv2.imwrite(path, image)
+        paths.append(path)
+    # And an exact duplicate
+    shutil.copy(paths[0], os.path.join(directory, "copy_of_00.png"))
+
+
+def analyzed_images(journal_path):
+    """
+    The stages journaled per image path, and the journal's lines.
+    """
+    with open(journal_path, encoding="utf-8") as f:
+        lines = f.readlines()
+    stages = {}
+    for line in lines:
+        try:
+            node, _ = json.loads(line)
+        except ValueError:
+            continue
+        if node[0] == "analyze":
+            path = node[3].rsplit(":", 2)[0]
+            stages.setdefault(path, set()).add(node[1])
+    return stages, lines
+
+
+def output_files(output_dir):
+    return sorted(
+        os.path.relpath(os.path.join(directory, name), output_dir)
+        for directory, _, names in os.walk(output_dir) for name in names
+        if name != cli.JOURNAL_FILENAME
+    )
+
+
+@pytest.fixture
+def sent(monkeypatch):
+    # In-process workers, so the images sent to analysis can be recorded
+    monkeypatch.setattr(settings, "ANALYSIS_CACHE_PATH", "")
+    sent = []
+    analyze_images = engine.analyze_images
+
+    def recording(items, options):
+        sent.extend(os.path.abspath(item[0]) for item in items)
+        return analyze_images(items, options)
+
+    monkeypatch.setattr(engine, "analyze_images", recording)
+    return sent
+
+
+def run(input_dir, output_dir):
+    return cli.main([input_dir, "--output", output_dir, "--executor", "serial"] + FEATURES)
+
+
+def test_resume_after_truncated_journal(tmp_path, sent):
+    input_dir, output_dir = str(tmp_path / "input"), str(tmp_path / "output")
+    write_images(input_dir)
+    journal_path = os.path.join(output_dir, cli.JOURNAL_FILENAME)
+
+    assert run(input_dir, output_dir) == 0
+    first_outputs = output_files(output_dir)
+    stages, lines = analyzed_images(journal_path)
+    assert len(stages) == 13
+    assert len(set(sent)) == 13
+
+    # Interrupted before the outputs, with the journal cut partway through
+    # the analyses, in the middle of a line
+    shutil.rmtree(output_dir)
+    os.makedirs(output_dir)
+    keep = len(lines) // 3
+    with open(journal_path, "w", encoding="utf-8") as f:
+        f.writelines(lines[:keep])
+        f.write(lines[keep][:len(lines[keep]) // 2])
+    kept_stages, _ = analyzed_images(journal_path)
+    finished = {path for path, names in stages.items() if kept_stages.get(path) == names}
+    assert finished and len(finished) < len(stages)
+
+    sent.clear()
+    assert run(input_dir, output_dir) == 0
+    assert set(sent) == set(stages) - finished
+    assert output_files(output_dir) == first_outputs
+
+    # Everything is journaled now
+    sent.clear()
+    assert run(input_dir, output_dir) == 0
+    assert sent == []
+    assert output_files(output_dir) == first_outputs
@@ -0,0 +1,79 @@
+"""
+Parity test for the batched hash engine: hash_gray_batch must give exactly
+the bits of imagehash's own functions, which earlier runs (and the analysis
+cache) computed duplicate hashes with.
+"""
+import glob
+import os
+
+import imagehash
+import numpy as np
+import pytest
+from PIL import Image
+
+from features.image_hashes import HASH_KINDS, hash_gray_batch
+
+SAMPLES_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "Image Samples")
+
+REFERENCE_HASHES = {
+    "ahash": imagehash.average_hash,
+    "dhash": imagehash.dhash,
+    "phash": imagehash.phash,
+    "whash": imagehash.whash,
+}
+
+
+def sample_images():
+    images = []
+    for path in sorted(glob.glob(os.path.join(SAMPLES_DIR, "*"))):
+        with Image.open(path) as img:
+            # Any grayscale input will do, as long as both sides hash the same pixels
+            img.draft("L", (512, 512))
+            images.append(img.convert("L"))
+    return images
+
+
+def synthetic_images():
+    rng = np.random.default_rng(0)
+    # Odd, non-square and tiny sizes exercise the per-side whash batches
+    sizes = [(37, 53), (640, 480), (480, 640), (5, 9), (256, 256)]
+    return [Image.fromarray(rng.integers(0, 256, size=size, dtype=np.uint8)) for size in sizes]
+
+
+def reference_bits(kind, image):
+    return int(str(REFERENCE_HASHES[kind](image)), 16)
+
+
+@pytest.fixture(scope="module")
+def images():
+    return sample_images() + synthetic_images()
+
+
+def test_samples_found():
+    assert sample_images()
+
+
+@pytest.mark.parametrize("kind", HASH_KINDS)
+def test_batch_matches_imagehash(images, kind):
+    hashes = hash_gray_batch(images, kinds=(kind,))[kind]
+    assert hashes.dtype == np.uint64
+    assert [int(value) for value in hashes] == [reference_bits(kind, image) for image in images]
+
+
+def test_arrays_hash_like_images(images):
+    arrays = [np.asarray(image) for image in images]
+    from_arrays = hash_gray_batch(arrays, kinds=HASH_KINDS)
+    from_images = hash_gray_batch(images, kinds=HASH_KINDS)
+    for kind in HASH_KINDS:
+        assert np.array_equal(from_arrays[kind], from_images[kind])
+
+
+def test_empty_batch():
+    hashes = hash_gray_batch([])
+    assert set(hashes) == {"dhash", "phash"}
+    assert all(len(values) == 0 for values in hashes.values())
+
+
+def test_unknown_kind():
+    with pytest.raises(ValueError):
+        hash_gray_batch(synthetic_images(), kinds=("md5",))
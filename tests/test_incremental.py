@@ -0,0 +1,46 @@
+"""
+Tests for the memory bound of the session graphs: least recently used
+nodes, then the graphs of least recently processed sessions, are dropped.
+"""
+from pipeline.incremental import SessionGraph, SessionGraphs
+
+
+def fill(graph, count, prefix="analyze"):
+    for index in range(count):
+        graph.put((prefix, index), {"value": index})
+
+
+def test_graph_drops_least_recently_used_nodes():
+    graph = SessionGraph(max_nodes=3)
+    fill(graph, 3)
+    assert graph.get(("analyze", 0)) == {"value": 0}
+    graph.put(("analyze", 3), {"value": 3})
+    assert len(graph) == 3
+    assert graph.get(("analyze", 1)) is None
+    assert graph.get(("analyze", 0)) == {"value": 0}
+
+
+def test_unbounded_graph():
+    graph = SessionGraph()
+    fill(graph, 1000)
+    assert len(graph) == 1000
+
+
+def test_sessions_share_the_limit():
+    graphs = SessionGraphs(max_nodes=5)
+    fill(graphs.get("a"), 3)
+    fill(graphs.get("b"), 3)
+    # The least recently processed session goes first
+    graphs.get("a")
+    current = graphs.get("c")
+    assert graphs.get("b") is not current
+    assert len(graphs.get("b")) == 0
+    fill(current, 9)
+    assert len(current) == 5
+
+
+def test_no_limit():
+    graphs = SessionGraphs(max_nodes=0)
+    for session_id in "abc":
+        fill(graphs.get(session_id), 100)
+    assert [len(graphs.get(session_id)) for session_id in "abc"] == [100, 100, 100]
@@ -0,0 +1,122 @@
+"""
+Tests for chunked uploads through Ingestor and ChunkWriter: resuming from
+the received offset, discarding rejected chunks, and the content hash of
+a file assembled from chunks.
+"""
+import os
+
+import pytest
+
+from pipeline import settings
+from pipeline.frame import content_hasher
+from pipeline.ingest import ChunkRejected, Ingestor, UploadOutOfOrder
+
+SESSION = "session"
+NAME = "photo.jpg"
+DATA = os.urandom(1000)
+
+
+@pytest.fixture
+def ingestor(monkeypatch, tmp_path):
+    monkeypatch.setattr(settings, "PREANALYZE_UPLOADS", False)
+    ingestor = Ingestor(str(tmp_path / "uploads"), str(tmp_path / "partial"))
+    os.makedirs(ingestor.session_dir(SESSION))
+    return ingestor
+
+
+def send(ingestor, start, end, total=len(DATA), body=None):
+    body = DATA[start:end + 1] if body is None else body
+    with ingestor.begin_chunk(SESSION, NAME, start, end, total) as chunk:
+        for index in range(0, len(body), 100):
+            chunk.write(body[index:index + 100])
+        return chunk.finish()
+
+
+def final_path(ingestor):
+    return os.path.join(ingestor.session_dir(SESSION), NAME)
+
+
+def expected_hash():
+    hasher = content_hasher()
+    hasher.update(DATA)
+    return hasher.hexdigest()
+
+
+def test_chunks_assemble_the_file(ingestor):
+    assert send(ingestor, 0, 399) == (400, False)
+    assert send(ingestor, 400, 999) == (1000, True)
+    with open(final_path(ingestor), "rb") as f:
+        assert f.read() == DATA
+    assert ingestor.content_hashes(SESSION) == {final_path(ingestor): expected_hash()}
+    assert not ingestor.receiving(SESSION)
+
+
+def test_resume_from_received_offset(ingestor):
+    assert ingestor.received_offset(SESSION, NAME) == (0, False)
+    send(ingestor, 0, 299)
+    assert ingestor.receiving(SESSION)
+    # A new ingestor, as after a restart: hashing resumes from the partial file
+    ingestor = Ingestor(ingestor.upload_dir, ingestor.partial_dir)
+    offset, complete = ingestor.received_offset(SESSION, NAME)
+    assert (offset, complete) == (300, False)
+    with pytest.raises(UploadOutOfOrder) as excinfo:
+        send(ingestor, 200, 499)
+    assert excinfo.value.offset == 300
+    assert send(ingestor, offset, 999) == (1000, True)
+    assert ingestor.received_offset(SESSION, NAME) == (1000, True)
+    assert ingestor.content_hashes(SESSION)[final_path(ingestor)] == expected_hash()
+
+
+def test_dropped_connection_keeps_received_bytes(ingestor):
+    with ingestor.begin_chunk(SESSION, NAME, 0, 499, len(DATA)) as chunk:
+        chunk.write(DATA[:250])
+    assert ingestor.received_offset(SESSION, NAME) == (250, False)
+    assert send(ingestor, 250, 999) == (1000, True)
+
+
+@pytest.mark.parametrize("body", [DATA[300:500], DATA[300:700] + b"extra"], ids=["short", "long"])
+def test_rejected_chunk_is_truncated_to_start(ingestor, body):
+    send(ingestor, 0, 299)
+    with pytest.raises(ChunkRejected) as excinfo:
+        send(ingestor, 300, 699, body=body)
+    assert excinfo.value.offset == 300
+    assert ingestor.received_offset(SESSION, NAME) == (300, False)
+    # The file's lock was released and the hash is rebuilt from the file
+    assert send(ingestor, 300, 999) == (1000, True)
+    assert ingestor.content_hashes(SESSION)[final_path(ingestor)] == expected_hash()
+
+
+def test_changed_total_is_rejected(ingestor):
+    send(ingestor, 0, 399)
+    with pytest.raises(ChunkRejected) as excinfo:
+        send(ingestor, 400, 599, total=600)
+    assert excinfo.value.offset == 400
+    assert ingestor.received_offset(SESSION, NAME) == (400, False)
+    assert send(ingestor, 400, 999) == (1000, True)
+
+
+def test_data_past_total_is_rejected(ingestor):
+    # Without the declared total of earlier chunks, as after a restart
+    send(ingestor, 0, 399)
+    ingestor = Ingestor(ingestor.upload_dir, ingestor.partial_dir)
+    with pytest.raises(ChunkRejected) as excinfo:
+        send(ingestor, 400, 599, total=500)
+    assert excinfo.value.offset == 0
+    assert ingestor.received_offset(SESSION, NAME) == (0, False)
+    assert send(ingestor, 0, 999) == (1000, True)
+
+
+def test_concurrent_chunk_is_out_of_order(ingestor):
+    with ingestor.begin_chunk(SESSION, NAME, 0, 99, len(DATA)):
+        with pytest.raises(UploadOutOfOrder):
+            ingestor.begin_chunk(SESSION, NAME, 0, 99, len(DATA))
+    assert send(ingestor, 0, 999) == (1000, True)
+    with pytest.raises(UploadOutOfOrder):
+        send(ingestor, 1000, 1099, total=2000)
+
+
+def test_forget_session_drops_partial_files(ingestor):
+    send(ingestor, 0, 99)
+    ingestor.forget_session(SESSION)
+    assert not ingestor.receiving(SESSION)
+    assert ingestor.received_offset(SESSION, NAME) == (0, False)
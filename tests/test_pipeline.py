@@ -0,0 +1,56 @@
+"""
+Tests for run_pipeline's stage order: duplicate removal runs first, but a
+duplicate group must be represented by an image the other filters keep.
+"""
+import os
+
+import cv2
+import numpy as np
+import pytest
+
+from pipeline import settings
+from pipeline.engine import run_pipeline
+
+
+@pytest.fixture(autouse=True)
+def serial(monkeypatch):
+    monkeypatch.setattr(settings, "ANALYSIS_CACHE_PATH", "")
+    monkeypatch.setattr(settings, "EXECUTOR_KIND", "serial")
+
+
+def write_images(directory):
+    rng = np.random.default_rng(1)
+    sharp = rng.integers(0, 256, size=(60, 80, 3), dtype=np.uint8)
+    sharp = cv2.resize(sharp, (320, 240), interpolation=cv2.INTER_NEAREST)
+    images = {
+        # Sorted first, so it leads the duplicate group
+        "a_blurry.png": cv2.GaussianBlur(sharp, (41, 41), 0),
+        "b_sharp.png": sharp,
+        "c_other.png": rng.integers(0, 256, size=(240, 320, 3), dtype=np.uint8),
+    }
+    paths = []
+    for name, image in images.items():
+        paths.append(os.path.join(directory, name))
+        cv2.imwrite(paths[-1], image)
+    return paths
+
+
+def kept_names(processed_images):
+    return sorted(os.path.basename(image["path"]) for image in processed_images)
+
+
+def test_duplicates_alone(tmp_path):
+    paths = write_images(str(tmp_path))
+    processed, stats = run_pipeline(paths, str(tmp_path / "out"), {"remove_duplicates": True})
+    assert kept_names(processed) == ["a_blurry.png", "c_other.png"]
+    assert stats["duplicates_removed"] == 1
+
+
+def test_blurry_leader_gives_way(tmp_path):
+    paths = write_images(str(tmp_path))
+    options = {"remove_duplicates": True, "remove_blur": True}
+    processed, stats = run_pipeline(paths, str(tmp_path / "out"), options)
+    assert kept_names(processed) == ["b_sharp.png", "c_other.png"]
+    assert stats["blur_removed"] == 1
+    assert stats["duplicates_removed"] == 0
+    assert stats["plan"][0] == "remove_duplicates"
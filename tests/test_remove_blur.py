@@ -0,0 +1,103 @@
+"""
+Regression test for the blur scoring engine: score_blur_gray and
+score_blur_batch must stay within FOCUS_SCORE_TOLERANCE of the reference
+focus measures and never change a blurry/sharp decision.
+"""
+import glob
+import os
+
+import cv2
+import numpy as np
+import pytest
+
+from features.remove_blur import (
+    DEFAULT_BLUR_THRESHOLD, FFT_WEIGHT, FOCUS_SCORE_TOLERANCE, FRACTION_BLURRY, LAPLACIAN_WEIGHT,
+    LOCAL_BLUR_THRESHOLD, PATCH_GRID, SIZE_PERCENT, TENENGRAD_WEIGHT,
+    improved_fft_blur_detection, multi_scale_laplacian_variance, patch_based_blur_check,
+    resize_image, score_blur_batch, score_blur_gray,
+)
+
+SAMPLES_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "Image Samples")
+
+
+def reference_score(gray, threshold=DEFAULT_BLUR_THRESHOLD):
+    """
+    (score, is_blurry) as computed before the engine was reworked: float64
+    measures, a full complex FFT and a Laplacian per patch.
+    """
+    laplacian_var = multi_scale_laplacian_variance(gray, levels=3)
+    sobel_x = cv2.Sobel(gray, cv2.CV_64F, 1, 0, ksize=3)
+    sobel_y = cv2.Sobel(gray, cv2.CV_64F, 0, 1, ksize=3)
+    tenengrad = np.mean(sobel_x ** 2 + sobel_y ** 2)
+    fft_score = improved_fft_blur_detection(gray, size_percent=SIZE_PERCENT)
+    score = LAPLACIAN_WEIGHT * laplacian_var + TENENGRAD_WEIGHT * tenengrad + FFT_WEIGHT * fft_score
+
+    mean_intensity = np.mean(gray)
+    factor = 0.8 if mean_intensity < 50 else 1.2 if mean_intensity > 200 else 1.0
+    global_blurry = score < threshold * factor
+    local_blurry = patch_based_blur_check(
+        gray, patch_grid=PATCH_GRID, local_threshold=LOCAL_BLUR_THRESHOLD, fraction_blurry=FRACTION_BLURRY
+    )
+    return float(score), bool(global_blurry or local_blurry)
+
+
+def _sample_grays():
+    grays = {}
+    for path in sorted(glob.glob(os.path.join(SAMPLES_DIR, "*"))):
+        image = cv2.imread(path)
+        if image is not None:
+            grays[os.path.basename(path)] = cv2.cvtColor(resize_image(image, width=1024), cv2.COLOR_BGR2GRAY)
+    return grays
+
+
+def _variants(name, gray):
+    motion = np.zeros((15, 15), dtype=np.float32)
+    motion[7, :] = 1 / 15
+    yield name, gray
+    yield f"{name} gaussian", cv2.GaussianBlur(gray, (0, 0), 3)
+    yield f"{name} motion", cv2.filter2D(gray, -1, motion)
+    yield f"{name} dark", (gray * 0.2).astype(np.uint8)
+    yield f"{name} bright", np.clip(gray.astype(np.int16) + 170, 0, 255).astype(np.uint8)
+
+
+def _cases():
+    rng = np.random.default_rng(0)
+    images = _sample_grays()
+    # Synthetic scenes cover sizes and contents the samples do not
+    images["synthetic noise"] = rng.integers(0, 256, (480, 640), dtype=np.uint8)
+    images["synthetic checkerboard"] = (np.indices((600, 800)).sum(axis=0) // 20 % 2 * 255).astype(np.uint8)
+    return [case for name, gray in images.items() for case in _variants(name, gray)]
+
+
+CASES = _cases()
+
+
+def _assert_matches(name, result, reference):
+    score, is_blurry = result
+    expected_score, expected_blurry = reference
+    difference = abs(score - expected_score) / max(abs(expected_score), 1e-12)
+    assert difference <= FOCUS_SCORE_TOLERANCE, f"{name}: relative difference {difference:.3g}"
+    assert is_blurry == expected_blurry, f"{name}: decision changed"
+
+
+def test_flat_image_decision_matches_reference():
+    # A featureless image has no high frequencies: its FFT measure is the log
+    # of rounding noise in both implementations, so only the decision is stable
+    for name, gray in _variants("flat", np.full((300, 400), 128, dtype=np.uint8)):
+        assert score_blur_gray(gray)[1] == reference_score(gray)[1], f"{name}: decision changed"
+
+
+def test_samples_found():
+    assert any(not name.startswith("synthetic") for name, _ in CASES), f"No images in {SAMPLES_DIR}"
+
+
+@pytest.mark.parametrize("name, gray", CASES, ids=[name for name, _ in CASES])
+def test_score_blur_gray_matches_reference(name, gray):
+    _assert_matches(name, score_blur_gray(gray), reference_score(gray))
+
+
+def test_score_blur_batch_matches_reference():
+    results = score_blur_batch([gray for _, gray in CASES])
+    assert len(results) == len(CASES)
+    for (name, gray), result in zip(CASES, results):
+        _assert_matches(name, result, reference_score(gray))